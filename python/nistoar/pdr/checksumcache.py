@@ -0,0 +1,258 @@
+"""
+A persistent cache of file checksums.
+
+Bagging the same input files repeatedly (e.g. when a MIDAS submission is
+re-bagged by the metadata service and later by the preservation service)
+requires each file's checksum to be re-calculated each time unless it is
+remembered.  The ChecksumCache class stores checksums in an SQLite database
+file, keyed by the identity of the file on disk (its device and inode) and
+validated against its size and modification time, so that the cached value
+is only used if the file has not changed.  Because the key is the inode,
+a checksum calculated for one path applies as well to any hard link to the
+same file.
+"""
+import os, time, sqlite3, threading
+
+from .utils import checksum_of, checksums_of
+
+DEF_MAX_ENTRIES = 500000
+DEF_ALGORITHM = "sha256"
+
+# files modified more recently than this many seconds ago are not cached, as
+# a further change within the filesystem's timestamp resolution could go
+# undetected.
+MTIME_RESOLUTION = 2.0
+
+# a cache hit only records a new access time if the recorded one is older
+# than this many seconds; this keeps hits from costing a database write each
+# while still being fine enough for least-recently-used eviction.
+ACCESS_RESOLUTION = 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checksums (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (dev, ino, algorithm)
+);
+CREATE INDEX IF NOT EXISTS checksums_accessed ON checksums (accessed);
+"""
+
+def _mtime_ns(st):
+    if hasattr(st, 'st_mtime_ns'):
+        return st.st_mtime_ns
+    return int(st.st_mtime * 1000000000)
+
+class ChecksumCache(object):
+    """
+    a persistent, size-bounded cache of file checksums stored in an SQLite
+    database file.  When the number of cached checksums exceeds the configured
+    maximum, the least recently used entries are evicted.
+
+    An instance can be shared across threads; the database file can be shared
+    across processes.
+    """
+
+    def __init__(self, dbfile, max_entries=DEF_MAX_ENTRIES,
+                 algorithm=DEF_ALGORITHM, access_resolution=ACCESS_RESOLUTION):
+        """
+        open (and create, if necessary) the cache database
+
+        :param str dbfile:       the path to the SQLite database file
+        :param int max_entries:  the maximum number of checksums to retain
+        :param str algorithm:    the checksum algorithm (only "sha256" is
+                                 currently supported)
+        :param float access_resolution:  the granularity, in seconds, of the
+                                 access times used to choose entries to evict
+        """
+        if algorithm != DEF_ALGORITHM:
+            raise ValueError("ChecksumCache: unsupported algorithm: " +
+                             algorithm)
+        self.dbfile = dbfile
+        self.max_entries = max_entries
+        self.algorithm = algorithm
+        self.access_resolution = access_resolution
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(dbfile, timeout=30,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+        self._since_prune = 0
+
+        self._stats = { "hits": 0, "misses": 0, "invalidated": 0,
+                        "stored": 0, "evicted": 0 }
+
+    @classmethod
+    def from_config(cls, config, basedir):
+        """
+        create a cache as described by a configuration dictionary.  The
+        following properties are supported:
+        :prop dbfile str ("checksum_cache.sqlite"):  the path to the database
+                         file; a relative path is taken to be relative to
+                         basedir.
+        :prop max_entries int:  the maximum number of checksums to retain
+        :prop access_resolution float (3600):  the granularity, in seconds,
+                         of the access times used to choose entries to evict
+
+        :param dict config:  the configuration dictionary
+        :param str basedir:  the directory that relative dbfile paths are
+                             relative to (usually a working directory)
+        """
+        dbfile = config.get('dbfile', "checksum_cache.sqlite")
+        if not os.path.isabs(dbfile):
+            dbfile = os.path.join(basedir, dbfile)
+        return cls(dbfile, config.get('max_entries', DEF_MAX_ENTRIES),
+                   access_resolution=config.get('access_resolution',
+                                                ACCESS_RESOLUTION))
+
+    @property
+    def stats(self):
+        """
+        a dictionary of counts of cache activity since this instance was
+        created:  hits, misses, invalidated (i.e. found but stale because the
+        file changed), stored, and evicted.
+        """
+        return dict(self._stats)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM checksums") \
+                           .fetchone()[0]
+
+    def get(self, filepath, st=None):
+        """
+        return the cached checksum for the given file or None if a valid
+        checksum is not cached.
+
+        :param str filepath:  the path to the file of interest
+        :param st:            the file's os.stat() result, if already known
+        """
+        if st is None:
+            st = os.stat(filepath)
+        key = (st.st_dev, st.st_ino, self.algorithm)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, hash, accessed "
+                                   "FROM checksums "
+                                   "WHERE dev=? AND ino=? AND algorithm=?",
+                                   key).fetchone()
+            if not row:
+                self._stats['misses'] += 1
+                return None
+
+            if row[0] != st.st_size or row[1] != _mtime_ns(st):
+                self._stats['invalidated'] += 1
+                self._stats['misses'] += 1
+                self._db.execute("DELETE FROM checksums WHERE dev=? AND ino=? "
+                                 "AND algorithm=?", key)
+                self._db.commit()
+                return None
+
+            self._stats['hits'] += 1
+            now = time.time()
+            if row[3] < now - self.access_resolution:
+                self._db.execute("UPDATE checksums SET accessed=? WHERE dev=? "
+                                 "AND ino=? AND algorithm=?", (now,)+key)
+                self._db.commit()
+            return row[2]
+
+    def put(self, filepath, checksum, st=None):
+        """
+        cache the checksum for the given file.
+
+        :param str filepath:  the path to the file of interest
+        :param str checksum:  the file's checksum
+        :param st:            the file's os.stat() result, taken before the
+                              checksum was calculated; if not provided, it
+                              will be determined now.
+        """
+        if st is None:
+            st = os.stat(filepath)
+        now = time.time()
+        if st.st_mtime > now - MTIME_RESOLUTION:
+            # too recently modified to trust the timestamp
+            return
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO checksums VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?)",
+                             (st.st_dev, st.st_ino, self.algorithm, st.st_size,
+                              _mtime_ns(st), checksum, now))
+            self._db.commit()
+            self._stats['stored'] += 1
+            self._since_prune += 1
+            if self._since_prune > max(self.max_entries / 10, 1):
+                self.prune()
+
+    def prune(self):
+        """
+        evict the least recently used entries so that the cache does not
+        exceed its maximum size.
+        """
+        with self._lock:
+            self._since_prune = 0
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self._db.execute("DELETE FROM checksums WHERE rowid IN "
+                                 "(SELECT rowid FROM checksums "
+                                 " ORDER BY accessed LIMIT ?)", (excess,))
+                self._db.commit()
+                self._stats['evicted'] += excess
+
+    def clear(self):
+        """
+        remove all entries from the cache
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM checksums")
+            self._db.commit()
+
+    def close(self):
+        """
+        close the connection to the database
+        """
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def checksum_of(self, filepath):
+        """
+        return the checksum of the given file, taking it from the cache if
+        possible and otherwise calculating it (and caching the result).
+        """
+        st = os.stat(filepath)
+        out = self.get(filepath, st)
+        if out is None:
+            out = checksum_of(filepath)
+            self.put(filepath, out, st)
+        return out
+
+    def checksums_of(self, filepaths, workers=None):
+        """
+        return the checksums of many files, taking them from the cache when
+        possible and calculating the rest in parallel (see
+        nistoar.pdr.utils.checksums_of()).
+
+        :param list filepaths:  the paths to the files to checksum
+        :param int workers:     the number of files to hash in parallel
+        :return generator:  an iterator of 2-tuples giving a file path and its
+                            checksum, in no particular order
+        """
+        tocalc = {}
+        for fp in filepaths:
+            st = os.stat(fp)
+            cs = self.get(fp, st)
+            if cs is None:
+                tocalc[fp] = st
+            else:
+                yield (fp, cs)
+
+        for fp, cs in checksums_of(tocalc.keys(), workers):
+            self.put(fp, cs, tocalc[fp])
+            yield (fp, cs)
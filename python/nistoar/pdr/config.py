@@ -7,6 +7,7 @@ import requests
 from urlparse import urlparse
 
 from .exceptions import ConfigurationException
+from .sessions import get_session
 
 oar_home = None
 try:
@@ -134,7 +135,7 @@ class ConfigService(object):
     an interface to the configuration service
     """
 
-    def __init__(self, urlbase, envprof=None):
+    def __init__(self, urlbase, envprof=None, session=None):
         """
         initialize the service.
         :param urlbase str:  the base URL for the service which must include 
@@ -144,9 +145,14 @@ class ConfigService(object):
         :param envprof str:  the label indicating the default environment 
                              profile (usually, one of 'local', 'dev', 'test',
                              or 'prod').
+        :param session:      the requests Session to send requests through; 
+                             if not provided, the process's shared, 
+                             connection-pooling session (see 
+                             nistoar.pdr.sessions) will be used.
         """
         self._base = urlbase
         self._prof = envprof
+        self._session = session
         if not self._base.endswith('/'):
             self._base += '/'
 
@@ -157,6 +163,15 @@ class ConfigService(object):
         if not u.netloc:
             raise ConfigurationException(msg.format("missing server name"))
 
+    @property
+    def session(self):
+        """
+        the requests Session used to send requests to the service
+        """
+        if self._session is None:
+            return get_session()
+        return self._session
+
     def url_for(self, component, envprof=None):
         """
         return the proper URL for access the configuration for a given 
@@ -180,7 +195,11 @@ class ConfigService(object):
         return true if the service appears to be up.  
         """
         try:
-            resp = requests.get(self.url_for("ready"))
+            # wait_until_up() does its own polling, so don't retry here
+            sess = self._session
+            if sess is None:
+                sess = get_session({ "retries": 0 })
+            resp = sess.get(self.url_for("ready"))
             return resp.status_code and resp.status_code < 500
         except requests.exceptions.RequestException:
             return False
@@ -247,7 +266,7 @@ class ConfigService(object):
         :return dict:  the parsed configuration data 
         """
         try:
-            resp = requests.get(self.url_for(component, envprof))
+            resp = self.session.get(self.url_for(component, envprof))
             resp.raise_for_status()
             return self._extract(resp.json(), component, flat)
         except ValueError as ex:
@@ -8,15 +8,35 @@ from collections import OrderedDict
 import requests
 
 from ..exceptions import PDRServiceException, PDRServerError, IDNotFound
+from ..sessions import get_session
 
 class MetadataClient(object):
     """
     a client interface for retrieving metadata from the RMM
     """
-    def __init__(self, baseurl):
+    def __init__(self, baseurl, session=None):
+        """
+        initialize the client
+
+        :param str baseurl:  the base URL for the RMM service
+        :param session:      the requests Session to send requests through; 
+                             if not provided, the process's shared, 
+                             connection-pooling session (see 
+                             nistoar.pdr.sessions) will be used.
+        """
         self.baseurl = baseurl
         if not self.baseurl.endswith('/'):
             self.baseurl += '/'
+        self._session = session
+
+    @property
+    def session(self):
+        """
+        the requests Session used to send requests to the service
+        """
+        if self._session is None:
+            return get_session()
+        return self._session
 
     def describe(self, id):
         """
@@ -47,7 +67,7 @@ class MetadataClient(object):
     def _retrieve(self, url, id):
         hdrs = { "Accept": "application/json" }
         try:
-            resp = requests.get(url, headers=hdrs)
+            resp = self.session.get(url, headers=hdrs)
 
             if resp.status_code >= 500:
                 raise RMMServerError(id, resp.status_code, resp.reason)
@@ -142,7 +142,9 @@ class BagDistribClient(object):
         :param str bagname:  the name of the bag as given by any of the listing
                              methods in this client.  
         :param dir str:  the directory to save the serialized bag to
+        :return str:  the SHA-256 hash of the saved bag file, as calculated 
+                      during the download, or None if it is not known.
         """
         rurl = "/".join(["_aip", bagname])
-        self.svc.retrieve_file(rurl, os.path.join(outdir, bagname))
+        return self.svc.retrieve_file(rurl, os.path.join(outdir, bagname))
 
@@ -2,23 +2,53 @@
 This distrib submodule provides a client interface to the PDR Distribution 
 Service.
 """
-import os, sys, shutil, logging, json
+import os, sys, shutil, logging, json, re, hashlib
 
-import urllib
 import requests
+from multiprocessing.pool import ThreadPool
 
 from ..exceptions import PDRException, PDRServiceException, PDRServerError
+from ..sessions import get_session
+
+DEF_PROBE_WORKERS = 8
+DEF_CHUNK_SIZE = 1024 * 1024
+DEF_RESUME_ATTEMPTS = 3
+
+_content_range_re = re.compile(r'^bytes\s+(\d+)-')
 
 class RESTServiceClient(object):
     """
     a generic public client interface to a REST service
     """
 
-    def __init__(self, baseurl):
+    def __init__(self, baseurl, session=None, chunk_size=DEF_CHUNK_SIZE,
+                 resume_attempts=DEF_RESUME_ATTEMPTS):
         """
         initialized the service to the given base URL
+
+        :param str baseurl:  the base URL for the service
+        :param session:      the requests Session to send requests through; 
+                             if not provided, the process's shared, 
+                             connection-pooling session (see 
+                             nistoar.pdr.sessions) will be used.
+        :param int chunk_size:  the number of bytes to read at a time when 
+                             saving content to a file
+        :param int resume_attempts:  the number of times retrieve_file() will
+                             try to resume an interrupted download
         """
         self.base = baseurl
+        self._session = session
+        self.chunk_size = chunk_size
+        self.resume_attempts = resume_attempts
+
+    @property
+    def session(self):
+        """
+        the requests Session used to send requests to the service
+        """
+        if self._session is None:
+            return get_session()
+        return self._session
 
     def get_json(self, relurl):
         """
@@ -34,7 +64,7 @@ class RESTServiceClient(object):
 
         resp = None
         try:
-            resp = requests.get(self.base+relurl, headers=hdrs)
+            resp = self.session.get(self.base+relurl, headers=hdrs)
 
             if resp.status_code >= 500:
                 raise DistribServerError(relurl, resp.status_code, resp.reason)
@@ -75,52 +105,18 @@ class RESTServiceClient(object):
         if not relurl.startswith('/'):
             relurl = '/'+relurl
 
-        try:
-            out = urllib.urlopen(self.base+relurl)
-
-            code = out.getcode()
-            hdrs = out.info()
-            reason = "(unknown)"
-            if 'status' in hdrs:
-                reason = hdrs['status']
-                if re.match(r'^\d{3} ', reason):
-                    reason = reason[4:]
-
-            if code >= 500:
-                raise DistribServerError(relurl, code, reason)
-            elif code == 404:
-                raise DistribResourceNotFound(relurl, reason)
-            elif code == 406:
-                raise DistribClientError(relurl, code, reason,
-                                         message="JSON data not available from"+
-                                         " this URL (is URL correct?)")
-            elif code >= 400:
-                raise DistribClientError(relurl, code, reason)
-            elif code != 200:
-                raise DistribServerError(relurl, code, reason,
-                               message="Unexpected response from server: {0} {1}"
-                                        .format(code, reason))
-
-            return out
-        except IOError as ex:
-            raise DistribServerError(message="Trouble connecting to distribution"
-                                     +" service: "+str(ex), cause=ex)
-
-    def retrieve_file(self, relurl, filepath):
-        """
-        retrive the content at the given URL and save it to a local file
-        """
-        if not relurl.startswith('/'):
-            relurl = '/'+relurl
-
         resp = None
         try:
-            resp = requests.get(self.base+relurl, stream=True)
+            resp = self.session.get(self.base+relurl, stream=True)
 
             if resp.status_code >= 500:
                 raise DistribServerError(relurl, resp.status_code, resp.reason)
             elif resp.status_code == 404:
                 raise DistribResourceNotFound(relurl, resp.reason)
+            elif resp.status_code == 406:
+                raise DistribClientError(relurl, resp.status_code, resp.reason,
+                                         message="JSON data not available from"+
+                                         " this URL (is URL correct?)")
             elif resp.status_code >= 400:
                 raise DistribClientError(relurl, resp.status_code, resp.reason)
             elif resp.status_code != 200:
@@ -128,19 +124,120 @@ class RESTServiceClient(object):
                                message="Unexpected response from server: {0} {1}"
                                         .format(resp.status_code, resp.reason))
 
-            with open(filepath, "wb") as fd:
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        fd.write(chunk)
-        
+            out = _ResponseStream(resp)
+            resp = None
+            return out
         except requests.RequestException as ex:
             raise DistribServerError(message="Trouble connecting to distribution"
-                                     +" service: "+ str(ex), cause=ex)
-        
+                                     +" service: "+str(ex), cause=ex)
         finally:
             if resp is not None:
                 resp.close()
 
+    def retrieve_file(self, relurl, filepath, chunk_size=None):
+        """
+        retrive the content at the given URL and save it to a local file.  
+
+        The content is first written to a partial file (with ".part" appended 
+        to the given filepath) which is renamed to filepath when the download 
+        is complete.  If the transfer is interrupted, it is resumed from 
+        where it left off (via an HTTP Range request) up to resume_attempts 
+        times; a partial file left behind by an earlier call is likewise 
+        resumed.  
+
+        :param str relurl:     the relative URL of the content to retrieve
+        :param str filepath:   the path to the file to save the content to
+        :param int chunk_size: the number of bytes to read at a time; if not 
+                               provided, the value set at construction is used.
+        :return str:  the SHA-256 hash (in hex) of the saved file's content, 
+                      calculated as it was downloaded.
+        """
+        if not relurl.startswith('/'):
+            relurl = '/'+relurl
+        if not chunk_size:
+            chunk_size = self.chunk_size
+        partfile = filepath + ".part"
+
+        failures = 0
+        while True:
+            offset = 0
+            if os.path.exists(partfile):
+                offset = os.stat(partfile).st_size
+            hdrs = {}
+            if offset > 0:
+                hdrs['Range'] = "bytes={0}-".format(offset)
+
+            resp = None
+            try:
+                resp = self.session.get(self.base+relurl, stream=True,
+                                        headers=hdrs)
+
+                if resp.status_code == 416 and offset > 0:
+                    # our partial file is not a prefix of the resource
+                    os.remove(partfile)
+                    continue
+                elif resp.status_code >= 500:
+                    raise DistribServerError(relurl, resp.status_code,
+                                             resp.reason)
+                elif resp.status_code == 404:
+                    raise DistribResourceNotFound(relurl, resp.reason)
+                elif resp.status_code >= 400:
+                    raise DistribClientError(relurl, resp.status_code,
+                                             resp.reason)
+                elif resp.status_code not in (200, 206) or \
+                     (resp.status_code == 206 and offset == 0):
+                    raise DistribServerError(relurl, resp.status_code,
+                                             resp.reason,
+                             message="Unexpected response from server: {0} {1}"
+                                             .format(resp.status_code,
+                                                     resp.reason))
+
+                mode = "wb"
+                digest = hashlib.sha256()
+                if resp.status_code == 206:
+                    m = _content_range_re.match(
+                                          resp.headers.get('Content-Range',''))
+                    if not m or int(m.group(1)) != offset:
+                        # can't trust the range that was sent; start over
+                        os.remove(partfile)
+                        continue
+                    mode = "ab"
+                    _hash_file(partfile, digest, chunk_size)
+
+                expected = resp.headers.get('Content-Length')
+                got = 0
+                with open(partfile, mode) as fd:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            fd.write(chunk)
+                            digest.update(chunk)
+                            got += len(chunk)
+
+                if expected and got < int(expected):
+                    raise requests.ConnectionError("connection closed after "+
+                                                   "{0} of {1} bytes"
+                                                   .format(got, expected))
+                break
+
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as ex:
+                failures += 1
+                if failures > self.resume_attempts:
+                    raise DistribServerError(message="Trouble retrieving "+
+                                             relurl + " from distribution " +
+                                             "service: " + str(ex), cause=ex)
+            except requests.RequestException as ex:
+                raise DistribServerError(message="Trouble connecting to "+
+                                         "distribution service: "+ str(ex),
+                                         cause=ex)
+        
+            finally:
+                if resp is not None:
+                    resp.close()
+
+        os.rename(partfile, filepath)
+        return digest.hexdigest()
+
     def head(self, relurl):
         """
         send a HEAD request to the given relative URL to determine if the 
@@ -156,7 +253,7 @@ class RESTServiceClient(object):
 
         resp = None
         try:
-            resp = requests.get(self.base+relurl, allow_redirects=True)
+            resp = self.session.head(self.base+relurl, allow_redirects=True)
             return (resp.status_code, resp.reason)
 
         except requests.RequestException as ex:
@@ -180,8 +277,62 @@ class RESTServiceClient(object):
         except DistribServerError as ex:
             return False
 
+    def are_available(self, relurls, workers=DEF_PROBE_WORKERS):
+        """
+        check the availability of many resources at once (as with 
+        is_available()), sending up to the given number of HEAD requests 
+        concurrently.
+
+        :param list relurls:  the relative URLs of the resources to check
+        :param int  workers:  the maximum number of requests to send at once
+        :return dict:  a mapping of each of the given URLs to True if the 
+                       resource is available or False, otherwise.
+        """
+        relurls = list(relurls)
+        workers = min(workers or 1, len(relurls))
+        if workers <= 1:
+            return dict((u, self.is_available(u)) for u in relurls)
+
+        pool = ThreadPool(workers)
+        try:
+            return dict(zip(relurls, pool.map(self.is_available, relurls)))
+        finally:
+            pool.close()
+            pool.join()
+
         
 
+def _hash_file(filepath, digest, bufsize):
+    # update digest with the contents of a file
+    with open(filepath, 'rb') as fd:
+        buf = fd.read(bufsize)
+        while buf:
+            digest.update(buf)
+            buf = fd.read(bufsize)
+
+class _ResponseStream(object):
+    """
+    a file-like wrapper around a streaming response.  Closing it returns the
+    underlying connection to the session's pool.
+    """
+    def __init__(self, resp):
+        self._resp = resp
+        self._resp.raw.decode_content = True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        return self._resp.raw.read(size)
+
+    def close(self):
+        self._resp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 class DistribServiceException(PDRServiceException):
     """
     an exception indicating a problem using the distribution service.
@@ -1,14 +1,18 @@
 """
 tools for checking the availability of distributions described in a NIST bag.
 """
-import os, re
+import os, re, threading
 from collections import Mapping
+from contextlib import contextmanager
 
 import multibag as mb
 import requests
+from multiprocessing.pool import ThreadPool
 
 from .utils import parse_bag_name
 from ...exceptions import ConfigurationException, StateException
+from ...sessions import get_session
+from ...distrib.client import DEF_PROBE_WORKERS
 from ...distrib import (RESTServiceClient, BagDistribClient, DistribServerError,
                         DistribServiceException, DistribResourceNotFound)
 
@@ -63,7 +67,64 @@ class DataChecker(object):
         svcurl = self.cfg.get('repo_access',{}).get('distrib_service',{}) \
                          .get('service_endpoint')
         if svcurl:
-            self._distsvc = RESTServiceClient(svcurl)
+            self._distsvc = RESTServiceClient(svcurl,
+                  get_session(self.cfg.get('repo_access',{}).get('http_session')))
+
+        # when not None, the results of expensive lookups (opening member
+        # bags, listing remote bags) are remembered here (see memoized())
+        self._memo = None
+        self._memolock = threading.Lock()
+
+    @contextmanager
+    def memoized(self):
+        """
+        return a context within which the member bags opened from the cache 
+        and the bag listings retrieved from the distribution service are 
+        remembered and reused.  This makes checking many files at once (as
+        with unavailable_files()) efficient:  each member bag is opened and 
+        each version is listed at most once.  The memory is released when the 
+        context is exited (unless it is nested inside another such context).  
+        A memoized context is safe to use across multiple threads.
+        """
+        if self._memo is not None:
+            yield self
+            return
+        self._memo = {}
+        try:
+            yield self
+        finally:
+            self._memo = None
+
+    def _memoize(self, kind, key, func):
+        # return the result of func(), remembering it (or the exception it
+        # raises) under (kind, key) if a memoized context is active.
+        memo = self._memo
+        if memo is None:
+            return func()
+        with self._memolock:
+            ent = memo.get((kind, key))
+            if ent is None:
+                ent = memo[(kind, key)] = [threading.Lock(), None]
+        with ent[0]:
+            if ent[1] is None:
+                try:
+                    ent[1] = (True, func())
+                except Exception as ex:
+                    ent[1] = (False, ex)
+        if not ent[1][0]:
+            raise ent[1][1]
+        return ent[1][1]
+
+    def _open_cached_bag(self, loc):
+        try:
+            return self._memoize("bag", loc, lambda: mb.open_bag(loc))
+        except Exception as ex:
+            return None
+
+    def _list_bags_for_version(self, aipid, version):
+        bagsvc = BagDistribClient(aipid, self._distsvc)
+        return self._memoize("versions", (aipid, version),
+                             lambda: bagsvc.list_for_version(version))
 
     def available_in_bag(self, cmp):
         """
@@ -151,7 +212,9 @@ class DataChecker(object):
 
         locs = [ os.path.join(self._store, inbag) ]
         if not os.path.isdir(locs[0]):
-            locs = [os.path.join(self._store, f) for f in os.listdir(self._store)
+            storefiles = self._memoize("store", None,
+                                       lambda: os.listdir(self._store))
+            locs = [os.path.join(self._store, f) for f in storefiles
                                                  if f.startswith(inbag+".")]
             if len(locs) == 0:
                 return False
@@ -159,11 +222,8 @@ class DataChecker(object):
         for loc in locs:
             if not os.path.isfile(loc):
                 continue
-            try:
-                mbag = mb.open_bag(loc)
-            except Exception as ex:
-                continue
-            if mbag.isfile('/'.join(['data', cmp])):
+            mbag = self._open_cached_bag(loc)
+            if mbag and mbag.isfile('/'.join(['data', cmp])):
                 return True
 
         return False
@@ -200,7 +260,7 @@ class DataChecker(object):
         """
         resp = None
         try:
-            resp = requests.head(url, allow_redirects=True)
+            resp = get_session().head(url, allow_redirects=True)
             return (resp.status_code, resp.reason)
         finally:
             if resp is not None:
@@ -241,6 +301,35 @@ class DataChecker(object):
                               "\n  ({0})".format(cmp))
             return False
 
+    def available_via_urls(self, cmps, workers=None):
+        """
+        check the availability of many data files via their download URLs
+        (as with available_via_url()), sending the HEAD requests concurrently.
+
+        :param list cmps:    a list of component metadata dicts or download 
+                             URLs describing the data files to check
+        :param int workers:  the maximum number of requests to send at once;
+                             if not provided, the value of the 
+                             'url_probe_workers' configuration parameter 
+                             (default: 8) is used.
+        :return list:  a list of booleans, one for each of the given files 
+                       (in the same order), indicating whether the file is 
+                       available.
+        """
+        cmps = list(cmps)
+        if workers is None:
+            workers = self.cfg.get('url_probe_workers', DEF_PROBE_WORKERS)
+        workers = min(workers, len(cmps))
+        if workers <= 1:
+            return [self.available_via_url(c) for c in cmps]
+
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(self.available_via_url, cmps)
+        finally:
+            pool.close()
+            pool.join()
+
     def available_as(self, cmp, strict=False, viadistrib=True):
         """
         return an enumeration value indicating how the specified data file is 
@@ -321,10 +410,9 @@ class DataChecker(object):
         
         if not self._distsvc:
             raise StateException("Distribution service not configured")
-        bagsvc = BagDistribClient(parts[0], self._distsvc)
 
         try:
-            matches = [f for f in bagsvc.list_for_version(parts[1])
+            matches = [f for f in self._list_bags_for_version(parts[0],parts[1])
                          if f.startswith(mbagname+".")]
             return len(matches) > 0
 
@@ -345,7 +433,7 @@ class DataChecker(object):
                                mbagname, str(ex))
             
 
-    def unavailable_files(self, strict=False, viadistrib=True):
+    def unavailable_files(self, strict=False, viadistrib=True, workers=None):
         """
         return a list of the data file component filepaths that appear to 
         be unavailable via any means.  This is a check to make sure that all
@@ -353,6 +441,9 @@ class DataChecker(object):
         present bag or otherwise previously preserved and available; in this
         case, the returned list will be empty.
 
+        The checks are done within a memoized() context so that each member 
+        bag is opened and each remote version listing is retrieved only once.
+
         :param bool strict:  if True, don't assume if remote bag containing the
                              file is available that the file is actually in the
                              bag.  Currently, this implementation will return
@@ -361,8 +452,11 @@ class DataChecker(object):
         :param bool viadistrib:  if True, check a file's availability only if
                              its download URL points to the PDR's 
                              distribution service. 
+        :param int workers:  the number of files to check in parallel; if not
+                             provided, the value of the 'check_workers' 
+                             configuration parameter (default: 1) is used.
         """
-        missing = []
+        comps = []
         nerd = self.bag.nerdm_record(False)
         for cmp in nerd.get('components',[]):
             if "dcat:Distribution" not in cmp.get('@type',[]) or \
@@ -371,10 +465,41 @@ class DataChecker(object):
             if viadistrib and 'downloadURL' in cmp and \
                not self.has_pdr_url(cmp['downloadURL']):
                 continue
-            if not self.available(cmp, strict, False):
-                missing.append(cmp.get('filepath') or cmp.get('downloadURL'))
+            comps.append(cmp)
 
-        return missing
+        if workers is None:
+            workers = self.cfg.get('check_workers', 1)
+        workers = min(workers, len(comps))
+        pool = None
+        mapf = map
+        if workers > 1:
+            pool = ThreadPool(workers)
+            mapf = pool.map
+
+        try:
+            with self.memoized():
+                # files not found locally will be checked via their download
+                # URLs all at once.
+                local = mapf(self._available_locally, comps)
+                tocheck = [c for c, avail in zip(comps, local) if not avail]
+                viaurl = self.available_via_urls(tocheck)
+                tocheck = [c for c, avail in zip(tocheck, viaurl) if not avail]
+
+                if not strict and self._distsvc:
+                    remote = mapf(self.containing_bag_available, tocheck)
+                else:
+                    remote = [False] * len(tocheck)
+
+            return [c.get('filepath') or c.get('downloadURL')
+                    for c, avail in zip(tocheck, remote) if not avail]
+
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def _available_locally(self, cmp):
+        return self.available_in_bag(cmp) or self.available_in_cached_bag(cmp)
 
     def all_files_available(self, strict=False, viadistrib=True):
         """
@@ -11,7 +11,7 @@ The implementations use the BagBuilder class to populate the output bag.
 """
 import os, errno, logging, re, json, shutil, threading, time
 from abc import ABCMeta, abstractmethod, abstractproperty
-from collections import OrderedDict
+from collections import OrderedDict, Mapping
 from copy import deepcopy
 
 from .base import SIPBagger, moddate_of, checksum_of, read_pod
@@ -22,6 +22,7 @@ from ..bagit import NISTBag
 from ..bagit.tools import synchronize_enhanced_refs
 from ....id import PDRMinter, NIST_ARK_NAAN
 from ... import def_merge_etcdir, utils
+from ...checksumcache import ChecksumCache
 from .. import (SIPDirectoryError, SIPDirectoryNotFound, AIPValidationError,
                 ConfigurationException, StateException, PODError,
                 PreservationStateException)
@@ -65,6 +66,22 @@ def _midadid_to_dirname(midasid, log=None):
         log.warn("Unexpected MIDAS ID (too short): "+midasid)
     return out
 
+def _open_checksum_cache(config, workdir):
+    # return a ChecksumCache as configured by the 'checksum_cache' parameter
+    # or None if it is not set
+    cscfg = config.get('checksum_cache')
+    if not cscfg:
+        return None
+    if not isinstance(cscfg, Mapping):
+        cscfg = {}
+    try:
+        return ChecksumCache.from_config(cscfg, workdir)
+    except Exception as ex:
+        # the cache is only an optimization
+        log.warn("Unable to open checksum cache (proceeding without it): %s",
+                 str(ex))
+        return None
+
 def midasid_to_bagname(midasid, log=None):
     out = midasid
 
@@ -85,7 +102,8 @@ class MIDASMetadataBagger(SIPBagger):
     :prop bag_builder dict ({}): a set of parameters to pass to the BagBuilder
                                  object used to populate the output bag (see
                                  BagBuilder class documentation for supported
-                                 parameters).
+                                 parameters).  Unless set otherwise here, 
+                                 compact_json is set to True.
     :prop merge_etc        str:  the path to the directory containing the 
                                  metadata merge rule configurations.  If not
                                  set, the directory will be searched for in 
@@ -98,6 +116,14 @@ class MIDASMetadataBagger(SIPBagger):
     :prop update_by_checksum_size_lim int (0):  a size limit in bytes for which 
                                  files less than this will be checked to see 
                                  if it has changed (not yet implemented).
+    :prop checksum_cache dict (None):  if set, remember the checksums of data 
+                                 files in a persistent cache so that they need
+                                 not be recalculated by subsequent baggings 
+                                 of unchanged files.  Sub-properties include
+                                 'dbfile', the path to cache's database file 
+                                 (relative to the working directory; default:
+                                 "checksum_cache.sqlite"), and 'max_entries'
+                                 (see ChecksumCache).  
     :prop component_merge_convention str ("dev"): the merge convention name to 
                                  use to merge MIDAS-provided component metadata
                                  with the PDR's initial component metadata.
@@ -185,9 +211,14 @@ class MIDASMetadataBagger(SIPBagger):
         # If None, we'll create a ID minter if we need one (in self._mint_id)
         self._minter = minter
 
-        self.bagbldr = BagBuilder(self.bagparent, self.name,
-                                  self.cfg.get('bag_builder', {}),
+        bldcfg = self.cfg.get('bag_builder', {})
+        if 'compact_json' not in bldcfg:
+            # this is a working bag; its metadata get pretty-printed only 
+            # when the bag is finalized for preservation
+            bldcfg = dict(bldcfg, compact_json=True)
+        self.bagbldr = BagBuilder(self.bagparent, self.name, bldcfg,
                                   logger=self.log)
+        self.bagbldr.checksum_cache = _open_checksum_cache(self.cfg, workdir)
         mergeetc = self.cfg.get('merge_etc', def_merge_etcdir)
         if not mergeetc:
             raise StateException("Unable to locate the merge configuration "+
@@ -196,7 +227,8 @@ class MIDASMetadataBagger(SIPBagger):
 
         self.hardlinkdata = self.cfg.get('hard_link_data', True)
         self.inpodfile = None
-        self.resmd = None
+        self._resmd = None
+        self._resmd_idx = None
 
         # this will contain a mapping of files that currently appear in the
         # MIDAS submission area; the keys are filepath values (in the NERDm
@@ -237,6 +269,48 @@ class MIDASMetadataBagger(SIPBagger):
         """
         return self.bagbldr.bagdir
 
+    @property
+    def resmd(self):
+        """
+        the NERDm resource record (with components) describing the bag's
+        contents so far, or None if it has not been loaded yet.
+        """
+        return self._resmd
+
+    @resmd.setter
+    def resmd(self, md):
+        self._resmd = md
+        self._resmd_idx = None
+
+    def _resmd_comp_index(self):
+        # return the positions of the components in self.resmd as a 
+        # dictionary keyed by @id; the index is built upon first need after 
+        # resmd is set.
+        if self._resmd_idx is None:
+            ids = {}
+            cmps = self._resmd.get('components', [])
+            for i in range(len(cmps)):
+                if '@id' in cmps[i]:
+                    ids.setdefault(cmps[i]['@id'], i)
+            self._resmd_idx = ids
+        return self._resmd_idx
+
+    def _update_resmd_comp(self, md):
+        # add the given component metadata to self.resmd, replacing the 
+        # component with the same @id, if present
+        ids = self._resmd_comp_index()
+        i = ids.get(md.get('@id'))
+
+        cmps = self._resmd.setdefault('components', [])
+        if i is None:
+            cmps.append(md)
+            i = len(cmps) - 1
+        else:
+            cmps[i] = md
+
+        if '@id' in md:
+            ids.setdefault(md['@id'], i)
+
     def find_pod_file(self):
         """
         find an existing pod file given a list of existing possible locations
@@ -461,19 +535,14 @@ class MIDASMetadataBagger(SIPBagger):
                         self._mark_filepath_unsynced(cmp['filepath'])
 
             # Now delete distributions that are no longer in the resource
-            def has_cmp_with_path(comps, path):
-                for c in comps:
-                    if c.get('filepath','') == path:
-                        return True
-                return False
+            podpaths = set([c.get('filepath','')
+                            for c in podnerd.get('components', [])])
                 
             resmd = self.bagbldr.bag.nerdm_record(False)
             for cmp in resmd.get('components', []):
                 if any([(':DataFile' in t or ':ChecksumFile' in t)
                         for t in cmp.get('@type',[])]) and \
-                   cmp.get('filepath') and \
-                   not has_cmp_with_path(podnerd.get('components', []),
-                                         cmp['filepath']):
+                   cmp.get('filepath') and cmp['filepath'] not in podpaths:
                     self.bagbldr.remove_component(cmp['filepath'], True)
 
             # enhance references (if desired)
@@ -629,17 +698,7 @@ class MIDASMetadataBagger(SIPBagger):
             # update self.resmd; this is cheaper than recreating it from scratch
             # with nerdm_record()
             if self.resmd:
-                cmps = self.resmd.get('components',[])
-                for i in range(len(cmps)):
-                    if md['@id'] == cmps[i]['@id']:
-                        cmps[i] = md
-                        break
-                if i >= len(cmps):
-                    if len(cmps) == 0:
-                        self.resmd['components'] = [md]
-                    else:
-                        self.resmd['components'].append(md)
-
+                self._update_resmd_comp(md)
 
 
     def _check_checksum_files(self):
@@ -736,6 +795,34 @@ class MIDASMetadataBagger(SIPBagger):
 
         def examine_next(self):
             filepath, location = self.files.popitem()
+            self._examine(filepath, location)
+
+        def examine_all(self):
+            """
+            examine all of the files that have been added, calculating their
+            checksums in parallel.
+            """
+            while self.files:
+                todo = OrderedDict()
+                while self.files:
+                    filepath, location = self.files.popitem(False)
+                    todo[location] = filepath
+
+                done = set()
+                try:
+                    for location, cs in \
+                            self.bagger.bagbldr._checksums_of(todo.keys()):
+                        self._examine(todo[location], location, cs)
+                        done.add(location)
+                except Exception as ex:
+                    log.warn("Trouble calculating checksums in parallel (%s); "
+                             "continuing serially", str(ex))
+
+                for location in todo:
+                    if location not in done:
+                        self._examine(todo[location], location)
+
+        def _examine(self, filepath, location, checksum=None):
             try:
                 md = self.bagger.bagbldr.bag.nerd_metadata_for(filepath)
 
@@ -745,7 +832,8 @@ class MIDASMetadataBagger(SIPBagger):
                     ct = re.sub(r'^[^:]*:', '', ct[0])
             
                 md = self.bagger.bagbldr.describe_data_file(location, filepath,
-                                                            True, ct)
+                                                            True, ct,
+                                                            checksum=checksum)
                 if '_status' in md:
                     del md['_status']
                 self.bagger.bagbldr.replace_metadata_for(filepath, md,
@@ -784,8 +872,7 @@ class MIDASMetadataBagger(SIPBagger):
                 self.exif = exmnr
             def run(self):
                 # time.sleep(0.1)
-                while self.exif.files:
-                    self.exif.examine_next()
+                self.exif.examine_all()
                 self.exif.finish()
         
 
@@ -836,6 +923,12 @@ class PreservationBagger(SIPBagger):
     :prop conponent_merge_convention str ("dev"): the merge convention name to 
                                  use to merge MIDAS-provided component metadata
                                  with the PDR's initial component metadata.
+    :prop checksum_cache dict (None):  if set, remember the checksums of data 
+                                 files in a persistent cache (see 
+                                 MIDASMetadataBagger); relative database file
+                                 paths are relative to the metadata bag 
+                                 directory (mddir) so that the cache is shared 
+                                 with the metadata bagger.
     :prop relative_to_indir bool (False):  If True, the output bag directory 
        is expected to be under one of the input directories; this base class
        will then ensure that it has write permission to create the output 
@@ -939,6 +1032,7 @@ class PreservationBagger(SIPBagger):
         self.bagbldr = BagBuilder(self.bagparent,
                                   self.form_bag_name(self.name), bldcfg,
                                   logger=self.siplog)
+        self.bagbldr.checksum_cache = _open_checksum_cache(self.cfg, self.mddir)
 
     @property
     def bagdir(self):
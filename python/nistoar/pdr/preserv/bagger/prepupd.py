@@ -3,7 +3,7 @@ This bagger submodule provides functions for preparing an update to a previously
 preserved collection.  This includes a service client for retrieving previous
 head bags from cache or long-term storage.  
 """
-import os, shutil, json, logging
+import os, shutil, json, logging, time, sqlite3, threading
 from abc import ABCMeta, abstractmethod, abstractproperty
 from collections import OrderedDict
 from zipfile import ZipFile
@@ -17,16 +17,42 @@ from ...describe import rmm
 from ... import distrib
 from ...exceptions import IDNotFound
 from ... import utils
+from ...sessions import get_session
 from ..bagit.builder import BagBuilder
 from ..bagit.bag import NISTBag
 
 deflog = logging.getLogger(_sys.system_abbrev).getChild(_sys.subsystem_abbrev)
 
+_HBC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headinfo (
+    aipid TEXT NOT NULL,
+    version TEXT NOT NULL,
+    info TEXT NOT NULL,
+    PRIMARY KEY (aipid, version)
+);
+CREATE TABLE IF NOT EXISTS bags (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bags_accessed ON bags (accessed);
+"""
+
 class HeadBagCacher(object):
     """
     a helper class that manages serialized head bags in a local cache.
+
+    The cache can be bounded in the total size and/or number of bags it 
+    holds; when a newly fetched bag causes a bound to be exceeded, the least 
+    recently used bags are evicted.  Information about the cached bags and 
+    the head bag descriptions retrieved from the distribution service are 
+    kept in a small SQLite database (in the info directory) which can be 
+    shared by multiple processes using the same cache.
     """
-    def __init__(self, distrib_service, cachedir, infodir=None):
+    INDEX_FILE = "_cache.sqlite"
+
+    def __init__(self, distrib_service, cachedir, infodir=None, max_size=None,
+                 max_count=None):
         """
         set up the cache
         :param RESTServiceClient distrib_service:  the distribution service 
@@ -36,12 +62,19 @@ class HeadBagCacher(object):
         :param str infodir:    the path to the directory where bag metadata 
                                will be stored.  If not provided, a subdirectory
                                of cachedir, "_info", will be used.
+        :param int max_size:   the maximum total size, in bytes, of the bags 
+                               to keep in the cache; if None, the size is not
+                               limited.
+        :param int max_count:  the maximum number of bags to keep in the cache;
+                               if None, the number is not limited.
         """
         self.distsvc = distrib_service
         self.cachedir = cachedir
         if not infodir:
             infodir = os.path.join(self.cachedir, "_info")
         self.infodir = infodir
+        self.max_size = max_size
+        self.max_count = max_count
 
         if not os.path.exists(self.cachedir):
             os.mkdir(self.cachedir)
@@ -53,7 +86,132 @@ class HeadBagCacher(object):
         if not os.path.isdir(self.infodir):
             raise StateException("HeadBagCacher: not a directory: "+
                                  self.cachedir)
-        
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(self.infodir, self.INDEX_FILE),
+                                   timeout=30, check_same_thread=False)
+        self._db.executescript(_HBC_SCHEMA)
+        self._db.commit()
+
+        self._stats = { "hits": 0, "misses": 0, "bytes_served": 0,
+                        "bytes_downloaded": 0, "evicted": 0,
+                        "bytes_evicted": 0 }
+
+        self._sync_index()
+        self.prune()
+
+    @property
+    def stats(self):
+        """
+        a dictionary of counts of cache activity since this instance was 
+        created:  hits and misses (i.e. requested bags found or not found in 
+        the cache), bytes_served (the total size of the bags found in the 
+        cache), bytes_downloaded, evicted (the number of bags removed to keep
+        within the cache's bounds), and bytes_evicted.
+        """
+        return dict(self._stats)
+
+    @property
+    def usage(self):
+        """
+        a dictionary describing the current contents of the cache: count (the
+        number of cached bags) and size (their total size in bytes).
+        """
+        with self._lock:
+            row = self._db.execute("SELECT COUNT(*), TOTAL(size) FROM bags") \
+                          .fetchone()
+        return { "count": row[0], "size": int(row[1]) }
+
+    def close(self):
+        """
+        close the connection to the cache's index database
+        """
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def _sync_index(self):
+        # make the index of cached bags reflect what is actually in the cache
+        # directory; bags not yet indexed are assumed to have been last used 
+        # when they were written.
+        present = {}
+        for f in os.listdir(self.cachedir):
+            if f.startswith('_') or f.startswith('.') or f.endswith('.part'):
+                continue
+            path = os.path.join(self.cachedir, f)
+            if os.path.isfile(path):
+                present[f] = os.stat(path)
+
+        with self._lock:
+            indexed = set(r[0] for r in 
+                          self._db.execute("SELECT name FROM bags"))
+            for name in indexed - set(present):
+                self._db.execute("DELETE FROM bags WHERE name=?", (name,))
+            for name in set(present) - indexed:
+                self._db.execute("INSERT OR IGNORE INTO bags VALUES (?, ?, ?)",
+                                 (name, present[name].st_size,
+                                  present[name].st_mtime))
+            self._db.commit()
+
+    def _touch(self, name, size=None):
+        # record that the named bag was just used
+        with self._lock:
+            if size is None:
+                self._db.execute("UPDATE bags SET accessed=? WHERE name=?",
+                                 (time.time(), name))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO bags VALUES (?, ?, ?)",
+                                 (name, size, time.time()))
+            self._db.commit()
+
+    def _over_bounds(self, count, size):
+        return (self.max_count is not None and count > self.max_count) or \
+               (self.max_size is not None and size > self.max_size)
+
+    def prune(self, keep=None):
+        """
+        evict the least recently used bags as necessary to keep the cache 
+        within its configured bounds.  
+
+        :param str keep:  the name of a bag that should not be evicted (e.g. 
+                          because it was just fetched for use)
+        :return int:  the number of bags evicted
+        """
+        if self.max_count is None and self.max_size is None:
+            return 0
+
+        evicted = 0
+        with self._lock:
+            usage = self.usage
+            count, size = usage['count'], usage['size']
+            if not self._over_bounds(count, size):
+                return 0
+
+            for name, bsize in self._db.execute("SELECT name, size FROM bags "
+                                                "ORDER BY accessed").fetchall():
+                if not self._over_bounds(count, size):
+                    break
+                if name == keep:
+                    continue
+
+                path = os.path.join(self.cachedir, name)
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError as ex:
+                    deflog.warn("Unable to evict %s from head bag cache: %s",
+                                name, str(ex))
+                    continue
+                self._db.execute("DELETE FROM bags WHERE name=?", (name,))
+                count -= 1
+                size -= bsize
+                evicted += 1
+                self._stats['evicted'] += 1
+                self._stats['bytes_evicted'] += bsize
+
+            self._db.commit()
+        return evicted
 
     def cache_headbag(self, aipid, version=None, confirm=True):
         """
@@ -84,22 +242,67 @@ class HeadBagCacher(object):
 
         # look for bag in cache; if not there, fetch a copy
         bagfile = os.path.join(self.cachedir, hinfo['name'])
-        if not os.path.exists(bagfile):
-            bagcli.save_bag(hinfo['name'], self.cachedir)
+        csum = None
+        if os.path.exists(bagfile):
+            self._stats['hits'] += 1
+            self._stats['bytes_served'] += os.stat(bagfile).st_size
+            self._touch(hinfo['name'])
+        else:
+            self._stats['misses'] += 1
+            csum = bagcli.save_bag(hinfo['name'], self.cachedir)
+            size = os.stat(bagfile).st_size
+            self._stats['bytes_downloaded'] += size
+            self._touch(hinfo['name'], size)
         if confirm:
-            self.confirm_bagfile(hinfo)
+            self.confirm_bagfile(hinfo, checksum=csum)
+        if csum is not None or not confirm:
+            self.prune(keep=hinfo['name'])
 
         return bagfile
 
-    def confirm_bagfile(self, baginfo, purge_on_error=True):
+    def prewarm(self, aipids, version=None):
+        """
+        ensure that the head bags for the given AIPs are in the cache (e.g. 
+        in anticipation of updates to them).  A failure to cache one of the 
+        bags is logged but does not prevent the others from being cached.
+
+        :param list aipids:  the identifiers of the AIPs whose head bags 
+                             should be cached
+        :param str version:  the version of the AIPs to cache the head bags 
+                             for; if None, the latest version is cached.
+        :return OrderedDict:  a mapping of each AIP identifier to the path to
+                             its cached head bag, or None if it could not be
+                             cached.
+        """
+        out = OrderedDict()
+        for aipid in aipids:
+            try:
+                out[aipid] = self.cache_headbag(aipid, version)
+            except Exception as ex:
+                deflog.warn("%s: Failed to pre-cache head bag: %s",
+                            aipid, str(ex))
+                out[aipid] = None
+        return out
+
+    def confirm_bagfile(self, baginfo, purge_on_error=True, checksum=None):
         """
         Make sure the cached bag described by bag metadata was transfered
         correctly by checking it checksum.  
+        :param dict baginfo:  the bag's description from the distribution 
+                              service
+        :param bool purge_on_error:  if True, remove the bag from the cache if
+                              its checksum is incorrect
+        :param str checksum:  the SHA-256 checksum of the cached bag file, if 
+                              already known (e.g. calculated as it was 
+                              downloaded); if not provided, it will be 
+                              calculated by reading the file.
         :raise CorruptedBagError: if an error was detected.
         """
         bagfile = os.path.join(self.cachedir, baginfo['name'])
         try:
-            if utils.checksum_of(bagfile) != baginfo['checksum']['hash']:
+            if not checksum:
+                checksum = utils.checksum_of(bagfile)
+            if checksum != baginfo['checksum']['hash']:
                 if purge_on_error:
                     # bag file looks corrupted; purge it from the cache
                     self._clear_from_cache(bagfile, baginfo)
@@ -115,32 +318,71 @@ class HeadBagCacher(object):
     def _clear_from_cache(self, bagfile, baginfo=None):
         if os.path.exists(bagfile):
             os.remove(bagfile)
-        if baginfo:
-            info = self._recall_head_info(baginfo['aipid'])
-            if baginfo['sinceVersion'] in info:
-                del info[baginfo['sinceVersion']]
-                self._save_head_info(baginfo['aipid'], info)
+        with self._lock:
+            self._db.execute("DELETE FROM bags WHERE name=?",
+                             (os.path.basename(bagfile),))
+            if baginfo:
+                self._db.execute("DELETE FROM headinfo WHERE aipid=? AND "
+                                 "version=?", (baginfo['aipid'],
+                                               baginfo['sinceVersion']))
+            self._db.commit()
 
     def _cache_head_info(self, aipid, version, info):
-        out = self._recall_head_info(aipid)
-        out[version] = info
-        self._save_head_info(aipid, out)
+        data = json.dumps(info)
+        with self._lock:
+            self._migrate_head_info(aipid)
+            if self._db.execute("UPDATE headinfo SET info=? WHERE aipid=? AND "
+                                "version=?", (data, aipid, version)).rowcount < 1:
+                self._db.execute("INSERT INTO headinfo VALUES (?, ?, ?)",
+                                 (aipid, version, data))
+            self._db.commit()
 
     def _save_head_info(self, aipid, info):
-        with open(self._head_info_file(aipid), 'w') as fd:
-            json.dump(info, fd, indent=2)
+        with self._lock:
+            self._db.execute("DELETE FROM headinfo WHERE aipid=?", (aipid,))
+            self._db.executemany("INSERT INTO headinfo VALUES (?, ?, ?)",
+                                 [(aipid, v, json.dumps(info[v])) for v in info])
+            self._db.commit()
 
     def _head_info_file(self, aipid):
+        # the location of the per-AIP file used by earlier versions of this 
+        # class to store head bag info
         return os.path.join(self.infodir, aipid)
 
-    def _recall_head_info(self, aipid):
+    def _migrate_head_info(self, aipid):
+        # load head bag info stored by an earlier version of this class into
+        # the index
         hif = self._head_info_file(aipid)
-        if not os.path.exists(hif):
-            return OrderedDict()
-        with open(hif) as fd:
-            return json.load(fd, object_pairs_hook=OrderedDict)
+        if os.path.isfile(hif):
+            with open(hif) as fd:
+                info = json.load(fd, object_pairs_hook=OrderedDict)
+            with self._lock:
+                if not self._db.execute("SELECT COUNT(*) FROM headinfo WHERE "
+                                        "aipid=?", (aipid,)).fetchone()[0]:
+                    self._save_head_info(aipid, info)
+            os.remove(hif)
+
+    def _recall_head_info(self, aipid):
+        out = OrderedDict()
+        with self._lock:
+            self._migrate_head_info(aipid)
+            for version, info in \
+                  self._db.execute("SELECT version, info FROM headinfo WHERE "
+                                   "aipid=? ORDER BY rowid", (aipid,)):
+                out[version] = json.loads(info, object_pairs_hook=OrderedDict)
+        return out
             
 
+def _ignore_payload(bagdir):
+    # return a shutil.copytree() ignore function that skips a bag's data 
+    # directory
+    bagdir = os.path.abspath(bagdir)
+    def ignore(dir, names):
+        if os.path.abspath(dir) == bagdir:
+            return [n for n in names if n == "data"]
+        return []
+    return ignore
+
 class UpdatePrepService(object):
     """
     a factory class that creates UpdatePrepper instances
@@ -153,11 +395,15 @@ class UpdatePrepService(object):
             raise ConfigurationException("UpdatePrepService: Missing property: "+
                                          "headbag_cache")
         self.storedir = self.cfg.get('store_dir')
+        session = get_session(self.cfg.get('http_session'))
         scfg = self.cfg.get('distrib_service', {})
-        self.distsvc = distrib.RESTServiceClient(scfg.get('service_endpoint'))
+        self.distsvc = distrib.RESTServiceClient(scfg.get('service_endpoint'),
+                                                 session)
         scfg = self.cfg.get('metadata_service', {})
-        self.mdsvc  = rmm.MetadataClient(scfg.get('service_endpoint'))
-        self.cacher = HeadBagCacher(self.distsvc, self.sercache)
+        self.mdsvc  = rmm.MetadataClient(scfg.get('service_endpoint'), session)
+        self.cacher = HeadBagCacher(self.distsvc, self.sercache,
+                                    max_size=self.cfg.get('headbag_cache_max_size'),
+                                    max_count=self.cfg.get('headbag_cache_max_count'))
 
     def prepper_for(self, aipid, version=None, log=None):
         """
@@ -252,11 +498,11 @@ class UpdatePrepper(object):
         """
         return self.cache_nerdm_rec() is not None
         
-    def _unpack_bag_as(self, bagfile, destbag):
+    def _unpack_bag_as(self, bagfile, destbag, metadata_only=False):
         destdir = os.path.dirname(destbag)
 
         if bagfile.endswith('.zip'):
-            root = self._unpack_zip_into(bagfile, destdir)
+            root = self._unpack_zip_into(bagfile, destdir, metadata_only)
         else:
             raise StateException("Don't know how to unpack serialized bag: "+
                                  os.path.basename(bagfile))
@@ -267,7 +513,20 @@ class UpdatePrepper(object):
                                    "not created: "+tmpname)
         os.rename(tmpname, destbag)
         
-    def _unpack_zip_into(self, bagfile, destdir):
+    def _unpack_zip_into(self, bagfile, destdir, metadata_only=False):
+        """
+        unpack a zipped bag into a directory, restoring the original 
+        modification times of its contents.
+
+        :param str bagfile:  the path to the zip file containing the bag
+        :param str destdir:  the directory to unpack the bag into
+        :param bool metadata_only:  if True, do not extract the payload (i.e. 
+                             anything under the bag's data directory), only 
+                             the tag files and directories (like metadata and 
+                             multibag).  Only the entries extracted are read
+                             from the zip file.
+        :return str:  the name of the bag's root directory
+        """
         if not os.path.exists(destdir):
             raise StateException("Bag destination directory not found: "+destdir)
                                  
@@ -288,7 +547,10 @@ class UpdatePrepper(object):
             if not root:
                 raise StateException("Bag appears to be empty: "+bagfile)
 
+            payload = root + "/data/"
             for entry in zip.infolist():
+                if metadata_only and entry.filename.startswith(payload):
+                    continue
                 zip.extract(entry, destdir)
                 extracted = os.path.join(destdir, entry.filename)
                 date_time = mktime(entry.date_time + (0, 0, -1))
@@ -365,16 +627,18 @@ class UpdatePrepper(object):
             raise StateException("metadata bag working space does not exist: "+
                                  parent)
 
+        # the payload is not needed (and will be removed below), so only the
+        # metadata and other tag files are copied over.
         if os.path.isdir(headbag):
             # unserialized bag
-            shutil.copytree(headbag, mdbag)
+            shutil.copytree(headbag, mdbag, ignore=_ignore_payload(headbag))
             
         elif not os.path.isfile(headbag):
             raise ValueError("UpdatePrepper: head bag does not exist: "+headbag)
 
         else:
             # serialized bag file
-            self._unpack_bag_as(headbag, mdbag)
+            self._unpack_bag_as(headbag, mdbag, metadata_only=True)
 
         # save the the bag-info.txt as deprecated-info.txt for later use
         mbdir = os.path.join(mdbag, "multibag")
@@ -3,6 +3,6 @@ Support for the NIST Bagit Profile
 """
 from .. import (PDRException, SIPDirectoryError, SIPDirectoryNotFound, 
                 ConfigurationException, StateException, PODError, NERDError)
-from bag import NISTBag
+from bag import NISTBag, ZippedNISTBag
 from builder import BagBuilder
 
@@ -2,8 +2,9 @@
 Tools for reading data from a bag
 """
 
-import os, logging, re, json, hashlib
+import os, logging, re, json, hashlib, time, errno, posixpath
 from collections import OrderedDict
+from zipfile import ZipFile, BadZipfile
 
 from .. import PreservationSystem, read_nerd, read_pod
 from .. import NERDError, PODError, StateException
@@ -20,6 +21,23 @@ DEFAULT_MERGE_CONVENTION = "midas0"
 JQLIB = def_jq_libdir
 MERGECONF = def_merge_etcdir
 
+# files modified more recently than this many seconds ago are not cached, as 
+# a further change within the filesystem's timestamp resolution could go 
+# undetected.
+MTIME_RESOLUTION = 2.0
+
+# the default limit on the total size (in characters of serialized JSON) of 
+# the metadata a NISTBag will cache
+DEF_MDCACHE_SIZE = 16 * 1024 * 1024
+
+def _ordered(pairs):
+    # a faster equivalent of OrderedDict(pairs) for use as a JSON 
+    # object_pairs_hook
+    out = OrderedDict()
+    for k, v in pairs:
+        out[k] = v
+    return out
+
 class NISTBag(PreservationSystem):
     """
     an interface for reading data in a NIST-compliant BagIt bag.
@@ -28,8 +46,27 @@ class NISTBag(PreservationSystem):
     # NOTE: this is an incomplete implementation
     # (what's missing?)
 
-    def __init__(self, rootdir, merge_annots=False, merge_conf_dir=None):
-        if not os.path.isdir(rootdir):
+    def __init__(self, rootdir, merge_annots=False, merge_conf_dir=None,
+                 cache_metadata=True):
+        """
+        create the bag view
+
+        :param rootdir str:         the path to the bag's root directory
+        :param merge_annots bool:   if True, merge annotation data into the 
+                                    NERDm metadata by default when it is read.
+        :param merge_conf_dir str:  the directory containing the schemas 
+                                    annotated with merging directives
+        :param cache_metadata bool or int:  if True (default), cache the 
+                                    metadata read from the bag's metadata 
+                                    files, re-reading a file only after it has
+                                    changed (as judged by its size and 
+                                    modification time).  An integer value 
+                                    turns on caching and sets the limit on 
+                                    the total size of the cache (in characters
+                                    of serialized JSON; default: 
+                                    DEF_MDCACHE_SIZE).
+        """
+        if not self._isdir(rootdir):
             raise StateException("Bag directory does not exist as a directory: "+
                                  rootdir, sys=self)
         self._dir = rootdir
@@ -50,6 +87,40 @@ class NISTBag(PreservationSystem):
             self._mergeconf = MERGECONF
         self._mergerfact = None
 
+        # maps a key describing a metadata request to a pair: the stat stamps 
+        # of the files the cached data were derived from, and the data 
+        # serialized as JSON; entries are kept in least-recently-used order.
+        self._mdcache = None
+        self._mdcache_size = 0
+        self._mdcache_limit = 0
+        if cache_metadata:
+            self._mdcache = OrderedDict()
+            self._mdcache_limit = DEF_MDCACHE_SIZE
+            if cache_metadata is not True:
+                self._mdcache_limit = int(cache_metadata)
+
+    # The following methods provide the access to the bag's contents used by
+    # this class; subclasses can override them to read bags stored in other 
+    # forms (see ZippedNISTBag).
+
+    def _exists(self, path):
+        return os.path.exists(path)
+
+    def _isfile(self, path):
+        return os.path.isfile(path)
+
+    def _isdir(self, path):
+        return os.path.isdir(path)
+
+    def _listdir(self, path):
+        return os.listdir(path)
+
+    def _walk(self, path):
+        return os.walk(path)
+
+    def _open(self, path):
+        return open(path)
+
     @property
     def dir(self):
         """
@@ -154,27 +225,33 @@ class NISTBag(PreservationSystem):
                                    annotations.
         """
         nerdfile = self.nerd_file_for(filepath)
-        if not os.path.exists(nerdfile):
+        if not self._exists(nerdfile):
           raise ComponentNotFound("Component not found: " + filepath, 
                                   os.path.basename(self._name))
-        out = self.read_nerd(nerdfile)
 
         if merge_annots is None:
             merge_annots = self._mergeannots
-            
+        if merge_annots is True:
+            merge_annots = DEFAULT_MERGE_CONVENTION
         annotfile = os.path.join(os.path.dirname(nerdfile), ANNOTS_FILENAME)
-        if merge_annots and os.path.exists(annotfile):
-            if merge_annots is True:
-                merge_annots = DEFAULT_MERGE_CONVENTION
 
-            merge_type = "Component"
-            if filepath == "":
-                merge_type = "Resource"
+        if isinstance(merge_annots, Merger):
+            # can't tell if results from this merger can be reused
+            return self._load_nerd(nerdfile, annotfile, filepath, merge_annots)
+        return self._cached((nerdfile, merge_annots), [nerdfile, annotfile],
+                            lambda: self._load_nerd(nerdfile, annotfile,
+                                                    filepath, merge_annots))
 
-            compmerger = self._make_merger(merge_annots, merge_type)
+    def _load_nerd(self, nerdfile, annotfile, filepath, merge_annots):
+        # read (and merge) the metadata for nerd_metadata_for()
+        out = self.read_nerd(nerdfile)
+        if merge_annots and self._exists(annotfile):
             if isinstance(merge_annots, Merger):
                 compmerger = merge_annots
             else:
+                merge_type = "Component"
+                if filepath == "":
+                    merge_type = "Resource"
                 compmerger = self._make_merger(merge_annots, merge_type)
 
             annots = self.read_nerd(annotfile)
@@ -182,6 +259,61 @@ class NISTBag(PreservationSystem):
 
         return out
 
+    def _stamp_of(self, filepath):
+        # return the stat data used to detect a change in a file, or None if
+        # the file does not exist
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _cached(self, key, files, build):
+        # return the data built by build() from the given files, calling 
+        # build() only if any of those files have changed since the last time
+        # data was cached under key.  The data is cached in serialized form, 
+        # so that each caller gets its own copy to do with as it pleases;
+        # parsing the JSON is cheaper than both copying the data and reading
+        # (and locking) the files.
+        if self._mdcache is None:
+            return build()
+
+        # stat before building:  if a file changes while it is being read, 
+        # the stamp will not match next time.
+        stamps = tuple([self._stamp_of(f) for f in files])
+        cached = self._mdcache.pop(key, None)
+        if cached:
+            self._mdcache_size -= len(cached[1])
+            if cached[0] == stamps:
+                self._cache_put(key, cached)
+                return json.loads(cached[1], object_pairs_hook=_ordered)
+
+        out = build()
+        settled = time.time() - MTIME_RESOLUTION
+        if all([s is None or s[2] < settled for s in stamps]):
+            self._cache_put(key, (stamps, json.dumps(out)))
+        return out
+
+    def _cache_put(self, key, entry):
+        size = len(entry[1])
+        if size > self._mdcache_limit:
+            return
+        self._mdcache[key] = entry
+        self._mdcache_size += size
+        while self._mdcache_size > self._mdcache_limit:
+            # evict the least recently used
+            self._mdcache_size -= len(self._mdcache.popitem(last=False)[1][1])
+
+    def clear_cache(self):
+        """
+        discard all metadata cached from previous reads of the bag's metadata 
+        files.  This is normally not necessary, as changed files are detected
+        automatically.
+        """
+        if self._mdcache is not None:
+            self._mdcache = OrderedDict()
+            self._mdcache_size = 0
+
     def _make_merger(self, stratconvname, typename):
         if not self._mergerfact:
             self._mergerfact = MergerFactory(MERGECONF)
@@ -193,10 +325,10 @@ class NISTBag(PreservationSystem):
         a component.
         """
         annotfile = self.annotations_file_for(filepath)
-        if not os.path.exists(os.path.dirname(annotfile)):
+        if not self._exists(os.path.dirname(annotfile)):
             raise ComponentNotFound("Component not found: " + filepath, 
                                     os.path.basename(self._name))
-        if not os.path.exists(annotfile):
+        if not self._exists(annotfile):
             return OrderedDict()
         return self.read_nerd(annotfile)
 
@@ -228,36 +360,22 @@ class NISTBag(PreservationSystem):
             compmerger = self._make_merger(merge_annots, 'Component')
 
         out = None
-        if not os.path.isdir(self._metadir):
+        if not self._isdir(self._metadir):
             raise BadBagRequest(self.name +
                                 ": Bag does not contain NERDm metadata")
-        for root, subdirs, files in os.walk(self._metadir):
+        for root, subdirs, files in self._walk(self._metadir):
+            nerdfile = os.path.join(root, NERDMD_FILENAME)
+            annotfile = os.path.join(root, ANNOTS_FILENAME)
             if root == self._metadir:
-                out = self.nerd_metadata_for("")
-                if 'components' not in out:
-                    out['components'] = []
-
-                if merge_annots:
-                    annotfile = os.path.join(root,ANNOTS_FILENAME)
-                    if os.path.exists(annotfile):
-                        annots = self.read_nerd(annotfile)
-                        merger = self._make_merger(merge_annots, 'Resource')
-                        out = merger.merge(out, annots)
+                out = self._cached((root, merge_annots, self._mergeannots,
+                                    'Resource'),
+                                   [nerdfile, annotfile],
+                                   lambda: self._load_res_md(merge_annots))
 
             elif NERDMD_FILENAME in files:
-                comp = self.read_nerd(os.path.join(root, NERDMD_FILENAME))
-
-                # remove properties that support standalone use/validation
-                for key in "_schema $schema @context".split():
-                    if key in comp:
-                        del comp[key]
-
-                if merge_annots:
-                    annotfile = os.path.join(root,ANNOTS_FILENAME)
-                    if os.path.exists(annotfile):
-                        annots = self.read_nerd(annotfile)
-                        comp = compmerger.merge(comp, annots)
-
+                comp = self._cached((root, merge_annots, 'Component'),
+                                    [nerdfile, annotfile],
+                                    lambda: self._load_comp_md(root, compmerger))
                 out['components'].append(comp)
 
         if incl_inventory and 'inventory' not in out:
@@ -267,6 +385,47 @@ class NISTBag(PreservationSystem):
         
         return out
 
+    def _load_res_md(self, merge_annots):
+        # read the resource-level metadata for nerdm_record()
+        nerdfile = self.nerd_file_for("")
+        if not self._exists(nerdfile):
+            raise ComponentNotFound("Component not found: ",
+                                    os.path.basename(self._name))
+        defmerge = self._mergeannots
+        if defmerge is True:
+            defmerge = DEFAULT_MERGE_CONVENTION
+        out = self._load_nerd(nerdfile, self.annotations_file_for(""), "",
+                              defmerge)
+        if 'components' not in out:
+            out['components'] = []
+
+        if merge_annots:
+            annotfile = os.path.join(self._metadir, ANNOTS_FILENAME)
+            if self._exists(annotfile):
+                annots = self.read_nerd(annotfile)
+                merger = self._make_merger(merge_annots, 'Resource')
+                out = merger.merge(out, annots)
+
+        return out
+
+    def _load_comp_md(self, mddir, compmerger=None):
+        # read the metadata for the component described in the given metadata
+        # directory for nerdm_record()
+        comp = self.read_nerd(os.path.join(mddir, NERDMD_FILENAME))
+
+        # remove properties that support standalone use/validation
+        for key in "_schema $schema @context".split():
+            if key in comp:
+                del comp[key]
+
+        if compmerger:
+            annotfile = os.path.join(mddir, ANNOTS_FILENAME)
+            if self._exists(annotfile):
+                annots = self.read_nerd(annotfile)
+                comp = compmerger.merge(comp, annots)
+
+        return comp
+
     @classmethod
     def update_inventory_in(cls, resmd):
         """
@@ -313,11 +472,11 @@ class NISTBag(PreservationSystem):
             return True
 
         path = self._full_dpath(comppath)
-        if os.path.exists(path):
+        if self._exists(path):
             return True
 
         path = os.path.join(self.metadata_dir, comppath)
-        if os.path.isdir(path):
+        if self._isdir(path):
             return True
 
         return False
@@ -331,11 +490,11 @@ class NISTBag(PreservationSystem):
             return False
 
         path = self._full_dpath(comppath)
-        if os.path.isfile(path):
+        if self._isfile(path):
             return True
 
         path = self.nerd_file_for(comppath)
-        if os.path.exists(path):
+        if self._exists(path):
             mdata = self.read_nerd(path)
             return any([t for t in mdata['@type'] if ':DataFile' in t])
 
@@ -353,11 +512,11 @@ class NISTBag(PreservationSystem):
             return False
 
         path = self._full_dpath(comppath)
-        if os.path.isdir(path):
+        if self._isdir(path):
             return True
 
         path = self.nerd_file_for(comppath)
-        if os.path.exists(path):
+        if self._exists(path):
             mdata = self.read_nerd(path)
             return any([t for t in mdata['@type'] if ':Subcollection' in t])
 
@@ -375,17 +534,17 @@ class NISTBag(PreservationSystem):
 
         children = set()
         cdir = self._full_dpath(comppath)
-        if os.path.exists(cdir):
-            for c in os.listdir(cdir):
+        if self._exists(cdir):
+            for c in self._listdir(cdir):
                 if not c.startswith('.') and not c.startswith('_'):
                     children.add( c )
 
         cdir = os.path.join(self.metadata_dir, comppath)
-        if os.path.exists(cdir):
+        if self._exists(cdir):
             # add in child metadata directories that have a nerdm.json file
-            for c in os.listdir(cdir):
+            for c in self._listdir(cdir):
                 if not c.startswith('.') and not c.startswith('_') \
-                   and os.path.exists(os.path.join(cdir,c,NERDMD_FILENAME)):
+                   and self._exists(os.path.join(cdir,c,NERDMD_FILENAME)):
                     children.add( c )
 
         return list(children)
@@ -402,7 +561,7 @@ class NISTBag(PreservationSystem):
 
         :return generator:  
         """
-        for dir, subdirs, files in os.walk(self.data_dir):
+        for dir, subdirs, files in self._walk(self.data_dir):
             reldir = dir[len(self.data_dir)+1:]
             for f in files:
                 # if f.startswith('.'):
@@ -416,7 +575,7 @@ class NISTBag(PreservationSystem):
 
         :return generator:  
         """
-        for dir, subdirs, files in os.walk(self.metadata_dir):
+        for dir, subdirs, files in self._walk(self.metadata_dir):
             reldir = dir[len(self.metadata_dir)+1:]
             for f in subdirs:
                 # if f.startswith('.'):
@@ -433,8 +592,8 @@ class NISTBag(PreservationSystem):
         bag's base directory.  
         """
         fetchfile = os.path.join(self.dir, "fetch.txt")
-        if os.path.exists(fetchfile):
-            with open(fetchfile) as fd:
+        if self._exists(fetchfile):
+            with self._open(fetchfile) as fd:
                 for line in fd:
                     out = line.strip().split()
                     if len(out) != 3 or len([i for i in out if len(i) > 0]) != 3:
@@ -449,7 +608,7 @@ class NISTBag(PreservationSystem):
         :param filepath str:  the full path to tag file (not relative to the 
                               bag's base directory).
         """
-        with open(filepath) as fd:
+        with self._open(filepath) as fd:
             for line in fd:
                 yield line.rstrip()
 
@@ -467,7 +626,7 @@ class NISTBag(PreservationSystem):
         infofile = altfile
         if not infofile:
             infofile = os.path.join(self.dir, "bag-info.txt")
-        if not os.path.exists(infofile):
+        if not self._exists(infofile):
             return out
 
         leadspc = re.compile("^\s+")
@@ -497,3 +656,180 @@ class NISTBag(PreservationSystem):
                     
         return out
     
+
+class ZippedNISTBag(NISTBag):
+    """
+    a read-only view of a NIST-compliant bag serialized as a zip file that
+    reads the bag's contents directly out of the zip file without unpacking 
+    it.  
+
+    The zip file's central directory is read once when the view is created 
+    and kept as an in-memory index of the bag's contents; each read of a file 
+    then seeks directly to that file's entry in the zip file.  This makes it 
+    cheap to inspect the metadata of an archived bag, regardless of the size 
+    of its payload.
+
+    Paths to files in the bag (e.g. as returned by nerd_file_for(), or as 
+    passed to get_baginfo()) are paths within the zip file, starting with the 
+    name of the bag (i.e. the value of the dir property).  The view should be 
+    closed (via close()) when no longer needed; it can also be used as a 
+    context manager.
+    """
+
+    def __init__(self, zipfile, merge_annots=False, merge_conf_dir=None,
+                 cache_metadata=True):
+        """
+        create the bag view
+
+        :param zipfile str:         the path to the serialized bag
+        :param merge_annots bool:   if True, merge annotation data into the 
+                                    NERDm metadata by default when it is read.
+        :param merge_conf_dir str:  the directory containing the schemas 
+                                    annotated with merging directives
+        :param cache_metadata bool: if True (default), cache the metadata read
+                                    from the bag's metadata files.
+        """
+        self._zipfile = zipfile
+        try:
+            self._zip = ZipFile(zipfile)
+        except (IOError, BadZipfile) as ex:
+            raise StateException("Unable to open serialized bag: " + zipfile +
+                                 ": " + str(ex), cause=ex, sys=self)
+
+        try:
+            root = self._index_zip()
+            super(ZippedNISTBag, self).__init__(root, merge_annots,
+                                                merge_conf_dir, cache_metadata)
+        except:
+            self._zip.close()
+            raise
+
+    def _index_zip(self):
+        # build the index of the bag's contents from the zip file's central 
+        # directory.  _files maps file paths to their ZipInfo entries; _dirs 
+        # maps directory paths to the names of their contents (in order of 
+        # appearance).  
+        self._files = {}
+        self._dirs = OrderedDict()
+
+        root = None
+        for info in self._zip.infolist():
+            name = info.filename.rstrip('/')
+            if not name:
+                continue
+            if root is None:
+                root = name.split('/')[0]
+            if name != root and not name.startswith(root+'/'):
+                raise BagFormatError("Serialized bag has multiple root "
+                                     "directories: " + self._zipfile)
+
+            if info.filename.endswith('/'):
+                self._dirs.setdefault(name, OrderedDict())
+            else:
+                self._files[name] = info
+
+            # register the entry with its (possibly implied) ancestors
+            while '/' in name:
+                parent, child = name.rsplit('/', 1)
+                children = self._dirs.setdefault(parent, OrderedDict())
+                if child in children:
+                    break
+                children[child] = True
+                name = parent
+
+        if root is None or root not in self._dirs:
+            raise BagFormatError("Serialized bag appears to be empty: " +
+                                 self._zipfile)
+        return root
+
+    @property
+    def zipfile(self):
+        """
+        the path to the zip file containing the bag
+        """
+        return self._zipfile
+
+    def close(self):
+        """
+        close the underlying zip file
+        """
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _norm(self, path):
+        return posixpath.normpath(path)
+
+    def _exists(self, path):
+        path = self._norm(path)
+        return path in self._files or path in self._dirs
+
+    def _isfile(self, path):
+        return self._norm(path) in self._files
+
+    def _isdir(self, path):
+        return self._norm(path) in self._dirs
+
+    def _listdir(self, path):
+        path = self._norm(path)
+        if path not in self._dirs:
+            raise OSError(errno.ENOENT, "No such directory in bag", path)
+        return list(self._dirs[path].keys())
+
+    def _walk(self, path):
+        path = self._norm(path)
+        if path not in self._dirs:
+            return
+        subdirs = []
+        files = []
+        for name in self._dirs[path]:
+            if '/'.join([path, name]) in self._dirs:
+                subdirs.append(name)
+            else:
+                files.append(name)
+        yield path, subdirs, files
+        for name in subdirs:
+            for out in self._walk('/'.join([path, name])):
+                yield out
+
+    def _open(self, path):
+        info = self._files.get(self._norm(path))
+        if not info:
+            raise IOError(errno.ENOENT, "No such file in bag", path)
+        return self._zip.open(info)
+
+    def _stamp_of(self, filepath):
+        # the contents of the zip file do not change
+        info = self._files.get(self._norm(filepath))
+        if not info:
+            return None
+        return (info.CRC, info.file_size, 0)
+
+    def _read_json(self, jsonfile):
+        with self._open(jsonfile) as fd:
+            return json.load(fd, object_pairs_hook=OrderedDict)
+
+    def read_nerd(self, nerdfile):
+        try:
+            return self._read_json(nerdfile)
+        except ValueError as ex:
+            raise NERDError("Unable to parse NERD file, " + nerdfile + ": " +
+                            str(ex), cause=ex, src=nerdfile)
+        except IOError as ex:
+            raise NERDError("Unable to read NERD file, " + nerdfile + ": " +
+                            str(ex), cause=ex, src=nerdfile)
+
+    def read_pod(self, podfile):
+        try:
+            return self._read_json(podfile)
+        except ValueError as ex:
+            raise PODError("Unable to parse POD file, " + podfile + ": " +
+                           str(ex), cause=ex, src=podfile)
+        except IOError as ex:
+            raise PODError("Unable to read POD file, " + podfile + ": " +
+                           str(ex), cause=ex, src=podfile)
+
@@ -3,10 +3,12 @@ Tools for building a NIST Preservation bags
 """
 from __future__ import print_function, absolute_import
 from __future__ import print_function, absolute_import
-import os, errno, logging, re, pkg_resources, textwrap, datetime
+import os, errno, logging, re, pkg_resources, textwrap, datetime, json
 import pynoid as noid
 from shutil import copy as filecopy, rmtree
 from copy import deepcopy
+from contextlib import contextmanager
+from StringIO import StringIO
 from collections import Mapping, Sequence, OrderedDict
 from urllib import quote as urlencode
 
@@ -18,7 +20,8 @@ from ....nerdm.exceptions import (NERDError, NERDTypeError)
 from ....nerdm.convert import PODds2Res
 from ....id import PDRMinter, NIST_ARK_NAAN
 from ...utils import (build_mime_type_map, checksum_of, measure_dir_size,
-                      read_nerd, read_pod, write_json)
+                      read_nerd, read_pod, write_json, copy_with_checksum,
+                      checksums_of)
 
 from ....id import PDRMinter
 from ... import def_jq_libdir, def_etc_dir
@@ -66,6 +69,352 @@ DEF_MERGE_CONV = "midas0"
 
 ARK_NAAN = NIST_ARK_NAAN
 
+class _BatchBagView(NISTBag):
+    """
+    a view of a bag being built that overlays the metadata files written 
+    during a batch session (see BagBuilder.batch()) onto the files on disk.  
+    The pending files are held in memory until they are committed with 
+    commit().  Files and directories removed during the session are moved
+    aside (into the bag's TRASH_DIR) until the session is committed or 
+    aborted.
+    """
+
+    # the name of the bag directory holding removed files until commit, 
+    # along with the session's journal
+    TRASH_DIR = ".batch-removed"
+
+    # the name of the journal file (within TRASH_DIR) that records the 
+    # session's changes to the bag's files, so that an interrupted session
+    # can be cleaned up (see clean_leftovers())
+    JOURNAL = "journal"
+
+    # the suffix given to the temporary files written by commit()
+    TMP_SUFFIX = ".batch"
+
+    def __init__(self, rootdir):
+        # maps a (normalized) file path to a pair:  a sequence number that 
+        # changes each time the file is staged, and the JSON data
+        self._pending = OrderedDict()
+        self._seq = 0
+
+        # maps a file path to a pair:  the sequence number of the staged 
+        # contents that a memo was derived from, and the memo
+        self._memos = {}
+
+        # the metadata directories created during the session, in order of 
+        # creation
+        self.created = []
+
+        # pairs of (original path, trash path) for the files and directories
+        # removed during the session, in order of removal
+        self.removed = []
+        super(_BatchBagView, self).__init__(rootdir)
+
+    @classmethod
+    def clean_leftovers(cls, bagdir):
+        """
+        clean up after a session on the given bag that was interrupted (e.g.
+        by a crash).  If the session was in the midst of being committed, 
+        the commit is completed; otherwise, the session's changes are rolled
+        back:  files it removed are restored and directories it created are 
+        removed.  Any temporary files left behind are deleted.  
+
+        :return bool:  True if any removed files were restored
+        """
+        restored = False
+        trash = os.path.join(bagdir, cls.TRASH_DIR)
+        jfile = os.path.join(trash, cls.JOURNAL)
+        created, removed, renames = [], [], None
+        if os.path.exists(jfile):
+            created, removed, renames = cls._read_journal(bagdir, jfile)
+            if renames is not None:
+                cls._rename_all(renames)
+
+        mdir = os.path.join(bagdir, "metadata")
+        for root, subdirs, files in os.walk(mdir):
+            for f in files:
+                if f.startswith('.') and f.endswith(cls.TMP_SUFFIX):
+                    os.remove(os.path.join(root, f))
+
+        if renames is None:
+            restored = cls._rollback(created, removed)
+        if os.path.exists(trash):
+            rmtree(trash)
+        return restored
+
+    @classmethod
+    def _read_journal(cls, bagdir, jfile):
+        # return the directories created, the files removed, and (if the 
+        # session was being committed) the renames to be done, as recorded 
+        # in the given journal
+        created = []
+        removed = []
+        renames = None
+        with open(jfile) as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # an incomplete last line; the action was not taken
+                    break
+                paths = [os.path.join(bagdir, p) for p in entry[1:]]
+                if entry[0] == "created":
+                    created.append(paths[0])
+                elif entry[0] == "removed":
+                    removed.append(tuple(paths))
+                elif entry[0] == "commit":
+                    renames = []
+                elif entry[0] == "rename" and renames is not None:
+                    renames.append(tuple(paths))
+        return created, removed, renames
+
+    def _journal(self, action, *paths):
+        # append an entry to the session's journal
+        trash = os.path.join(self.dir, self.TRASH_DIR)
+        if not os.path.exists(trash):
+            os.mkdir(trash)
+        entry = [action] + [os.path.relpath(p, self.dir) for p in paths]
+        with open(os.path.join(trash, self.JOURNAL), 'a') as fd:
+            fd.write(json.dumps(entry) + "\n")
+
+    def add_created(self, dirs):
+        """
+        note the given metadata directories as having been created during 
+        the session (so that they are removed if the session is aborted).
+        """
+        for d in dirs:
+            self._journal("created", d)
+        self.created.extend(dirs)
+
+    def stage(self, jsdata, destfile, copy=True):
+        """
+        remember the given JSON data as the new contents of the given file,
+        replacing anything staged previously for that file.  
+
+        :param bool copy:  if False, the given data object itself (rather than
+                           a copy) is held as the pending contents; the caller
+                           must then not change it except via another call to
+                           stage().
+        """
+        if copy:
+            jsdata = deepcopy(jsdata)
+        self._seq += 1
+        self._pending[os.path.normpath(destfile)] = (self._seq, jsdata)
+
+    def is_pending(self, path):
+        return os.path.normpath(path) in self._pending
+
+    def _seq_of(self, path):
+        pending = self._pending.get(path)
+        return pending and pending[0]
+
+    def get_memo(self, path):
+        """
+        return the data last saved with set_memo() for the given file, or 
+        None if nothing was saved or the file has since been re-staged.
+        """
+        path = os.path.normpath(path)
+        memo = self._memos.get(path)
+        if memo and memo[0] == self._seq_of(path):
+            return memo[1]
+        return None
+
+    def set_memo(self, path, memo):
+        """
+        save data derived from the current contents of the given file, to be
+        retrieved via get_memo() for as long as those contents are current.
+        """
+        path = os.path.normpath(path)
+        self._memos[path] = (self._seq_of(path), memo)
+
+    def discard_under(self, path):
+        """
+        forget any pending files at or below the given path
+        """
+        path = os.path.normpath(path)
+        for f in list(self._pending.keys()):
+            if f == path or f.startswith(path+os.sep):
+                del self._pending[f]
+                self._memos.pop(f, None)
+
+    def remove(self, path):
+        """
+        remove the given file or directory (along with any pending files 
+        below it) from the bag.  It is moved out of the way so that it can be
+        restored if the session is aborted; it is deleted for good when the 
+        session is committed.  
+        """
+        path = os.path.normpath(path)
+        self.discard_under(path)
+        if not os.path.exists(path):
+            return
+        dest = os.path.join(self.dir, self.TRASH_DIR, str(len(self.removed)))
+        self._journal("removed", path, dest)
+        os.rename(path, dest)
+        self.removed.append((path, dest))
+
+    def commit(self, indent=4):
+        """
+        write all pending files into the bag.  Each file's data is first 
+        written to a temporary file alongside its destination; only after all
+        have been successfully written are they renamed into place.  Files 
+        removed during the session are then deleted.  The renames are 
+        recorded in the session's journal beforehand so that, if interrupted,
+        they can be completed by clean_leftovers().  
+        """
+        tmpfiles = []
+        try:
+            for destfile, (seq, jsdata) in self._pending.items():
+                tmpf = os.path.join(os.path.dirname(destfile), "." +
+                                    os.path.basename(destfile)+self.TMP_SUFFIX)
+                tmpfiles.append((tmpf, destfile))
+                write_json(jsdata, tmpf, indent, nolock=True)
+        except Exception:
+            for tmpf, destfile in tmpfiles:
+                if os.path.exists(tmpf):
+                    os.remove(tmpf)
+            raise
+
+        if tmpfiles or self.removed:
+            self._journal_commit(tmpfiles)
+        self._rename_all(tmpfiles)
+        self._pending = OrderedDict()
+        self._memos = {}
+        self.created = []
+        self.removed = []
+
+        # this discards the journal, completing the commit
+        trash = os.path.join(self.dir, self.TRASH_DIR)
+        if os.path.exists(trash):
+            rmtree(trash)
+
+    def _journal_commit(self, renames):
+        # record the renames that will commit the session, followed by the
+        # marker that makes them take effect
+        trash = os.path.join(self.dir, self.TRASH_DIR)
+        if not os.path.exists(trash):
+            os.mkdir(trash)
+        with open(os.path.join(trash, self.JOURNAL), 'a') as fd:
+            lines = [json.dumps(["rename", os.path.relpath(t, self.dir),
+                                 os.path.relpath(d, self.dir)])
+                     for t, d in renames]
+            lines.insert(0, json.dumps(["commit"]))
+            fd.write("\n".join(lines) + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    @classmethod
+    def _rename_all(cls, renames):
+        # rename temporary files into place; those already renamed are skipped
+        for tmpf, destfile in renames:
+            if os.path.exists(tmpf):
+                os.rename(tmpf, destfile)
+
+    def abort(self):
+        """
+        discard all pending files, restore the files removed during the 
+        session, and remove the (now empty) metadata directories created 
+        during the session.
+        """
+        self._pending = OrderedDict()
+        self._memos = {}
+        self._rollback(self.created, self.removed)
+        trash = os.path.join(self.dir, self.TRASH_DIR)
+        if os.path.exists(trash):
+            rmtree(trash)
+        self.created = []
+        self.removed = []
+
+    @classmethod
+    def _rollback(cls, created, removed):
+        # restore the given removed files and remove the given created 
+        # directories; return True if anything was restored.
+
+        # clear out any directories recreated where removed ones used to be
+        cls._remove_created(created)
+        restored = False
+        for path, dest in reversed(removed):
+            if not os.path.exists(dest) or os.path.exists(path) or \
+               not os.path.isdir(os.path.dirname(path)):
+                # never moved, or replaced by a data file added during the 
+                # session
+                continue
+            os.rename(dest, path)
+            restored = True
+
+        # restored directories may contain some created during the session
+        cls._remove_created(created)
+        return restored
+
+    @classmethod
+    def _remove_created(cls, created):
+        for d in reversed(created):
+            try:
+                os.rmdir(d)
+            except OSError:
+                pass
+
+    def exists(self, path):
+        return self._exists(path)
+
+    def walk(self, path):
+        return self._walk(path)
+
+    def _exists(self, path):
+        return self.is_pending(path) or os.path.exists(path)
+
+    def _isfile(self, path):
+        return self.is_pending(path) or os.path.isfile(path)
+
+    def _walk(self, path):
+        for root, subdirs, files in os.walk(path):
+            root = os.path.normpath(root)
+            for f in self._pending:
+                if os.path.dirname(f) == root and \
+                   os.path.basename(f) not in files:
+                    files.append(os.path.basename(f))
+            yield root, subdirs, files
+
+    def _open(self, path):
+        path = os.path.normpath(path)
+        if path in self._pending:
+            return StringIO(json.dumps(self._pending[path][1]))
+        return open(path)
+
+    def _stamp_of(self, filepath):
+        path = os.path.normpath(filepath)
+        if path in self._pending:
+            return (None, self._pending[path][0], 0)
+        return super(_BatchBagView, self)._stamp_of(filepath)
+
+    def read_nerd(self, nerdfile, copy=True):
+        """
+        read the given NERDm file, returning its pending contents if it has
+        been staged.  
+
+        :param bool copy:  if False, the pending data object itself (rather 
+                           than a copy) is returned; the caller must then not
+                           change it except to stage the result via stage().
+        """
+        path = os.path.normpath(nerdfile)
+        if path in self._pending:
+            if copy:
+                return deepcopy(self._pending[path][1])
+            return self._pending[path][1]
+        return super(_BatchBagView, self).read_nerd(nerdfile)
+
+    def read_pod(self, podfile, copy=True):
+        """
+        read the given POD file, returning its pending contents if it has
+        been staged (see read_nerd()).
+        """
+        path = os.path.normpath(podfile)
+        if path in self._pending:
+            if copy:
+                return deepcopy(self._pending[path][1])
+            return self._pending[path][1]
+        return super(_BatchBagView, self).read_pod(podfile)
+
 class BagBuilder(PreservationSystem):
     """
     A class for building up and populating a BagIt bag compliant with the 
@@ -127,10 +476,33 @@ class BagBuilder(PreservationSystem):
     :prop copy_on_link_failure bool (True):  If True, then when moving datafiles 
                               to output bag via a hardlink, then the file 
                               will get copied if the linking fails.  
+    :prop checksum_on_copy bool (True):  If True, the checksum of a data file 
+                              will be calculated while it is copied into the 
+                              bag; this value is then used when the file is 
+                              registered and, as long as the file remains 
+                              unchanged, when the bag is finalized, saving 
+                              the need to re-read the file.  
+    :prop verify_payload_oxum bool (False):  if True, when writing the 
+                              bag-info.txt file, measure the payload by 
+                              examining the files in the data directory rather
+                              than relying solely on the byte and file counts 
+                              kept as data files are added and removed via 
+                              this builder.  
+    :prop checksum_workers int:  the number of data files to calculate 
+                              checksums for in parallel when checksumming 
+                              many files at once (e.g. in 
+                              ensure_comp_metadata()); if not set, the number
+                              of CPUs is used.  
     :prop file_md_extract dict (None):  a set of parameters to pass to the 
                               configured file metadata extractor.
     :prop json_indent int (4):  The amount of indent to use when exporting JSON
                               data
+    :prop compact_json bool (False):  if True, write JSON metadata files 
+                              compactly (without indentation or line breaks)
+                              while the bag is being built; this makes them
+                              smaller and faster to write and read.  The 
+                              files are pretty-printed (using json_indent) 
+                              when the bag is finalized.
     :prop ensure_nerdm_type_on_add bool (True):  if True, make sure that the 
                          resource metadata has a recognized value for "_schema".
     :prop distrib_service_baseurl str (https://data.nist.gov/od/ds):  the base
@@ -179,6 +551,7 @@ class BagBuilder(PreservationSystem):
         self._pdir = parentdir
         self._bagdir = os.path.join(self._pdir, self._name)
         self._bag = None
+        self._batch = None   # set while a batch session is open
 
         if not logger:
             logger = logging.getLogger(self._bagdir)
@@ -191,9 +564,27 @@ class BagBuilder(PreservationSystem):
 
         self._id = None   # set below
         self._ediid = None
+        self._ids_loaded = False
         self._logname = self.cfg.get('log_filename', 'preserv.log')
         self._log_handlers = {}
         self._mimetypes = None
+
+        # checksums of data files calculated as they were copied into the 
+        # bag, keyed by filepath; values are (size, mtime, hash) tuples
+        self._copysums = {}
+
+        # running [bytes, files] counts of the bag's payload, kept up to date
+        # as data files are added and removed; None if not yet known
+        self._payload_counts = None
+
+        # the (device, inode) of the data directory the counts apply to; if 
+        # the directory is replaced (e.g. by a copy of the bag), the counts 
+        # must be re-measured
+        self._payload_dirid = None
+
+        # a persistent cache of file checksums (a ChecksumCache instance); 
+        # this can be set by the creator of this builder.
+        self.checksum_cache = None
         self._distbase = self.cfg.get('distrib_service_baseurl', DISTSERV)
         if not self._distbase.endswith('/'):
             self._distbase += '/'
@@ -217,7 +608,7 @@ class BagBuilder(PreservationSystem):
                                      self._bagdir)
             self.ensure_bagdir()  # inits self.bag
 
-        if self.bag and os.path.exists(self.bag.nerd_file_for("")):
+        if self.bag and self._md_exists(self.bag.nerd_file_for("")):
             resmd = self.bag.nerd_metadata_for("")
             if resmd.get('@id'):
                 self._id = resmd['@id']
@@ -238,6 +629,67 @@ class BagBuilder(PreservationSystem):
         self.disconnect_logfile()
         return False
 
+    @contextmanager
+    def batch(self):
+        """
+        open a session for making many metadata updates at once, for use in a
+        with statement:
+
+           with bldr.batch():
+               bldr.update_metadata_for("a/b.txt", md1)
+               bldr.update_metadata_for("a/b.txt", md2)
+
+        Within the session, component metadata are kept in memory rather than
+        written to the bag as they are updated:  repeated updates to the same
+        component are combined, and each changed metadata file is written 
+        just once when the with-block exits normally.  The files are first 
+        written to temporary files, all of which are then renamed into 
+        place.  If the with-block exits via an exception, the pending updates
+        are discarded, leaving the bag's metadata as it was before the 
+        session began; likewise, components removed during the session (with 
+        remove_component()) are restored.  (Messages recorded to the bag's 
+        log and data files added during the session are not affected.)  
+        The session's removals and renames are recorded in a journal in the
+        bag so that a session that is interrupted (e.g. by a crash) can be 
+        cleaned up when the next session begins or when the bag is finalized:
+        if it was in the midst of being committed, the commit is completed;
+        otherwise, its changes to the metadata are rolled back.  
+
+        While the session is open, the bag property provides a view of the 
+        bag that includes the pending updates.  Opening a session within 
+        another session simply joins the outer one.  Calling finalize_bag() 
+        or validate() within a session first writes out the updates 
+        pending so far.  
+        """
+        if self._batch:
+            # join the session already open
+            yield self
+            return
+
+        self.ensure_bag_structure()
+        if _BatchBagView.clean_leftovers(self.bagdir):
+            # removed data files were restored, so recount the payload
+            self._payload_counts = None
+        outer = self._bag
+        self._batch = _BatchBagView(self.bagdir)
+        self._bag = self._batch
+        try:
+            yield self
+            self._commit_batch()
+        except:
+            if self._batch.removed:
+                # removed data files are restored, so recount the payload
+                self._payload_counts = None
+            self._batch.abort()
+            raise
+        finally:
+            self._bag = outer
+            self._batch = None
+
+    def _commit_batch(self):
+        if self._batch:
+            self._batch.commit(self._json_indent())
+
 
     def _merge_def_config(self, config):
         if not def_etc_dir:
@@ -398,8 +850,8 @@ class BagBuilder(PreservationSystem):
         old = None
         if self.bag:
             mdfile = self.bag.nerd_file_for("")
-            if os.path.exists(mdfile):
-                mdata = read_nerd(mdfile)
+            if self._md_exists(mdfile):
+                mdata = self._read_md(mdfile)
                 old = mdata.get('ediid')
                 if old and old != ediid:
                     if ediid:
@@ -412,10 +864,11 @@ class BagBuilder(PreservationSystem):
     def _upd_downloadurl(self, ediid):
         mdtree = os.path.join(self.bagdir, 'metadata')
         if os.path.exists(mdtree):
-            for dir, subdirs, files in os.walk(mdtree):
+            walk = (self._batch and self._batch.walk) or os.walk
+            for dir, subdirs, files in walk(mdtree):
                 if FILEMD_FILENAME in files:
                     mdfile = os.path.join(dir, FILEMD_FILENAME)
-                    mdata = read_nerd(mdfile)
+                    mdata = self._read_md(mdfile)
                     if (DATAFILE_TYPE in mdata.get("@type", []) or \
                         DOWNLOADABLEFILE_TYPE in mdata.get("@type", [])) and \
                        mdata.get('filepath') and             \
@@ -510,7 +963,7 @@ class BagBuilder(PreservationSystem):
     def _has_resmd(self):
         if not self.bag:
             return False
-        return os.path.exists(self.bag.nerd_file_for(""))
+        return self._md_exists(self.bag.nerd_file_for(""))
 
     def rename_bag(self, name):
         """
@@ -519,6 +972,9 @@ class BagBuilder(PreservationSystem):
         """
         if name == self._name:
             return
+        if self._batch:
+            raise StateException("Unable to rename bag while a batch session "
+                                 "is open", sys=self)
 
         newdir = os.path.join(self._pdir, name)
         if os.path.exists(self._bagdir):
@@ -551,15 +1007,25 @@ class BagBuilder(PreservationSystem):
         self.connect_logfile()
         if didit:
             self.record("Created bag with name, %s", self.bagname)
-        self._bag = NISTBag(self.bagdir)
-        if (not self._id or not self._ediid) and \
-           os.path.exists(self._bag.nerd_file_for("")):
-            # load the resource-level metadata that's already there
-            md = self._bag.nerd_metadata_for("")
-            if not self._id:
-                self._id = md.get('@id')
-            if not self._ediid:
-                self._ediid = md.get('ediid')
+        if not self._bag or self._bag.dir != self.bagdir:
+            # reuse an existing view to retain its metadata cache
+            self._bag = NISTBag(self.bagdir)
+            self._ids_loaded = False
+        if (not self._id or not self._ediid) and not self._ids_loaded and \
+           self._md_exists(self._bag.nerd_file_for("")):
+            # load the identifiers from the resource-level metadata that's 
+            # already there; this is done once, as later writes to that 
+            # metadata are picked up by _write_json().
+            self._load_ids(self._read_md(self._bag.nerd_file_for("")))
+            self._ids_loaded = True
+
+    def _load_ids(self, resmd):
+        # set the resource identifiers from the given resource metadata if 
+        # they have not been set already
+        if not self._id:
+            self._id = resmd.get('@id')
+        if not self._ediid:
+            self._ediid = resmd.get('ediid')
         
     def ensure_bag_structure(self):
         """
@@ -572,9 +1038,12 @@ class BagBuilder(PreservationSystem):
         self._extend_file_list(dirs, 'extra_tag_dirs')
 
         for dir in dirs:
-            dir = os.path.join(self.bagdir, dir)
-            if not os.path.exists(dir):
-                os.mkdir(dir)
+            path = os.path.join(self.bagdir, dir)
+            if not os.path.exists(path):
+                os.mkdir(path)
+                if dir == "data":
+                    self._payload_counts = [0, 0]
+                    self._payload_dirid = self._payload_dir_id()
 
     def _extend_file_list(self, filelist, param):
         extras = self.cfg.get(param)
@@ -606,7 +1075,18 @@ class BagBuilder(PreservationSystem):
         path = os.path.join(self.bagdir, "metadata", destpath)
         try:
             if not os.path.exists(path):
-                os.makedirs(path)
+                if self._batch:
+                    # remember (and journal) the directories we create in 
+                    # case the session is aborted
+                    made = []
+                    d = path
+                    while not os.path.exists(d):
+                        made.insert(0, d)
+                        d = os.path.dirname(d)
+                    self._batch.add_created(made)
+                    os.makedirs(path)
+                else:
+                    os.makedirs(path)
         except Exception, ex:
             pdir = os.path.join(os.path.basename(self.bagdir),
                                 "metadata", destpath)
@@ -631,7 +1111,7 @@ class BagBuilder(PreservationSystem):
         self._ensure_metadata_dirs(collpath)
 
         while collpath != "":
-            if not os.path.exists(self.bag.nerd_file_for(collpath)):
+            if not self._md_exists(self.bag.nerd_file_for(collpath)):
                 self._define_file_comp_md(collpath, "Subcollection")
             collpath = os.path.dirname(collpath)
 
@@ -728,7 +1208,7 @@ class BagBuilder(PreservationSystem):
             return out
 
     def _define_file_comp_md(self, destpath, comptype, msg=None):
-        if os.path.exists(self.bag.nerd_file_for(destpath)):
+        if self._md_exists(self.bag.nerd_file_for(destpath)):
             md = self.bag.nerd_metadata_for(destpath, True)
             if not metadata_matches_type(md, comptype):
                 raise StateException("Existing component not a "+comptype+
@@ -745,7 +1225,9 @@ class BagBuilder(PreservationSystem):
     def _define_nonfile_comp_md(self, compid, comptype, msg=None):
         if compid.startswith("@id:"):
             compid = compid[len("@id:"):]
-        rmd, comps, found = self._fetch_nonfile_comp(compid, comptype)
+        self.ensure_bag_structure()
+        rmd, comps, index = self._nonfile_comps_in()
+        found = self._check_nonfile_comp(comps, index, compid, comptype)
                 
         if found < 0:
             if msg is None:
@@ -754,11 +1236,10 @@ class BagBuilder(PreservationSystem):
             if msg:
                 self.record(msg)
             md = self._create_init_md_for("@id:"+compid, comptype)
-            comps.append(md)
-            self.ensure_bag_structure()
-            self._write_resmd(rmd)
+            found = self._set_nonfile_comp(rmd, comps, index, -1, md)
+            self._save_nonfile_comps(rmd, comps, index)
 
-        return comps[-1]
+        return deepcopy(comps[found])
 
     def remove_component(self, destpath, trimcolls=False):
         """
@@ -793,9 +1274,11 @@ class BagBuilder(PreservationSystem):
 
         # First look for metadata
         target = os.path.join(self.bag.metadata_dir, destpath)
+        if self._batch:
+            self._batch.discard_under(target)
         if os.path.isdir(target):
             removed = True
-            rmtree(target)
+            self._remove_path(target)
         elif os.path.exists(target):
             raise BadBagRequest("Request path does not look like a data "+
                                 "component (it's a file in the metadata tree): "+
@@ -805,10 +1288,14 @@ class BagBuilder(PreservationSystem):
         target = os.path.join(self.bag.data_dir, destpath)
         if os.path.isfile(target):
             removed = True
-            os.remove(target)
+            self._count_payload(-os.stat(target).st_size, -1)
+            self._remove_path(target)
         elif os.path.isdir(target):
             removed = True
-            rmtree(target)
+            if self._payload_counts is not None:
+                size = measure_dir_size(target)
+                self._count_payload(-size[0], -size[1])
+            self._remove_path(target)
 
         if destpath and trimcolls:
             destpath = os.path.dirname(destpath)
@@ -824,6 +1311,16 @@ class BagBuilder(PreservationSystem):
 
         return removed
 
+    def _remove_path(self, path):
+        # within a batch session, the removal is not final until the session
+        # is committed
+        if self._batch:
+            self._batch.remove(path)
+        elif os.path.isdir(path):
+            rmtree(path)
+        else:
+            os.remove(path)
+
     def _remove_nonfile_component(self, compid):
         if compid.startswith("@id:"):
             compid = compid[len("@id:"):]
@@ -880,7 +1377,7 @@ class BagBuilder(PreservationSystem):
             
         if msg is None:
             msg = "Setting "
-            if os.path.exists(self.bag.nerd_file_for(destpath)):
+            if self._md_exists(self.bag.nerd_file_for(destpath)):
                 msg = "Over-writing "
             if destpath:
                 msg += "component metadata: filepath="+destpath
@@ -913,13 +1410,8 @@ class BagBuilder(PreservationSystem):
         self.ensure_bag_structure()
 
         # look for a non-file component with the same identifier
-        comps = []
-        found = -1
-        if os.path.exists(outfile):
-            rmd = read_nerd(outfile)
-            comps, found = self._find_nonfile_comp_by_id(rmd, compid)
-        else:
-            rmd = {'components': comps}    
+        rmd, comps, index = self._nonfile_comps_in(outfile)
+        found = index.get(compid, -1)
 
         try:
             mdata = deepcopy(mdata)
@@ -931,7 +1423,6 @@ class BagBuilder(PreservationSystem):
                     msg = "Over-writing metadata for component: id="+compid
                 if msg:
                     self.record(msg)
-                comps[found] = mdata
 
             else:
                 # add a new component
@@ -939,48 +1430,100 @@ class BagBuilder(PreservationSystem):
                     msg = "Setting metadata for new component: id="+compid
                 if msg:
                     self.record(msg)
-                comps.append(mdata)
 
-            self._write_resmd(rmd, outfile)
+            self._set_nonfile_comp(rmd, comps, index, found, deepcopy(mdata))
+            self._save_nonfile_comps(rmd, comps, index, outfile)
         except Exception as ex:
             raise BagWriteError("Failed to write metadata for comp id="+compid+
                                 str(ex))
         return mdata
 
-    def _find_nonfile_comp_by_id(self, resmd, compid):
-        # this finds non-file components; returns the component list and
-        # the index of the component with a matching ID
-        comps = []
-        found = -1 
-        try:
-            if 'components' in resmd:
-                comps = resmd['components']
-                for i in range(len(comps)):
-                    if '@id' in comps[i] and comps[i]['@id'] == compid:
-                        found = i
-                        break
-        except Exception as ex:
-            raise NERDError("Trouble interpreting existing JSON metadata " +
-                            "for id="+compid+": "+str(ex))
-        return (comps, found)
-
     def _fetch_nonfile_comp(self, compid, comptype=None):
         # this finds a non-file component with a matcthing ID, returning
         # the base resource metadata node, the components list, and the
         # index of the matching component.
-        comps = []
-        found = -1
-        if self._has_resmd():
-            rmd = self.bag.nerd_metadata_for("")
-            comps, found = self._find_nonfile_comp_by_id(rmd, compid)
-            if comptype and found >= 0 and comps[found] and \
-               not metadata_matches_type(comps[found], comptype):
-                raise StateException("Existing component not a "+comptype+
-                                     ": "+str(comps[found].get('@type',[])))
+        rmd, comps, index = self._nonfile_comps_in()
+        found = self._check_nonfile_comp(comps, index, compid, comptype)
+        return (rmd, comps, found)
+
+    def _check_nonfile_comp(self, comps, index, compid, comptype=None):
+        # return the position of the non-file component with the given ID,
+        # ensuring that it has the given type, or -1 if it is not found
+        found = index.get(compid, -1)
+        if comptype and found >= 0 and comps[found] and \
+           not metadata_matches_type(comps[found], comptype):
+            raise StateException("Existing component not a "+comptype+
+                                 ": "+str(comps[found].get('@type',[])))
+        return found
+
+    def _nonfile_comps_in(self, mdfile=None):
+        # return the JSON data in the given resource-level metadata file 
+        # (default: the NERDm file) along with its list of components and 
+        # an index of the non-file components by @id.  Within a batch 
+        # session, these are kept between calls so that a series of 
+        # updates does not require repeated parsing and scanning; in this 
+        # case, the data returned is the live copy pending in the session 
+        # and must only be updated via _set_nonfile_comp() and 
+        # _save_nonfile_comps().
+        if not mdfile:
+            mdfile = self.bag.nerd_file_for("")
+        if self._batch:
+            memo = self._batch.get_memo(mdfile)
+            if memo:
+                return memo
+
+        if self._md_exists(mdfile):
+            rmd = self._read_md(mdfile)
         else:
-            rmd = { "components": comps }
+            rmd = {}
+        # (the list is only attached to rmd when a component gets added; see
+        # _set_nonfile_comp())
+        comps = rmd.get('components', [])
 
-        return (rmd, comps, found)
+        index = {}
+        try:
+            for i in range(len(comps)):
+                if '@id' in comps[i]:
+                    index.setdefault(comps[i]['@id'], i)
+        except Exception as ex:
+            raise NERDError("Trouble interpreting existing JSON metadata " +
+                            "in "+mdfile+": "+str(ex))
+
+        out = (rmd, comps, index)
+        if self._batch:
+            self._batch.set_memo(mdfile, out)
+        return out
+
+    def _set_nonfile_comp(self, rmd, comps, index, pos, comp):
+        # set the component at the given position in the components list
+        # (or append it if pos < 0), keeping the index up to date
+        if pos < 0:
+            if 'components' not in rmd:
+                rmd['components'] = comps
+            comps.append(comp)
+            pos = len(comps) - 1
+        else:
+            oldid = comps[pos].get('@id')
+            comps[pos] = comp
+            if oldid != comp.get('@id') and index.get(oldid) == pos:
+                # the component's identifier changed; re-index the lot
+                index.clear()
+                for i in range(len(comps)-1, -1, -1):
+                    if '@id' in comps[i]:
+                        index[comps[i]['@id']] = i
+        if '@id' in comp:
+            index.setdefault(comp['@id'], pos)
+        return pos
+
+    def _save_nonfile_comps(self, rmd, comps, index, mdfile=None):
+        # write out resource-level metadata returned by _nonfile_comps_in()
+        if not mdfile:
+            mdfile = self.bag.nerd_file_for("")
+        if self._batch:
+            self._batch.stage(rmd, mdfile, copy=False)
+            self._batch.set_memo(mdfile, (rmd, comps, index))
+        else:
+            self._write_resmd(rmd, mdfile)
 
     def _has_nonfile_comp(self, compid):
         rmd, comps, found = self._fetch_nonfile_comp(compid)
@@ -1056,27 +1599,29 @@ class BagBuilder(PreservationSystem):
             compid = compid[len("@id:"):]
         self.ensure_bag_structure()
 
-        rmd, comps, found = self._fetch_nonfile_comp(compid, comptype)
+        rmd, comps, index = self._nonfile_comps_in()
+        found = self._check_nonfile_comp(comps, index, compid, comptype)
         if found < 0:
             # not found; get default data
             if msg is None:
                 msg = "Creating new non-file component: id="+compid
-            md = self._create_init_md_for("@id:"+compid, comptype)
-            comps.append(md)
-            found = -1
-        elif msg is None:
-            msg = "Updating non-file component: id="+compid
+            orig = self._create_init_md_for("@id:"+compid, comptype)
+        else:
+            orig = comps[found]
+            if msg is None:
+                msg = "Updating non-file component: id="+compid
 
         if msg:
             self.record(msg)
-        comps[found] = self._update_md(comps[found], mdata)
-        self._write_resmd(rmd)
+        found = self._set_nonfile_comp(rmd, comps, index, found,
+                                       self._update_md(orig, mdata))
+        self._save_nonfile_comps(rmd, comps, index)
 
-        return comps[found]
+        return deepcopy(comps[found])
 
     def _update_file_metadata(self, destpath, mdata, comptype, msg=None):
         
-        if os.path.exists(self.bag.nerd_file_for(destpath)):
+        if self._md_exists(self.bag.nerd_file_for(destpath)):
             orig = self.bag.nerd_metadata_for(destpath)
             if comptype and '@type' in orig and \
                not metadata_matches_type(orig, comptype):
@@ -1202,7 +1747,7 @@ class BagBuilder(PreservationSystem):
                                                  message)
 
     def _update_file_annotations(self, destpath, mdata, comptype, message=None):
-        if not os.path.exists(self.bag.nerd_file_for(destpath)):
+        if not self._md_exists(self.bag.nerd_file_for(destpath)):
             if not comptype:
                 comptype = (destpath and "DataFile") or "Resource"
             self.define_component(destpath, comptype)
@@ -1214,10 +1759,10 @@ class BagBuilder(PreservationSystem):
         self.ensure_bag_structure()
 
         afile = self.bag.annotations_file_for(destpath)
-        if os.path.exists(afile):
+        if self._md_exists(afile):
             if message is None:
                 message = "Updating annoations for " + destpath
-            orig = read_nerd(afile)
+            orig = self._read_md(afile)
             mdata = self._update_md(orig, mdata)
         else:
             if message is None:
@@ -1239,21 +1784,18 @@ class BagBuilder(PreservationSystem):
             found = len(comps)
 
         afile = self.bag.annotations_file_for("")
-        comps = []
-        found = -1
-        if os.path.exists(afile):
-            armd = read_nerd(afile)
-            comps, found = self._find_nonfile_comp_by_id(armd, compid)
-        else:
-            armd = { 'components': comps }
-
+        armd, comps, index = self._nonfile_comps_in(afile)
+        found = index.get(compid, -1)
         if found < 0:
-            comps.append({'@id': compid})
+            orig = {'@id': compid}
+        else:
+            orig = comps[found]
         
-        comps[found] = self._update_md(comps[found], mdata)
-        self._write_resmd(armd, afile)
+        found = self._set_nonfile_comp(armd, comps, index, found,
+                                       self._update_md(orig, mdata))
+        self._save_nonfile_comps(armd, comps, index, afile)
 
-        return comps[found]
+        return deepcopy(comps[found])
 
     def add_data_file(self, destpath, srcpath, register=True, hardlink=False,
                       message=None, comptype=None):
@@ -1300,11 +1842,13 @@ class BagBuilder(PreservationSystem):
         self.ensure_datafile_dirs(destpath)
 
         action = "Added"
-        if os.path.exists(os.path.join(self.bag.data_dir, destpath)):
+        oldsize = None
+        outfile = os.path.join(self.bag.data_dir, destpath)
+        if os.path.exists(outfile):
             action = "Replaced"
+            oldsize = os.stat(outfile).st_size
 
         # insert the file into the data directory...
-        outfile = os.path.join(self.bag.data_dir, destpath)
         if hardlink:
             # ... as a hard link (faster, saves disk space)
             try:
@@ -1320,25 +1864,92 @@ class BagBuilder(PreservationSystem):
                     self.log.warning(msg)
                 else:
                     self.log.exception(msg, exc_info=True)
+                    self._payload_counts = None
                     raise BagWriteError(msg, sys=self)
+        checksum = None
+        self._copysums.pop(destpath, None)
         if not hardlink:
             # ... by copying source (hard link is not possible or desired)
             try:
-                filecopy(srcpath, outfile)
+                if self.cfg.get('checksum_on_copy', True):
+                    # calculate the checksum as we copy
+                    st = os.stat(srcpath)
+                    size, sums = copy_with_checksum(srcpath, outfile)
+                    checksum = sums['sha256']
+                    self._remember_checksum(destpath, checksum)
+                    if self.checksum_cache is not None:
+                        self.checksum_cache.put(srcpath, checksum, st)
+                else:
+                    filecopy(srcpath, outfile)
                 self.record("%s data file at %s" % (action, destpath))
             except Exception, ex:
                 msg = "Unable to copy data file (" + srcpath + \
                       ") into bag (" + outfile + "): " + str(ex)
                 self.log.exception(msg, exc_info=True)
+                self._payload_counts = None
                 raise BagWriteError(msg, cause=ex, sys=self)
 
+        if oldsize is None:
+            self._count_payload(os.stat(outfile).st_size, 1)
+        else:
+            self._count_payload(os.stat(outfile).st_size - oldsize, 0)
+
         # Now set its metadata
         if register:
             self.register_data_file(destpath, srcpath, True, comptype,
-                                    "...and updated its metadata.")
+                                    "...and updated its metadata.", checksum)
+
+    def _remember_checksum(self, destpath, checksum):
+        # remember the checksum calculated for a data file in the bag, along 
+        # with the file stats that tell us if the file has since changed
+        st = os.stat(os.path.join(self.bag.data_dir, destpath))
+        self._copysums[destpath] = (st.st_size, st.st_mtime, checksum)
+
+    def _data_checksum_of(self, destpath):
+        # return the checksum of a data file in the bag, using the value 
+        # calculated during copying if the file has not changed since
+        dfpath = os.path.join(self.bag.data_dir, destpath)
+        if destpath in self._copysums:
+            st = os.stat(dfpath)
+            size, mtime, checksum = self._copysums[destpath]
+            if st.st_size == size and st.st_mtime == mtime:
+                return checksum
+            del self._copysums[destpath]
+        return self._checksum_of(dfpath)
+
+    def _checksum_of(self, filepath):
+        # return the checksum of the given file, consulting the checksum 
+        # cache if available
+        if self.checksum_cache is not None:
+            return self.checksum_cache.checksum_of(filepath)
+        return checksum_of(filepath)
+
+    def _checksums_of(self, filepaths):
+        # return an iterator of (filepath, checksum) pairs for the given files,
+        # consulting the checksum cache if available and calculating the rest
+        # in parallel
+        workers = self.cfg.get('checksum_workers')
+        if self.checksum_cache is not None:
+            return self.checksum_cache.checksums_of(filepaths, workers)
+        return checksums_of(filepaths, workers)
+
+    def _data_checksums_of(self, destpaths):
+        # return a dictionary of checksums for the given data files in the
+        # bag, calculating those not already known in parallel
+        out = {}
+        tocalc = {}
+        for destpath in destpaths:
+            if destpath in self._copysums:
+                out[destpath] = self._data_checksum_of(destpath)
+            else:
+                tocalc[os.path.join(self.bag.data_dir, destpath)] = destpath
+
+        for dfpath, checksum in self._checksums_of(tocalc.keys()):
+            out[tocalc[dfpath]] = checksum
+        return out
 
     def register_data_file(self, destpath, srcpath=None, examine=True,
-                           comptype=None, message=None):
+                           comptype=None, message=None, checksum=None):
         """
         create and install metadata into the bag for the given file to be (newly)
         added at the given destination path.  The file itself is not actually 
@@ -1361,6 +1972,9 @@ class BagBuilder(PreservationSystem):
                                component.  If not specified, the type will be
                                discerned by examining the file (defaulting 
                                to "DataFile").  
+        :param str checksum:   the already calculated SHA-256 checksum of the 
+                               file; if provided, the file will not be re-read
+                               to calculate it.
         """
         # determine the component type
         if not comptype:
@@ -1368,7 +1982,7 @@ class BagBuilder(PreservationSystem):
 
         if srcpath:
             mdata = self.describe_data_file(srcpath, destpath, examine,
-                                            comptype, False)
+                                            comptype, False, checksum)
         else:
             mdata = self.define_component(destpath, comptype)
             self._add_mediatype(destpath, mdata)
@@ -1379,7 +1993,7 @@ class BagBuilder(PreservationSystem):
         return self.replace_metadata_for(destpath, mdata, message)
 
     def describe_data_file(self, srcpath, destpath=None, examine=True,
-                           comptype=None, asupdate=True):
+                           comptype=None, asupdate=True, checksum=None):
         """
         examine the given file and return a metadata description of it.  
 
@@ -1406,6 +2020,10 @@ class BagBuilder(PreservationSystem):
                                returned will not take into account previous metadata
                                as if assuming the file is being examined for the first
                                time.  
+        :param str checksum:   the already calculated SHA-256 checksum of the 
+                               file; if provided (and examine is True), this 
+                               value will be used rather than re-reading the 
+                               file to calculate it.  
         """
         if not destpath:
             destpath = os.path.basename(srcpath)
@@ -1414,7 +2032,7 @@ class BagBuilder(PreservationSystem):
         if not comptype:
             comptype = self._determine_file_comp_type(srcpath)
             
-        if asupdate and self.bag and os.path.exists(self.bag.nerd_file_for(destpath)):
+        if asupdate and self.bag and self._md_exists(self.bag.nerd_file_for(destpath)):
             # TODO: what if comptype has changed?
             mdata = self.bag.nerd_metadata_for(destpath, True)
         else:
@@ -1423,7 +2041,9 @@ class BagBuilder(PreservationSystem):
         try:
             self._add_file_specs(srcpath, mdata)
             if examine:
-                self._add_checksum(checksum_of(srcpath), mdata)
+                if not checksum:
+                    checksum = self._checksum_of(srcpath)
+                self._add_checksum(checksum, mdata)
                 self._add_extracted_metadata(srcpath, mdata)
         except OSError as ex:
             raise BagWriteError("Unable to examine data file for metadata: "+
@@ -1466,7 +2086,7 @@ class BagBuilder(PreservationSystem):
         out = OrderedDict()
         self._add_file_specs(datafile, out)
         if checksum:
-            self._add_checksum(checksum_of(datafile), out)
+            self._add_checksum(self._checksum_of(datafile), out)
         return out
 
     def _add_file_specs(self, datafile, mdata):
@@ -1533,67 +2153,69 @@ class BagBuilder(PreservationSystem):
                 self.log.warning("provided NERDm data does not look like a "+
                                  "Resource record")
         
-        msg = None
-        if message is not None:
-            msg = ""
-        if "components" in mdata:
-            components = mdata['components']
-            if not isinstance(components, list):
-                raise NERDTypeError("list", str(type(mdata['components'])),
-                                    'components')
-            for i in range(len(components)-1, -1, -1):
-                tps = components[i].get('@type',[])
-                comptype = None
-                if DATAFILE_TYPE in tps:
-                    comptype = "DataFile"
-                elif SUBCOLL_TYPE in tps:
-                    comptype = "Subcollection"
-                elif CHECKSUMFILE_TYPE in tps:
-                    comptype = "ChecksumFile"
-                elif DOWNLOADABLEFILE_TYPE in tps:
-                    comptype = ""
-                if comptype is not None:
-                    if savefilemd and 'filepath' not in components[i] and \
-                       components[i].get('@id','').startswith("cmps/"):
-                        components[i]['filepath'] = components[i]['@id'][5:]
-                    if savefilemd and 'filepath' not in components[i]:
-                        msg = "File component missing 'filepath' property"
-                        if '@id' in components[i]:
-                            msg += " ({0})".format(components[i]['@id'])
-                        self.log.warning(msg)
-                    else:
-                        if savefilemd:
-                            # update instead of replace (this sets defaults
-                            # internally)
-                            #
-                            # # ensure we have default metadata filled out
-                            # cmpmd = self._create_init_md_for(
-                            #    components[i]['filepath'], comptype)
-                            # cmpmd = self._update_md(cmpmd, components[i])
-                            # self.replace_metadata_for(cmpmd['filepath'], cmpmd)
-                            #
-                            self.update_metadata_for(components[i]['filepath'],
-                                                     components[i], comptype, msg)
-                        components.pop(i)
-
-        if 'inventory' in mdata:
-            # we'll recalculate the inventory at the end; for now, get rid of it.
-            del mdata['inventory']
-        if 'dataHierarchy' in mdata:
-            # we'll recalculate the dataHierarchy at the end; for now, get rid
-            # of it.
-            del mdata['dataHierarchy']
-        if 'ediid' in mdata:
-            self._ediid = mdata['ediid']
-            #
-            ## this will trigger updates to DataFile components unless
-            ## self.ediid is not set or was already set to new value
-            #self.ediid = mdata['ediid']
-
-        defmd = self._create_init_md_for("", "Resource")
-        mdata = self._update_md(defmd, mdata)
-        # self.replace_metadata_for("", mdata, message="")
-        self.update_metadata_for("", mdata, "Resource", message="")
+        # save all of the metadata files in one go
+        with self.batch():
+            msg = None
+            if message is not None:
+                msg = ""
+            if "components" in mdata:
+                components = mdata['components']
+                if not isinstance(components, list):
+                    raise NERDTypeError("list", str(type(mdata['components'])),
+                                        'components')
+                for i in range(len(components)-1, -1, -1):
+                    tps = components[i].get('@type',[])
+                    comptype = None
+                    if DATAFILE_TYPE in tps:
+                        comptype = "DataFile"
+                    elif SUBCOLL_TYPE in tps:
+                        comptype = "Subcollection"
+                    elif CHECKSUMFILE_TYPE in tps:
+                        comptype = "ChecksumFile"
+                    elif DOWNLOADABLEFILE_TYPE in tps:
+                        comptype = ""
+                    if comptype is not None:
+                        if savefilemd and 'filepath' not in components[i] and \
+                           components[i].get('@id','').startswith("cmps/"):
+                            components[i]['filepath'] = components[i]['@id'][5:]
+                        if savefilemd and 'filepath' not in components[i]:
+                            msg = "File component missing 'filepath' property"
+                            if '@id' in components[i]:
+                                msg += " ({0})".format(components[i]['@id'])
+                            self.log.warning(msg)
+                        else:
+                            if savefilemd:
+                                # update instead of replace (this sets defaults
+                                # internally)
+                                #
+                                # # ensure we have default metadata filled out
+                                # cmpmd = self._create_init_md_for(
+                                #    components[i]['filepath'], comptype)
+                                # cmpmd = self._update_md(cmpmd, components[i])
+                                # self.replace_metadata_for(cmpmd['filepath'], cmpmd)
+                                #
+                                self.update_metadata_for(components[i]['filepath'],
+                                                         components[i], comptype, msg)
+                            components.pop(i)
+
+            if 'inventory' in mdata:
+                # we'll recalculate the inventory at the end; for now, get rid of it.
+                del mdata['inventory']
+            if 'dataHierarchy' in mdata:
+                # we'll recalculate the dataHierarchy at the end; for now, get rid
+                # of it.
+                del mdata['dataHierarchy']
+            if 'ediid' in mdata:
+                self._ediid = mdata['ediid']
+                #
+                ## this will trigger updates to DataFile components unless
+                ## self.ediid is not set or was already set to new value
+                #self.ediid = mdata['ediid']
+
+            defmd = self._create_init_md_for("", "Resource")
+            mdata = self._update_md(defmd, mdata)
+            # self.replace_metadata_for("", mdata, message="")
+            self.update_metadata_for("", mdata, "Resource", message="")
 
     def add_ds_pod(self, pod, convert=True, savefilemd=True):
         """
@@ -1664,6 +2286,9 @@ class BagBuilder(PreservationSystem):
                     directories
           :prop 'confirm_checksums' bool (False):  if True, double check that 
                     recorded checksums are correct (by checksumming the data files)
+          :prop 'pretty_print_json' bool (True):  if True, rewrite any JSON 
+                    metadata files that were written compactly (see the 
+                    'compact_json' configuration property) with indentation.
 
         :param dict finalcfg:      the 'finalize' configuration properties
         :param bool stop_logging:  turn off logging to the bag-internal log file; 
@@ -1677,6 +2302,9 @@ class BagBuilder(PreservationSystem):
         """
         if finalcfg is None:
             finalcfg = self.cfg.get('finalize', {})
+        self._commit_batch()
+        if not self._batch and _BatchBagView.clean_leftovers(self.bagdir):
+            self._payload_counts = None
 
         # Start by trimming the empty data folders
         trim = finalcfg.get('trim_folders', False)
@@ -1692,6 +2320,9 @@ class BagBuilder(PreservationSystem):
         if trim:
             self.trim_metadata_folders()
 
+        if finalcfg.get('pretty_print_json', True):
+            self.pretty_print_metadata()
+
         self.ensure_bagit_ver()
         self.write_data_manifest(finalcfg.get('confirm_checksums', False))
         self.write_mbag_files()
@@ -1771,6 +2402,40 @@ class BagBuilder(PreservationSystem):
                     self.log.exception("Failed to remove empty metadata dir: " +
                                        mdir + ": " + str(ex))
 
+    def pretty_print_metadata(self, indent=None):
+        """
+        rewrite any JSON files in the bag's metadata directory that were 
+        written compactly (i.e. without line breaks) so that they are 
+        pretty-printed.  
+
+        :param int indent:  the indentation to use; if None, the 'json_indent'
+                            configuration property is used (default: 4).
+        """
+        if indent is None:
+            indent = self.cfg.get('json_indent', 4)
+        self._commit_batch()
+
+        mroot = os.path.join(self.bagdir, "metadata")
+        if not os.path.exists(mroot):
+            return
+        for mdir, subdirs, files in os.walk(mroot):
+            for f in files:
+                if not f.endswith(".json"):
+                    continue
+                f = os.path.join(mdir, f)
+                with open(f) as fd:
+                    content = fd.read()
+                if not content or '\n' in content:
+                    # already pretty-printed (or empty)
+                    continue
+                try:
+                    data = json.loads(content, object_pairs_hook=OrderedDict)
+                except ValueError as ex:
+                    self.log.warning("Unable to parse metadata file, %s: %s",
+                                     f, str(ex))
+                    continue
+                write_json(data, f, indent)
+
     def ensure_comp_metadata(self, updstats=False, extract=False):
         """
         iterate through all the data files found under the data directory
@@ -1786,30 +2451,43 @@ class BagBuilder(PreservationSystem):
         """
         if not self.bag:
             self.ensure_bagdir()
+
+        # first determine which files need (re-)examining so that their 
+        # checksums can be calculated together in parallel
+        dfiles = OrderedDict()
         for dfile in self.bag.iter_data_files():
+            updcstats = updstats
+            if not updcstats:
+                if not self._md_exists(self.bag.nerd_file_for(dfile)):
+                    updcstats = True
+                else:
+                    md = self.bag.nerd_metadata_for(dfile)
+                    updcstats = 'size' not in md or 'mediaType' not in md or \
+                                'checksum' not in md
+            dfiles[dfile] = updcstats
+        checksums = self._data_checksums_of([f for f in dfiles if dfiles[f]])
+
+        for dfile, updcstats in dfiles.items():
             mdfile = self.bag.nerd_file_for(dfile)
             dfpath = os.path.join(self.bag.data_dir, dfile)
-            if not os.path.exists(mdfile):
+            if not self._md_exists(mdfile):
                 # no metadata found; start from scratch
                 comptype = self._determine_file_comp_type(dfile)
-                self.register_data_file(dfile, dfpath, extract, comptype)
+                self.register_data_file(dfile, dfpath, extract, comptype,
+                                        checksum=checksums[dfile])
                 if not extract:
                     # register does not do checksum when examine=False;
-                    # get it now
+                    # set it now
                     md = OrderedDict()
-                    self._add_checksum(checksum_of(dfpath), md)
+                    self._add_checksum(checksums[dfile], md)
                     self.update_metadata_for(dfile, md,
                                          message="Updating checksum for "+dfile)
 
             else:
-                updcstats = updstats
-                md = self.bag.nerd_metadata_for(dfile)
-                if 'size' not in md or 'mediaType' not in md or \
-                   'checksum' not in md:
-                    updcstats = True
                 md = None
                 if updcstats:
-                    md = self.get_file_specs(dfpath, True)
+                    md = self.get_file_specs(dfpath, False)
+                    self._add_checksum(checksums[dfile], md)
 
                 if extract:
                     if not md:
@@ -1876,7 +2554,10 @@ class BagBuilder(PreservationSystem):
                               data file's metadata will be assumed to be 
                               correct and added to the manifest file.  If 
                               True, the checksum will be calculated to ensure
-                              the value in the metadata file is correct.
+                              the value in the metadata file is correct.  
+                              (Files whose checksums were calculated as they
+                              were copied into the bag by this builder and 
+                              which have not changed since are not re-read.)
         """
         # the checksum should not be part of annotations (?).
         # self.ensure_merged_annotations()
@@ -1895,7 +2576,7 @@ class BagBuilder(PreservationSystem):
                                           str(algo))
                 checksum = checksum['hash']
                 if confirm:
-                    if checksum_of(self._bag._full_dpath(datapath)) != checksum:
+                    if self._data_checksum_of(datapath) != checksum:
                         raise BagProfileError("Checksum failure for "+datapath)
 
                 self._record_manifest_checksum(fd, checksum,
@@ -1949,8 +2630,8 @@ format(nerdm['title'])
             initdata['External-Identifier'].append("doi:"+nerdm['doi'])
 
         # Calculate the payload Oxum
-        oxum = self._measure_oxum(self._bag._datadir)
-        initdata['Payload-Oxum'] = "{0}.{1}".format(oxum[0], oxum[1])
+        payload = self._measure_payload()
+        initdata['Payload-Oxum'] = "{0}.{1}".format(payload[0], payload[1])
 
         # update the multibag version, deprecation
         self.update_head_version(initdata, nerdm.get("version", "1"))
@@ -1958,8 +2639,10 @@ format(nerdm['title'])
         # write everything except Bag-Size
         self.write_baginfo_data(initdata, overwrite=overwrite)
 
-        # calculate and write the size of the bag 
-        oxum = self._measure_oxum(self.bagdir)
+        # calculate and write the size of the bag; the payload need not be
+        # measured again
+        oxum = measure_dir_size(self.bagdir, ["data"])
+        oxum = [oxum[0] + payload[0], oxum[1] + payload[1]]
         size = self._format_bytes(oxum[0])
         oxum[0] += len("Bag-Size: {0} ".format(size))
         oxum[0] += len("Bag-Oxum: {0}.{1} ".format(oxum[0], oxum[1]))
@@ -2010,6 +2693,47 @@ format(nerdm['title'])
     def _measure_oxum(self, rootdir):
         return measure_dir_size(rootdir)
 
+    def _payload_dir_id(self):
+        # return the (device, inode) identifying the current data directory
+        try:
+            st = os.stat(os.path.join(self.bagdir, "data"))
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _check_payload_dir(self):
+        # forget the running payload counts if the data directory they were 
+        # taken from has since been replaced
+        if self._payload_counts is not None and \
+           self._payload_dir_id() != self._payload_dirid:
+            self.log.debug("Bag's data directory was replaced; will "
+                           "re-measure payload")
+            self._payload_counts = None
+
+    def _count_payload(self, nbytes, nfiles):
+        # update the running payload counts (if they are known)
+        self._check_payload_dir()
+        if self._payload_counts is not None:
+            self._payload_counts[0] += nbytes
+            self._payload_counts[1] += nfiles
+
+    def _measure_payload(self):
+        # return the [bytes, files] counts for the bag's payload, taking
+        # them from the running counts when possible
+        self._check_payload_dir()
+        if self._payload_counts is None or \
+           self.cfg.get('verify_payload_oxum', False):
+            dirid = self._payload_dir_id()
+            counts = self._measure_oxum(self._bag.data_dir)
+            if self._payload_counts is not None and \
+               counts != self._payload_counts:
+                self.log.warning("Payload appears to have been changed "
+                                 "outside of the builder (%s.%s != %s.%s)",
+                                 counts[0], counts[1], *self._payload_counts)
+            self._payload_counts = counts
+            self._payload_dirid = dirid
+        return list(self._payload_counts)
+
     def _format_bytes(self, nbytes):
         prefs = ["", "k", "M", "G", "T"]
         ordr = 0
@@ -2138,9 +2862,9 @@ format(nerdm['title'])
             self.ensure_bagdir()
         nerdresf = self._bag.nerd_file_for("")
         podf = self._bag.pod_file()
-        if not os.path.exists(podf):
+        if not self._md_exists(podf):
             raise BagProfileError("Missing POD metadata file; is this bag complete?")
-        if not os.path.exists(nerdresf):
+        if not self._md_exists(nerdresf):
             raise BagProfileError("Missing POD metadata file; is this bag complete?")
         try:
             mf = nerdresf
@@ -2268,6 +2992,7 @@ format(nerdm['title'])
                                  "has not been created.")
         if config is None:
             self.cfg.get('validator', {})
+        self._commit_batch()
         vld8r = NISTAIPValidator(config)
         return vld8r.validate(self._bag)
 
@@ -2377,9 +3102,35 @@ format(nerdm['title'])
         ])
         return out
     
+    def _md_exists(self, mdfile):
+        # return True if the metadata file exists, either on disk or pending
+        # in the current batch session
+        if self._batch:
+            return self._batch.exists(mdfile)
+        return os.path.exists(mdfile)
+
+    def _read_md(self, mdfile):
+        # Note: within a batch session, this returns the live pending data;
+        # callers change it only to write it back with _write_json()
+        if self._batch:
+            return self._batch.read_nerd(mdfile, copy=False)
+        return read_nerd(mdfile)
+
+    def _json_indent(self):
+        # the indentation to write JSON metadata files with (None for compact)
+        if self.cfg.get('compact_json', False):
+            return None
+        return self.cfg.get('json_indent', 4)
+
     def _write_json(self, jsdata, destfile):
-        indent = self.cfg.get('json_indent', 4)
-        write_json(jsdata, destfile, indent)
+        if (not self._id or not self._ediid) and self._bag and \
+           destfile == self._bag.nerd_file_for(""):
+            # keep up with the identifiers written to the resource metadata
+            self._load_ids(jsdata)
+        if self._batch:
+            self._batch.stage(jsdata, destfile)
+            return
+        write_json(jsdata, destfile, self._json_indent())
 
     def _write_resmd(self, resmd, destfile=None):
         # Coming: control the order that JSON properties are written
@@ -3,10 +3,15 @@ Tools for serializing and running checksums on bags
 """
 import subprocess as sp
 from cStringIO import StringIO
-import logging, os
+import logging, os, time, struct, zlib, hashlib
+import zipfile as _zf
+from functools import partial
+import pkg_resources
 
 from .exceptions import BagSerializationError
 from .. import sys as _sys
+from .. import StateException
+from ...utils import checksum_of, build_mime_type_map
 
 def _exec(cmd, dir, log):
     log.info("serializing bag: %s", ' '.join(cmd))
@@ -82,6 +87,345 @@ def zip_serialize(bagdir, destdir, log, destfile=None):
 
     return destfile
 
+# entries (and archive offsets) larger than this require ZIP64 extensions
+ZIP64_LIMIT = _zf.ZIP64_LIMIT
+ZIP64_VERSION = 45
+
+ZIP_BUFSIZE = 1024 * 1024
+
+# media types of files that are already compressed and which, therefore, 
+# will be stored uncompressed; a type ending in '/' matches all types
+# starting with it.
+INCOMPRESSIBLE_TYPES = [
+    "video/", "audio/",
+    "image/jpeg", "image/png", "image/gif", "image/tiff", "image/webp",
+    "application/zip", "application/java-archive", "application/gzip",
+    "application/x-gzip", "application/x-bzip2", "application/x-xz",
+    "application/x-7z-compressed", "application/x-rar-compressed"
+]
+
+# extensions of already-compressed formats that are not necessarily 
+# recognized by the MIME-type map
+INCOMPRESSIBLE_EXTS = "gz tgz bz2 tbz2 xz txz zst lz4 lzma h5 hdf5 he5".split()
+
+class CompressionPolicy(object):
+    """
+    a function object that decides whether a file should be compressed as 
+    it is serialized into a bag file.  A file is left uncompressed if it is 
+    of a media type known to be already compressed (according to its file 
+    extension, mapped to a MIME-type in the same way the BagBuilder does 
+    when it sets a file's mediaType) or if its extension appears in a list 
+    of incompressible extensions.
+
+    This class can be configured with the following properties:
+    :prop incompressible_types list:  the media types of files that should 
+                         not be compressed; a type ending in '/' matches all
+                         types starting with it.  Default: INCOMPRESSIBLE_TYPES
+    :prop incompressible_exts list:  additional file extensions (without the 
+                         leading dot) of files that should not be compressed.
+                         Default: INCOMPRESSIBLE_EXTS
+    :prop mime_type_files list:  MIME-type definition files to load in 
+                         addition to the default one (see 
+                         nistoar.pdr.utils.build_mime_type_map()).
+    """
+
+    def __init__(self, config=None):
+        if config is None:
+            config = {}
+        self._types = config.get('incompressible_types', INCOMPRESSIBLE_TYPES)
+        self._exts = set([e.lstrip('.').lower() for e in 
+                          config.get('incompressible_exts', INCOMPRESSIBLE_EXTS)])
+        self._mtfiles = config.get('mime_type_files', [])
+        self._mimetypes = None
+
+    @property
+    def mimetypes(self):
+        """
+        the map of file extensions to MIME-types used by this policy
+        """
+        if self._mimetypes is None:
+            mtfile = pkg_resources.resource_filename('nistoar.pdr',
+                                                     'data/mime.types')
+            self._mimetypes = build_mime_type_map([mtfile] + self._mtfiles)
+        return self._mimetypes
+
+    def is_incompressible_type(self, mediatype):
+        """
+        return True if the given media type is considered already compressed
+        """
+        for t in self._types:
+            if mediatype == t or (t.endswith('/') and mediatype.startswith(t)):
+                return True
+        return False
+
+    def __call__(self, filepath):
+        """
+        return True if the given file should be compressed
+        """
+        ext = os.path.splitext(filepath)[1][1:]
+        if ext.lower() in self._exts:
+            return False
+        mt = self.mimetypes.get(ext, self.mimetypes.get(ext.lower()))
+        return not (mt and self.is_incompressible_type(mt))
+
+_def_policy = None
+
+def default_compression_policy():
+    """
+    return a CompressionPolicy with the default configuration.
+    """
+    global _def_policy
+    if _def_policy is None:
+        _def_policy = CompressionPolicy()
+    return _def_policy
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t[0] < 1980:
+        t = (1980, 1, 1, 0, 0, 0)
+    return ((t[0]-1980) << 9 | t[1] << 5 | t[2],
+            t[3] << 11 | t[4] << 5 | t[5] // 2)
+
+class _HashingWriter(object):
+    # a write-only file wrapper that hashes and counts the bytes written
+    def __init__(self, fd, algorithm='sha256'):
+        self._fd = fd
+        self.hash = hashlib.new(algorithm)
+        self.offset = 0
+
+    def write(self, data):
+        self._fd.write(data)
+        self.hash.update(data)
+        self.offset += len(data)
+
+class _ZipEntry(object):
+    def __init__(self, arcname, st, isdir, compress):
+        self.arcname = arcname
+        self.isdir = isdir
+        self.date, self.time = _dos_datetime(st.st_mtime)
+        self.extattr = (st.st_mode & 0xFFFF) << 16
+        if isdir:
+            self.extattr |= 0x10
+        self.method = (compress and not isdir) and _zf.ZIP_DEFLATED \
+                                                or _zf.ZIP_STORED
+        self.zip64 = st.st_size > ZIP64_LIMIT
+        self.flags = 0
+        if not isdir:
+            self.flags |= 0x08      # sizes & CRC follow in a data descriptor
+        if isinstance(arcname, unicode):
+            try:
+                self.name = arcname.encode('ascii')
+            except UnicodeError:
+                self.name = arcname.encode('utf-8')
+                self.flags |= 0x800
+        else:
+            # keep the bytes of the name as given by the filesystem, flagging
+            # them as UTF-8 only if that is how they decode (as zip does)
+            self.name = arcname
+            try:
+                arcname.decode('ascii')
+            except UnicodeError:
+                try:
+                    arcname.decode('utf-8')
+                    self.flags |= 0x800
+                except UnicodeError:
+                    pass
+        self.offset = 0
+        self.crc = 0
+        self.csize = 0
+        self.size = 0
+
+    @property
+    def version(self):
+        if self.zip64:
+            return ZIP64_VERSION
+        if self.method == _zf.ZIP_DEFLATED or self.isdir:
+            return 20
+        return 10
+
+    def local_header(self):
+        extra = ''
+        csize = size = 0
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            csize = size = 0xFFFFFFFF
+        return struct.pack(_zf.structFileHeader, _zf.stringFileHeader,
+                           self.version, 0, self.flags, self.method,
+                           self.time, self.date, 0, csize, size,
+                           len(self.name), len(extra)) + self.name + extra
+
+    def data_descriptor(self):
+        fmt = self.zip64 and '<4sLQQ' or '<4sLLL'
+        return struct.pack(fmt, 'PK\x07\x08', self.crc, self.csize, self.size)
+
+    def central_header(self):
+        extra = []
+        size, csize, offset = self.size, self.csize, self.offset
+        if self.zip64 or size > ZIP64_LIMIT or csize > ZIP64_LIMIT:
+            extra += [size, csize]
+            size = csize = 0xFFFFFFFF
+        if offset > ZIP64_LIMIT:
+            extra.append(offset)
+            offset = 0xFFFFFFFF
+        if extra:
+            extra = struct.pack('<HH'+len(extra)*'Q', 1, 8*len(extra), *extra)
+        else:
+            extra = ''
+        version = extra and ZIP64_VERSION or self.version
+        return struct.pack(_zf.structCentralDir, _zf.stringCentralDir,
+                           version, 3, version, 0, self.flags, self.method,
+                           self.time, self.date, self.crc, csize, size,
+                           len(self.name), len(extra), 0, 0, 0,
+                           self.extattr, offset) + self.name + extra
+
+def _write_zip_entry(out, entry, filepath, bufsize):
+    entry.offset = out.offset
+    out.write(entry.local_header())
+    if entry.isdir:
+        return
+
+    comp = None
+    if entry.method == _zf.ZIP_DEFLATED:
+        comp = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = 0
+    with open(filepath, 'rb') as fd:
+        while True:
+            data = fd.read(bufsize)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            entry.size += len(data)
+            if comp:
+                data = comp.compress(data)
+            entry.csize += len(data)
+            out.write(data)
+    if comp:
+        data = comp.flush()
+        entry.csize += len(data)
+        out.write(data)
+    entry.crc = crc & 0xFFFFFFFF
+    if entry.size > ZIP64_LIMIT and not entry.zip64:
+        raise BagSerializationError("file grew beyond the zip size limit "+
+                                    "while being serialized: "+filepath)
+    out.write(entry.data_descriptor())
+
+def _write_zip_end(out, entries):
+    cdoffset = out.offset
+    for entry in entries:
+        out.write(entry.central_header())
+    cdsize = out.offset - cdoffset
+
+    count = len(entries)
+    if count > 0xFFFF or cdsize > ZIP64_LIMIT or cdoffset > ZIP64_LIMIT:
+        eocd64 = out.offset
+        out.write(struct.pack(_zf.structEndArchive64, _zf.stringEndArchive64,
+                              44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                              count, count, cdsize, cdoffset))
+        out.write(struct.pack(_zf.structEndArchive64Locator,
+                              _zf.stringEndArchive64Locator, 0, eocd64, 1))
+        count = min(count, 0xFFFF)
+        cdsize = min(cdsize, 0xFFFFFFFF)
+        cdoffset = min(cdoffset, 0xFFFFFFFF)
+    out.write(struct.pack(_zf.structEndArchive, _zf.stringEndArchive,
+                          0, 0, count, count, cdsize, cdoffset, 0))
+
+def write_zip(bagdir, fd, log=None, compress=None, bufsize=ZIP_BUFSIZE):
+    """
+    write the contents of a bag as a zip archive to an open file stream.
+    The archive is written strictly sequentially (file sizes and CRCs are 
+    written in data descriptors after each file's data), so fd need not be
+    seekable.  ZIP64 extensions are used where needed for large files and
+    archives.  The SHA-256 checksum of the output is calculated as it is 
+    written.
+
+    :param bagdir   str:  path to the bag root directory to be serialized;
+                             the archive will contain a single top-level
+                             directory with the bag's name.
+    :param fd      file:  the file stream to write the archive to
+    :param log   Logger:  a logger to write messages to
+    :param compress func: a function that takes a file path and returns True
+                             if the file should be compressed (deflated) or
+                             False if it should be stored as is.  If not 
+                             provided, the default CompressionPolicy will
+                             be used.
+    :param bufsize  int:  the size of the read buffer
+    :return str:  the hex SHA-256 checksum of the written archive
+    """
+    if not compress:
+        compress = default_compression_policy()
+    parent, name = os.path.split(bagdir.rstrip('/'))
+    out = _HashingWriter(fd)
+    entries = []
+
+    for root, dirs, files in os.walk(bagdir):
+        dirs.sort()
+        reldir = os.path.relpath(root, parent).replace(os.sep, '/')
+        entry = _ZipEntry(reldir+'/', os.stat(root), True, False)
+        _write_zip_entry(out, entry, root, bufsize)
+        entries.append(entry)
+
+        for f in sorted(files):
+            filepath = os.path.join(root, f)
+            entry = _ZipEntry(reldir+'/'+f, os.stat(filepath), False,
+                              compress(filepath))
+            _write_zip_entry(out, entry, filepath, bufsize)
+            entries.append(entry)
+
+    _write_zip_end(out, entries)
+    if log:
+        log.debug("wrote %d entries (%d bytes) to zip for %s",
+                  len(entries), out.offset, name)
+    return out.hash.hexdigest()
+
+def zipstream_serialize(bagdir, destdir, log, destfile=None, compress=None):
+    """
+    serialize a bag into a zip file, natively (i.e. without an external
+    zip program).  The file is written under a temporary name in the 
+    destination directory and renamed on success, so the destination may
+    be the final storage location.  The checksum of the serialized file is 
+    calculated as it is written.
+
+    :param bagdir   str:  path to the bag root directory to be serialized
+    :param destdir  str:  path to the output directory to write serialized 
+                             file to.  
+    :param log   Logger:  a logger to write messages to
+    :param destfile str:  the name to give to the serialized file.  If not 
+                             provided, one will be constructed from the 
+                             bag directory name (and an appropriate extension)
+    :param compress func: a function that decides whether a file should be 
+                             compressed (see write_zip())
+    :return tuple:  the path to the serialized file and its SHA-256 checksum
+    """
+    parent, name = os.path.split(bagdir)
+    if not destfile:
+        destfile = name+'.zip'
+    destfile = os.path.join(destdir, destfile)
+
+    if not os.path.exists(bagdir):
+        raise StateException("Can't serialize missing bag directory: "+bagdir)
+    if not os.path.exists(destdir):
+        raise StateException("Can't serialize to missing destination directory: "
+                             +destdir)
+
+    log.info("serializing bag to zip: %s", os.path.basename(destfile))
+    partfile = destfile + ".part"
+    try:
+        with open(partfile, 'wb') as fd:
+            csum = write_zip(bagdir, fd, log, compress)
+        os.rename(partfile, destfile)
+    except (IOError, OSError, BagSerializationError), ex:
+        if os.path.exists(partfile):
+            try:
+                os.remove(partfile)
+            except Exception:
+                pass
+        if isinstance(ex, BagSerializationError):
+            raise
+        raise BagSerializationError("Bag serialization failure writing zip: "+
+                                    str(ex), name, ex, sys=_sys)
+
+    return destfile, csum
+
 def zip7_serialize(bagdir, destdir, log, destfile=None):
     """
     serialize a bag with 7zip
@@ -122,12 +466,21 @@ class Serializer(object):
     by a given name.  
     """
 
-    def __init__(self, typefunc=None, log=None):
+    def __init__(self, typefunc=None, log=None, hashed=None):
         """
+        :param typefunc dict:  a mapping of format names to serialization
+                               functions
+        :param log   Logger:   the default logger to send messages to
+        :param hashed  list:   the names of the formats in typefunc whose 
+                               functions return the checksum of the output
+                               file (see register())
         """
         self._map = {}
+        self._hashed = set()
         if typefunc:
             self._map.update(typefunc)
+        if hashed:
+            self._hashed.update(hashed)
         self.log = log
 
     def setLog(self, log):
@@ -140,7 +493,7 @@ class Serializer(object):
         """
         return self._map.keys()
 
-    def register(self, format, serfunc):
+    def register(self, format, serfunc, hashed=False):
         """
         register a serialization function to make available via this serializer.
         The provided function must take 3 arguments:
@@ -152,16 +505,21 @@ class Serializer(object):
                              format.
         :param serfunc func:  the serializaiton function to associate with this
                            name.  
+        :param hashed bool:  if True, the function calculates the SHA-256 
+                           checksum of the output file as it writes it and
+                           returns a tuple of the output file path and 
+                           the checksum; otherwise, it returns just the path.
         """
-        if not isinstance(serfunc, func):
+        if not callable(serfunc):
             raise TypeError("Serializer.register(): serfunc is not a function: "+
-                            str(func))
+                            str(serfunc))
         self._map[format] = serfunc
+        if hashed:
+            self._hashed.add(format)
+        else:
+            self._hashed.discard(format)
 
-    def serialize(self, bagdir, destdir, format, log=None):
-        """
-        serialize a bag using the named serialization format
-        """
+    def _serialize(self, bagdir, destdir, format, log):
         if format not in self._map:
             raise BagSerializationError("Serialization format not supported: "+
                                         str(format))
@@ -173,13 +531,49 @@ class Serializer(object):
                               getChild(_sys.subsystem_abbrev)
         return self._map[format](bagdir, destdir, log)
 
+    def serialize(self, bagdir, destdir, format, log=None):
+        """
+        serialize a bag using the named serialization format
+        """
+        out = self._serialize(bagdir, destdir, format, log)
+        if format in self._hashed:
+            out = out[0]
+        return out
+
+    def serialize_with_checksum(self, bagdir, destdir, format, log=None):
+        """
+        serialize a bag using the named serialization format and return 
+        the path to the output file along with its SHA-256 checksum.  If the 
+        format's serialization function calculates the checksum as it writes
+        (as the native zip serializer does), the output file is not re-read.
+
+        :return tuple:  the path to the serialized file and its checksum
+        """
+        out = self._serialize(bagdir, destdir, format, log)
+        if format not in self._hashed:
+            out = (out, checksum_of(out))
+        return out
+
 class DefaultSerializer(Serializer):
     """
     a Serializer configured for some default serialization formats: zip, 7z.
+    The zip format is produced natively (see zipstream_serialize()), leaving
+    already-compressed files uncompressed.
+
+    This class can be configured with the following properties:
+    :prop compression dict:  the configuration for the CompressionPolicy 
+                             that decides which files are compressed in zip 
+                             serializations.
     """
 
-    def __init__(self, log=None):
+    def __init__(self, log=None, config=None):
+        if config is None:
+            config = {}
+        compress = default_compression_policy()
+        if config.get('compression'):
+            compress = CompressionPolicy(config['compression'])
+
         super(DefaultSerializer, self).__init__({
-            "zip": zip_serialize,
+            "zip": partial(zipstream_serialize, compress=compress),
             "7z": zip7_serialize
-        }, log)
+        }, log, ["zip"])
@@ -1,27 +1,65 @@
 """
 This module implements a validator for the base BagIt standard
 """
-import os, re
+import os, re, time, logging
 from collections import OrderedDict
 from urlparse import urlparse
 
 from .base import (Validator, ValidatorBase, ALL, ValidationResults,
                    ERROR, WARN, REC, ALL, PROB)
 from ..bag import NISTBag
-from ....utils import checksum_of
+from ....utils import checksum_of, checksums_of
 
 csfunctions = {
     "sha256":  checksum_of
 }
 
+# checksum functions that can be calculated for many files in parallel; 
+# each takes a list of files and the number of parallel workers and returns
+# an iterator of (filepath, checksum) pairs
+batch_csfunctions = {
+    "sha256":  checksums_of
+}
+
+log = logging.getLogger(__name__)
+
 class BagItValidator(ValidatorBase):
     """
     A validator that runs tests for compliance to the base BagIt standard
+
+    This validator supports the following configuration parameters:
+    :prop test_manifest dict:  parameters for the manifest tests, including
+        :prop check_checksums bool (True):  if False, do not verify the 
+                         checksums of the files listed in the tag manifests
+        :prop checksum_workers int:  the number of files to checksum in 
+                         parallel; if not set, the number of CPUs is used.
+        :prop stop_on_failure bool (False):  if True, stop verifying a 
+                         manifest's checksums after the first failure is 
+                         found (for when only a pass/fail result is needed).
+                         (The want argument to the tests selects which types
+                         of issues matter, not how much detail is needed, so
+                         this choice is made via configuration.  Checksums 
+                         are not verified at all when want excludes ERROR, 
+                         as only an error can result.)
+        :prop progress_interval float (60):  the minimum number of seconds
+                         between reports of checksum verification progress 
     """
     profile = ("BagIt", "v0.97")
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, progress=None):
+        """
+        create the validator
+
+        :param dict config:  the validator configuration
+        :param progress:     a function to call to report progress while 
+                             verifying checksums; it is called with the name 
+                             of the manifest, the number of files verified 
+                             so far, the total number to verify, the number of 
+                             bytes verified, and the total number of bytes.  
+                             If not provided, progress is logged.
+        """
         super(BagItValidator, self).__init__(config)
+        self.progress = progress
 
     def test_bagit_txt(self, bag, want=ALL, results=None):
         """
@@ -73,7 +111,7 @@ class BagItValidator(ValidatorBase):
             out = ValidationResults(bag.name, want)
 
         t = self._issue("2.1.2", "Bag must contain payload directory, data/")
-        out._err(t, os.path.exists(os.path.join(bag.dir, "data")))
+        out._err(t, self._inventory(bag).exists(os.path.join(bag.dir, "data")))
 
         return out
 
@@ -96,8 +134,9 @@ class BagItValidator(ValidatorBase):
         return self._test_manifest(bag, "tagmanifest", check, out, want)
 
     def _test_manifest(self, bag, basename, check, out, want=ALL):
+        inv = self._inventory(bag)
         manire = re.compile(r'^{0}-(\w+).txt$'.format(basename))
-        manifests = [f for f in os.listdir(bag.dir) if manire.match(f)]
+        manifests = [f for f in inv.listdir(bag.dir) if manire.match(f)]
 
         if basename == "manifest":
             t = self._issue("2.1.3-1", "Bag requires at least one "+
@@ -112,6 +151,7 @@ class BagItValidator(ValidatorBase):
             csfunc = None
             if alg in csfunctions:
                 csfunc = csfunctions[alg]
+            batchfunc = batch_csfunctions.get(alg)
 
             badlines = []
             notdata = []
@@ -164,9 +204,9 @@ class BagItValidator(ValidatorBase):
             notafile = []
             for datap in paths:
                 fp = os.path.join(bag.dir, datap)
-                if not os.path.exists(fp):
+                if not inv.exists(fp):
                     missing.append(datap)
-                elif not os.path.isfile(fp):
+                elif not inv.isfile(fp):
                     notafile.append(datap)
 
             t = self._issue("2.1.3-7", "Manifest must list only files")
@@ -191,9 +231,10 @@ class BagItValidator(ValidatorBase):
             # check that all files in the payload are listed in the manifest
             notfound = []
             failed = []
+            tocheck = []
             if check or basename == "manifest":
               top = (basename == "manifest" and bag.data_dir) or bag.dir
-              for root, subdirs, files in os.walk(top):
+              for root, subdirs, files in inv.walk(top):
                 for f in files:
                     fp = os.path.join(root, f)
                     assert fp.startswith(bag.dir+'/')
@@ -202,8 +243,17 @@ class BagItValidator(ValidatorBase):
                     if datap not in paths:
                         if basename == "manifest":
                             notfound.append(datap)
-                    elif check and csfunc and csfunc(fp) != paths[datap]:
-                        failed.append(datap)
+                    elif check and csfunc:
+                        tocheck.append(fp)
+
+            if tocheck and (want & ERROR):
+                failed = self._verify_checksums(bag, mfile, tocheck, paths,
+                                                csfunc, batchfunc)
+
+                # report failures in the order they were found in the bag
+                order = dict([(fp[len(bag.dir)+1:], i)
+                              for i, fp in enumerate(tocheck)])
+                failed.sort(key=lambda p: order[p])
 
             t = self._issue("2.1.3-4",
                      "All payload files must be listed in at least one manifest")
@@ -226,6 +276,52 @@ class BagItValidator(ValidatorBase):
 
         return out
             
+    def _verify_checksums(self, bag, mfile, tocheck, paths, csfunc,
+                          batchfunc=None):
+        # verify the checksums of the given files against those listed in 
+        # the manifest, returning the bag-relative paths of the files that 
+        # fail.  The largest files are started first so that the work is 
+        # evenly spread across the workers.
+        tcfg = self.cfg.get("test_manifest", {})
+        stoponfail = tcfg.get('stop_on_failure', False)
+        interval = tcfg.get('progress_interval', 60)
+
+        inv = self._inventory(bag)
+        sizes = dict([(fp, inv.stat(fp).st_size) for fp in tocheck])
+        tocheck = sorted(tocheck, key=lambda f: sizes[f], reverse=True)
+        totbytes = sum(sizes.values())
+
+        if batchfunc:
+            sums = batchfunc(tocheck, tcfg.get('checksum_workers'))
+        else:
+            sums = ((fp, csfunc(fp)) for fp in tocheck)
+
+        failed = []
+        nfiles = nbytes = 0
+        last = time.time()
+        try:
+            for fp, cs in sums:
+                nfiles += 1
+                nbytes += sizes[fp]
+                if self.progress:
+                    self.progress(mfile, nfiles, len(tocheck), nbytes, totbytes)
+                elif time.time() - last >= interval:
+                    last = time.time()
+                    log.info("%s: %s: verified %d of %d files (%d of %d bytes)",
+                             bag.name, mfile, nfiles, len(tocheck),
+                             nbytes, totbytes)
+
+                if cs != paths[fp[len(bag.dir)+1:]]:
+                    failed.append(fp[len(bag.dir)+1:])
+                    if stoponfail:
+                        break
+        finally:
+            if hasattr(sums, 'close'):
+                # stop any remaining checksum calculations
+                sums.close()
+
+        return failed
+
     def test_baginfo(self, bag, want=ALL, results=None):
         out = results
         if not out:
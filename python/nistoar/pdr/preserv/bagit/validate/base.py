@@ -1,6 +1,7 @@
 """
 This module provides the base validator class
 """
+import os, json, errno, threading
 from abc import ABCMeta, abstractmethod, abstractproperty
 from collections import Sequence, OrderedDict
 
@@ -359,6 +360,137 @@ class ValidationIssue(object):
         return ValidationIssue(data[1], data[2], data[3], data[0], 
                                data[4], data[5], data[6])
 
+class BagInventory(object):
+    """
+    a snapshot of the contents of a bag's directory tree, taken with a single
+    walk of the tree, that can be shared by validation tests so that each 
+    need not walk the tree (or read the same files) itself.  The status of 
+    files (via stat()) and the parsed contents of JSON files (via 
+    read_json()) are loaded lazily when first requested and then remembered.
+
+    Paths passed to this class's methods are expected to be within the bag 
+    (i.e. start with the bag directory path, dir); other paths are looked up 
+    directly on disk.  
+    """
+
+    def __init__(self, bagdir):
+        """
+        take the snapshot
+
+        :param str bagdir:  the path to the bag's root directory
+        """
+        self.dir = bagdir
+        self._root = os.path.normpath(bagdir)
+        self._tree = {}
+        self._files = set()
+        self._stats = {}
+        self._json = {}
+        self._lock = threading.Lock()
+
+        for root, subdirs, files in os.walk(bagdir):
+            root = os.path.normpath(root)
+            self._tree[root] = (list(subdirs), list(files))
+            self._files.update([os.path.join(root, f) for f in files])
+
+    def _inside(self, path):
+        return path == self._root or path.startswith(self._root+os.sep)
+
+    def isdir(self, path):
+        """
+        return True if the given path is a directory (or a link to one)
+        """
+        path = os.path.normpath(path)
+        if not self._inside(path):
+            return os.path.isdir(path)
+        if path in self._tree:
+            return True
+        parent, name = os.path.split(path)
+        return parent in self._tree and name in self._tree[parent][0]
+
+    def isfile(self, path):
+        """
+        return True if the given path is a file
+        """
+        path = os.path.normpath(path)
+        if not self._inside(path):
+            return os.path.isfile(path)
+        return path in self._files
+
+    def exists(self, path):
+        """
+        return True if the given path exists
+        """
+        return self.isfile(path) or self.isdir(path)
+
+    def listdir(self, path):
+        """
+        return the names of the entries in the given directory
+        """
+        npath = os.path.normpath(path)
+        if not self._inside(npath):
+            return os.listdir(path)
+        if npath not in self._tree:
+            raise OSError(errno.ENOENT, "No such directory", path)
+        return self._tree[npath][0] + self._tree[npath][1]
+
+    def walk(self, top):
+        """
+        iterate through the directory tree below the given directory, like 
+        os.walk() (in top-down fashion).
+        """
+        ntop = os.path.normpath(top)
+        if not self._inside(ntop):
+            for out in os.walk(top):
+                yield out
+            return
+        if ntop not in self._tree:
+            return
+
+        subdirs, files = self._tree[ntop]
+        subdirs = list(subdirs)
+        yield top, subdirs, list(files)
+        for d in subdirs:
+            for out in self.walk(os.path.join(top, d)):
+                yield out
+
+    def stat(self, path):
+        """
+        return the os.stat() result for the given file
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            if path in self._stats:
+                return self._stats[path]
+        out = os.stat(path)
+        with self._lock:
+            self._stats[path] = out
+        return out
+
+    def read_json(self, path):
+        """
+        return the parsed contents of the given JSON file.  The file is only
+        read once; thus, the returned data should not be modified.  
+        :raise ValueError:  if the file does not contain legal JSON
+        :raise IOError:     if the file cannot be read
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            cached = self._json.get(path)
+        if cached is None:
+            try:
+                with open(path) as fd:
+                    cached = (json.load(fd, object_pairs_hook=OrderedDict),
+                              None)
+            except (ValueError, IOError) as ex:
+                cached = (None, ex)
+            with self._lock:
+                self._json[path] = cached
+
+        if cached[1]:
+            raise cached[1]
+        return cached[0]
+
+
 class AggregatedValidator(Validator):
     """
     a Validator class that combines several validators together
@@ -372,8 +504,14 @@ class AggregatedValidator(Validator):
         if not out:
             out = ValidationResults(bag.name, want)
 
+        # let all of the validators share one snapshot of the bag
+        inv = kw.get('inventory')
+        if inv is None or inv.dir != bag.dir:
+            inv = BagInventory(bag.dir)
+        kw['inventory'] = inv
+
         for v in self._vals:
-            v.validate(bag, want, out)
+            v.validate(bag, want, out, **kw)
         return out
 
 
@@ -384,11 +522,15 @@ class ValidatorBase(Validator):
     This validator will recognizes all methods that begin with "test_" as
     test that can return a list of errors.  The method should accept a 
     NISTBag instance as its first argument.  
+
+    During a call to validate(), the test methods can get a snapshot of the 
+    bag's contents, shared by all of the tests, via _inventory().  
     """
     profile = (None, None)
     
     def __init__(self, config):
         super(ValidatorBase, self).__init__(config)
+        self._current = threading.local()
 
     def the_test_methods(self):
         """
@@ -421,25 +563,57 @@ class ValidatorBase(Validator):
         """
         return [name for name in dir(self) if name.startswith('test_')]
 
-    def validate(self, bag, want=ALL, results=None, *kw):
+    def validate(self, bag, want=ALL, results=None, **kw):
+        """
+        run this validator's tests on the given bag.
+
+        :param NISTBag bag:  the bag to validate
+        :param int want:     the types of issues to record
+        :param ValidationResults results:  the results object to add results
+                             to; if not provided, a new one is created.
+        :param BagInventory inventory:  (keyword only) a snapshot of the bag's
+                             contents to use; if not provided, one will be
+                             taken and shared by all of the tests.
+        """
         out = results
         if not out:
             out = ValidationResults(bag.name, want)
 
-        for test in self.the_test_methods():
-            try:
-                getattr(self, test)(bag, want, out) 
-            except Exception, ex:
-                out._err( ValidationIssue(self.profile[0], self.profile[1],
-                                          "validator failure", ERROR, 
+        inv = kw.get('inventory')
+        if inv is None or inv.dir != bag.dir:
+            inv = BagInventory(bag.dir)
+        prev = getattr(self._current, 'inventory', None)
+        self._current.inventory = inv
+
+        try:
+            for test in self.the_test_methods():
+                try:
+                    getattr(self, test)(bag, want, out) 
+                except Exception, ex:
+                    out._err( ValidationIssue(self.profile[0], self.profile[1],
+                                              "validator failure", ERROR, 
                                      "test method, {0}, raised an exception: {1}"
-                                            .format(test, str(ex)), False),
-                          False )
+                                                .format(test, str(ex)), False),
+                              False )
+        finally:
+            self._current.inventory = prev
         return out
 
+    def _inventory(self, bag):
+        """
+        return a snapshot of the given bag's contents.  If called while the 
+        bag is being validated via validate(), the snapshot shared by all the 
+        tests is returned; otherwise, a new one is taken.  
+        """
+        inv = getattr(self._current, 'inventory', None)
+        if inv is None or inv.dir != bag.dir:
+            inv = BagInventory(bag.dir)
+        return inv
+
     def _list_payload_files(self, bag):
         out = set()
-        for root, subdirs, files in os.walk(os.path.join(bag.dir, "data")):
+        datadir = os.path.join(bag.dir, "data")
+        for root, subdirs, files in self._inventory(bag).walk(datadir):
             root = root[len(bag.dir)+1:]
             out.update([os.path.join(root, f) for f in files])
         return out
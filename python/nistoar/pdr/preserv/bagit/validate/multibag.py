@@ -329,6 +329,7 @@ class MultibagValidator(ValidatorBase):
         if t.failed():
             return out
 
+        inv = self._inventory(bag)
         badfmt = []
         replicated = []
         missing = []
@@ -346,7 +347,7 @@ class MultibagValidator(ValidatorBase):
                     badfmt.append(i)
 
                 if len(parts) > 1 and parts[1] == bag.name and \
-                   not os.path.isfile(os.path.join(bag.dir, parts[0])):
+                   not inv.isfile(os.path.join(bag.dir, parts[0])):
                     missing.append(i)
 
         t = self._issue("3.2-1", "file-lookup.tsv lines must match format, "+
@@ -384,7 +385,7 @@ class MultibagValidator(ValidatorBase):
         
         # get a list of the payload files
         missing = []
-        for root, subdirs, files in os.walk(bag.data_dir):
+        for root, subdirs, files in self._inventory(bag).walk(bag.data_dir):
             for f in files:
                 if f.startswith(".") or f.startswith("_"):
                     continue
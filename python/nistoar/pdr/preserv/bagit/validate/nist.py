@@ -1,8 +1,10 @@
 """
 This module implements a validator for the NIST-generated bags
 """
-import os, re, json
+import os, re, json, threading, multiprocessing, atexit
 from collections import OrderedDict, Mapping
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
 import ejsonschema as ejs
@@ -23,6 +25,140 @@ DEF_NERDM_SUBCOLL_SCHEMA = DEF_PUB_NERDM_SCHEMA + "/definitions/Subcollection"
 DEF_BASE_POD_SCHEMA = "https://data.nist.gov/od/dm/pod-schema/v1.1#"
 DEF_POD_DATASET_SCHEMA = DEF_BASE_POD_SCHEMA + "/definitions/Dataset"
 
+# compiled schema validators that are not currently in use, keyed by schema 
+# directory and extension prefix
+_validators = {}
+_validators_lock = threading.Lock()
+
+# process pools for validating component metadata, keyed by schema directory
+# and number of processes.  Each pool process keeps its own cache of compiled
+# validators for as long as the pool lives.  Each entry is a dictionary 
+# holding the pool, the number of validations currently using it, a count
+# of its uses, and the timer that will close the pool once it has been idle 
+# for a while.
+_pools = {}
+_pools_lock = threading.Lock()
+
+# the default number of seconds a validation pool may sit unused before it 
+# is closed
+DEF_POOL_IDLE_TIMEOUT = 60
+
+@contextmanager
+def schema_validator(schemadir, ejsprefix):
+    """
+    check out a compiled schema validator for the schemas in a given 
+    directory for use in a with statement.  Loading and compiling the schemas
+    is expensive, so validators are cached for reuse across the process.  A 
+    validator is not safe to use in more than one thread at a time; thus, 
+    while it is checked out, no other thread will be given the same 
+    validator (it will instead get one of its own).
+
+    :param str schemadir:  the directory containing the schemas to load
+    :param str ejsprefix:  the prefix used to mark the schema extension 
+                           properties (e.g. "_" or "$")
+    """
+    key = (os.path.abspath(schemadir), ejsprefix)
+    with _validators_lock:
+        idle = _validators.setdefault(key, [])
+        val = (idle and idle.pop()) or None
+    if val is None:
+        val = ejs.ExtValidator.with_schema_dir(schemadir, ejsprefix=ejsprefix)
+
+    try:
+        yield val
+    finally:
+        with _validators_lock:
+            _validators.setdefault(key, []).append(val)
+
+def clear_schema_validators():
+    """
+    discard all cached schema validators (e.g. because the schemas on disk
+    have changed).  This also shuts down the process pools used for 
+    validation, as their processes hold validators of their own.
+    """
+    with _validators_lock:
+        _validators.clear()
+    _close_validation_pools()
+
+def _close_validation_pools():
+    # shut down all of the validation process pools
+    with _pools_lock:
+        ents = list(_pools.values())
+        _pools.clear()
+    for ent in ents:
+        _cancel_reaper(ent)
+        ent['pool'].terminate()
+        ent['pool'].join()
+
+def _cancel_reaper(ent):
+    reaper = ent.get('reaper')
+    if reaper and reaper is not threading.current_thread():
+        reaper.cancel()
+        reaper.join()
+
+atexit.register(_close_validation_pools)
+
+def _init_validation_process(schemadir):
+    # initialize a validation pool process:  make sure its validator cache 
+    # is usable (the lock may have been held by another thread when the 
+    # process was forked) and warm.
+    global _validators_lock
+    _validators_lock = threading.Lock()
+    for flav in "_ $".split():
+        with schema_validator(schemadir, flav):
+            pass
+
+@contextmanager
+def _validation_pool(schemadir, nproc, idle_timeout=DEF_POOL_IDLE_TIMEOUT):
+    # check out the process pool for validating against the schemas in the 
+    # given directory, creating it on first use, for use in a with statement.
+    # Once the pool has gone unused for idle_timeout seconds, it is closed
+    # (never, if idle_timeout is None).
+    key = (os.path.abspath(schemadir), nproc)
+    with _pools_lock:
+        ent = _pools.get(key)
+        if ent is None:
+            ent = { 'users': 0, 'uses': 0, 'reaper': None,
+                    'pool': multiprocessing.Pool(nproc, _init_validation_process,
+                                                 (schemadir,)) }
+            _pools[key] = ent
+        ent['users'] += 1
+
+    try:
+        yield ent['pool']
+    finally:
+        with _pools_lock:
+            ent['users'] -= 1
+            ent['uses'] += 1
+            if ent['reaper']:
+                ent['reaper'].cancel()
+                ent['reaper'] = None
+            if idle_timeout is not None:
+                ent['reaper'] = threading.Timer(idle_timeout, _close_idle_pool,
+                                                (key, ent, ent['uses']))
+                ent['reaper'].daemon = True
+                ent['reaper'].start()
+
+def _close_idle_pool(key, ent, uses):
+    # close the given pool if it has not been used since it had the given 
+    # number of uses
+    with _pools_lock:
+        if ent['users'] > 0 or ent['uses'] != uses or _pools.get(key) is not ent:
+            return
+        del _pools[key]
+    ent['pool'].terminate()
+    ent['pool'].join()
+
+def _validate_comp(args):
+    # validate component metadata against its schema, returning the error
+    # messages; this is a module function so that it can be run in a process 
+    # pool.
+    schemadir, flav, data, schemauri = args
+    with schema_validator(schemadir, flav) as val:
+        verrs = val.validate(data, schemauri=schemauri, strict=True,
+                             raiseex=False)
+    return [str(e) for e in (verrs or [])]
+
 
 class NISTBagValidator(ValidatorBase):
     """
@@ -30,6 +166,23 @@ class NISTBagValidator(ValidatorBase):
     Profile.  Specifically, this validator only covers the NIST Profile-specific
     parts (excluding Multibag and basic BagIt compliance; see 
     NISTAIPValidator)
+
+    This validator supports the following configuration parameters:
+    :prop validate_metadata bool (True):  if False, do not validate the NERDm
+                         metadata against its schemas
+    :prop nerdm_schema_dir str:  the directory containing the NERDm schemas
+    :prop validation_workers int (1):  the number of components to validate
+                         against the schemas in parallel
+    :prop validation_processes bool (False):  if True, validate components 
+                         in a pool of separate processes rather than threads
+                         (which, as validation is CPU-bound, can be more 
+                         effective for large bags).  The pool is created on 
+                         first use and shared by all validators in the 
+                         process using the same schemas and number of 
+                         workers.
+    :prop validation_pool_idle float (60):  the number of seconds the process
+                         pool may go unused before it is shut down (to be 
+                         recreated when next needed).  
     """
     namere02 = re.compile("^(\w[\w\-]*).mbag(\d+)_(\d+)-(\d+)$")
     namere04 = re.compile("^(\w[\w\-]*).(\d+(_\d+)*).mbag(\d+)_(\d+)-(\d+)$")
@@ -37,7 +190,7 @@ class NISTBagValidator(ValidatorBase):
     def __init__(self, config=None, profver="0.4"):
         super(NISTBagValidator, self).__init__(config)
         self._validatemd = self.cfg.get('validate_metadata', True)
-        self.mdval = None
+        self._schemadir = None
         self.profile = ("NIST", profver)
         if self._validatemd:
             schemadir = self.cfg.get('nerdm_schema_dir', pdr.def_schema_dir)
@@ -47,10 +200,13 @@ class NISTBagValidator(ValidatorBase):
             if not os.path.exists(schemadir):
                 raise ConfigurationException("nerdm_schema_dir directory does "+
                                              "exist: " + schemadir)
-            self.mdval = {
-                "_": ejs.ExtValidator.with_schema_dir(schemadir, ejsprefix='_'),
-                "$": ejs.ExtValidator.with_schema_dir(schemadir, ejsprefix='$')
-            }
+            self._schemadir = schemadir
+
+            # load the schemas now (if not already cached) so that problems 
+            # with them are detected up front
+            for flav in "_ $".split():
+                with schema_validator(schemadir, flav):
+                    pass
 
     def test_name(self, bag, want=ALL, results=None):
         """
@@ -174,8 +330,7 @@ class NISTBagValidator(ValidatorBase):
         try:
             # if this fails, don't bother reporting it as another test
             # will
-            with open(mdfile) as fd:
-                data = json.load(fd)
+            data = self._inventory(bag).read_json(mdfile)
 
             version = data.get('version')
             
@@ -253,7 +408,8 @@ class NISTBagValidator(ValidatorBase):
             t = self._issue(label,
                             "File given in value of '{0}' must exist as a file"
                             .format(elname))
-            out._err(t, os.path.isfile(os.path.join(bag.dir,data[elname][-1])))
+            out._err(t, self._inventory(bag).isfile(os.path.join(bag.dir,
+                                                          data[elname][-1])))
 
         return out
 
@@ -267,7 +423,8 @@ class NISTBagValidator(ValidatorBase):
 
         t = self._issue("4.1-1",
                         "Bag must have a tag directory named 'metadata'")
-        out._err(t, os.path.isdir(os.path.join(bag.dir, "metadata")))
+        out._err(t, self._inventory(bag).isdir(os.path.join(bag.dir,
+                                                            "metadata")))
 
         return out
 
@@ -282,15 +439,15 @@ class NISTBagValidator(ValidatorBase):
         
         t = self._issue("4.1-2-0",
                         "Metadata tag directory must contain the file, pod.json")
-        out._err(t, os.path.isfile(podfile))
+        inv = self._inventory(bag)
+        out._err(t, inv.isfile(podfile))
         if t.failed():
             return out
 
         t = self._issue("4.1-2-1",
                         "pod.json must contain a legal POD Dataset record") 
         try:
-            with open(podfile) as fd:
-                data = json.load(fd)
+            data = inv.read_json(podfile)
         except Exception as ex:
             comm = ["Failed reading JSON file: "+str(ex)]
             out._err(t, False, comm)
@@ -302,8 +459,9 @@ class NISTBagValidator(ValidatorBase):
             schemauri = data.get(flav+"schema")
             if not schemauri:
                 schemauri = DEF_POD_DATASET_SCHEMA
-            verrs = self.mdval[flav].validate(data, schemauri=schemauri,
-                                              strict=True, raiseex=False)
+            with schema_validator(self._schemadir, flav) as mdval:
+                verrs = mdval.validate(data, schemauri=schemauri,
+                                       strict=True, raiseex=False)
             if verrs:
                 s = (len(verrs) > 1 and "s") or ""
                 comm = ["{0} validation error{1} detected"
@@ -339,15 +497,15 @@ class NISTBagValidator(ValidatorBase):
         
         t = self._issue("4.1-3-0",
                       "Metadata tag directory must contain the file, nerdm.json")
-        out._err(t, os.path.isfile(mdfile))
+        inv = self._inventory(bag)
+        out._err(t, inv.isfile(mdfile))
         if t.failed():
             return out
 
         t = self._issue("4.1-3-1",
                "metadata/nerdm.json must contain a legal NERDm Resource record") 
         try:
-            with open(mdfile) as fd:
-                data = json.load(fd)
+            data = inv.read_json(mdfile)
         except Exception as ex:
             comm = ["Failed reading JSON file: "+str(ex)]
             out._err(t, False, comm)
@@ -358,8 +516,9 @@ class NISTBagValidator(ValidatorBase):
             schemauri = data.get(flav+"schema")
             if not schemauri:
                 schemauri = DEF_NERDM_RESOURCE_SCHEMA
-            verrs = self.mdval[flav].validate(data, schemauri=schemauri,
-                                              strict=True, raiseex=False)
+            with schema_validator(self._schemadir, flav) as mdval:
+                verrs = mdval.validate(data, schemauri=schemauri,
+                                       strict=True, raiseex=False)
             comm = None
             if verrs:
                 s = (len(verrs) > 1 and "s") or ""
@@ -388,6 +547,7 @@ class NISTBagValidator(ValidatorBase):
             out = ValidationResults(bag.name, want)
         metadir = os.path.join(bag.dir, "metadata")
         datadir = os.path.join(bag.dir, "data")
+        inv = self._inventory(bag)
 
         dotdir   = []
         dotfile  = []
@@ -396,7 +556,7 @@ class NISTBagValidator(ValidatorBase):
         dnotadir = []
         fnotadir = []
         nonerd   = []
-        for root, subdirs, files in os.walk(datadir):
+        for root, subdirs, files in inv.walk(datadir):
             for dir in subdirs:
                 path = os.path.join(root[len(datadir)-5:], dir)
                 if dir.startswith('.'):
@@ -404,11 +564,11 @@ class NISTBagValidator(ValidatorBase):
                     continue
                 dir = os.path.join(root, dir)
                 mdir = os.path.join(metadir, dir[len(datadir)+1:])
-                if not os.path.exists(mdir):
+                if not inv.exists(mdir):
                     misngdir.append(path)
-                elif not os.path.isdir(mdir):
+                elif not inv.isdir(mdir):
                     dnotadir.append("meta"+path)
-                elif not os.path.exists(os.path.join(mdir,"nerdm.json")):
+                elif not inv.exists(os.path.join(mdir,"nerdm.json")):
                     nonerd.append("meta"+path)
 
             for f in files:
@@ -417,11 +577,11 @@ class NISTBagValidator(ValidatorBase):
                     dotfile.append(path)
                     continue
                 f = os.path.join(metadir, root[len(datadir)+1:], f)
-                if not os.path.exists(f):
+                if not inv.exists(f):
                     misngfil.append(path)
-                elif not os.path.isdir(f):
+                elif not inv.isdir(f):
                     fnotadir.append("meta"+path)
-                elif not os.path.exists(os.path.join(f,"nerdm.json")):
+                elif not inv.exists(os.path.join(f,"nerdm.json")):
                     nonerd.append("meta"+path)
 
         t = self._issue("4.1-4-5", "Data directory should not contain files "+
@@ -501,14 +661,16 @@ class NISTBagValidator(ValidatorBase):
                          "of @type=nrdp:Subcollection.")
         kt = self._issue("4.1-4-2e", "_schema and @context fields recommended "+
                          "for inclusion in component NERDm data file")
-        for root, subdirs, files in os.walk(datadir):
+        inv = self._inventory(bag)
+        tovalidate = []
+        for root, subdirs, files in inv.walk(datadir):
             for f in files:
                 path = os.path.join(root[len(datadir):], f)
                 mdf = os.path.join(metadir, path, "nerdm.json")
-                if not os.path.isfile(mdf):
+                if not inv.isfile(mdf):
                     continue
 
-                data = self._check_comp_legal(mdf, path, out)
+                data = self._check_comp_legal(mdf, path, out, inv)
                 if data is None:
                     continue
 
@@ -528,27 +690,15 @@ class NISTBagValidator(ValidatorBase):
                 out._rec(kt, ok, comm)
 
                 if self._validatemd:
-                    flav = self._get_mdval_flavor(data)
-                    schemauri = data.get(flav+"schema")
-                    if not schemauri:
-                        schemauri = DEF_NERDM_DATAFILE_SCHEMA
-                    verrs = self.mdval[flav].validate(data, schemauri=schemauri,
-                                                      strict=True, raiseex=False)
-                    comm = None
-                    if verrs:
-                        s = (len(verrs) > 1 and "s") or ""
-                        comm = ["{0} validation error{1} detected"
-                                .format(len(verrs), s)]
-                        comm += [str(e) for e in verrs]
-                    out._err(vt, not comm, comm)
+                    tovalidate.append((data, DEF_NERDM_DATAFILE_SCHEMA))
             
             for d in subdirs:
                 path = os.path.join(root[len(datadir):], d)
                 mdf = os.path.join(metadir, path, "nerdm.json")
-                if not os.path.isfile(mdf):
+                if not inv.isfile(mdf):
                     continue
 
-                data = self._check_comp_legal(mdf, path, out)
+                data = self._check_comp_legal(mdf, path, out, inv)
                 if data is None:
                     continue
 
@@ -559,30 +709,62 @@ class NISTBagValidator(ValidatorBase):
                 out._err(ct, ok, comm)
 
                 if self._validatemd:
-                    flav = self._get_mdval_flavor(data)
-                    schemauri = data.get(flav+"schema")
-                    if not schemauri:
-                        schemauri = DEF_NERDM_SUBCOLL_SCHEMA
-                    verrs = self.mdval[flav].validate(data, schemauri=schemauri,
-                                                      strict=True, raiseex=False)
-                    comm = None
-                    if verrs:
-                        s = (len(verrs) > 1 and "s") or ""
-                        comm = ["{0} validation error{1} detected"
-                                .format(len(verrs), s)]
-                        comm += [str(e) for e in verrs]
-                    out._err(vt, not comm, comm)
+                    tovalidate.append((data, DEF_NERDM_SUBCOLL_SCHEMA))
+
+        # now validate the component metadata against their schemas
+        for verrs in self._validate_comps(tovalidate):
+            comm = None
+            if verrs:
+                s = (len(verrs) > 1 and "s") or ""
+                comm = ["{0} validation error{1} detected"
+                        .format(len(verrs), s)]
+                comm += verrs
+            out._err(vt, not comm, comm)
             
         return out
 
-    def _check_comp_legal(self, nerdmf, path, res):
+    def _validate_comps(self, comps):
+        # validate a list of (component metadata, default schema URI) pairs, 
+        # spreading the work across a pool of workers as configured.  A list 
+        # of the error messages for each component is returned in the order 
+        # of the input.
+        tasks = []
+        for data, defschema in comps:
+            flav = self._get_mdval_flavor(data)
+            tasks.append((self._schemadir, flav, data,
+                          data.get(flav+"schema") or defschema))
+
+        nworkers = self.cfg.get('validation_workers', 1)
+        workers = min(nworkers, len(tasks))
+        if workers <= 1:
+            return [_validate_comp(t) for t in tasks]
+
+        if self.cfg.get('validation_processes', False):
+            with _validation_pool(self._schemadir, nworkers,
+                                  self.cfg.get('validation_pool_idle',
+                                               DEF_POOL_IDLE_TIMEOUT)) as pool:
+                return pool.map(_validate_comp, tasks)
+
+        pool = ThreadPool(workers)
+        try:
+            out = pool.map(_validate_comp, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return out
+
+    def _check_comp_legal(self, nerdmf, path, res, inv=None):
         vt = self._issue("4.1-4-2a", "A data file directory must " +
                          "contain a legal NERDm metadata file.")
         pt = self._issue("4.1-4-2f", "A data component's NERDm data must have "+
                          "a correct filepath property")
         try:
-            with open(nerdmf) as fd:
-                data = json.load(fd, object_pairs_hook=OrderedDict)
+            if inv:
+                data = inv.read_json(nerdmf)
+            else:
+                with open(nerdmf) as fd:
+                    data = json.load(fd, object_pairs_hook=OrderedDict)
         except ValueError as ex:
             res._err(vt, False,
                      ["metadata/"+path+"/nerdm.json: Not a legal JSON file"])
@@ -610,10 +792,20 @@ class NISTAIPValidator(AggregatedValidator):
     An AggregatedValidator that validates the complete profile for bags 
     created by the NIST preservation service.  
     """
-    def __init__(self, config=None):
+    def __init__(self, config=None, progress=None):
+        """
+        create the validator
+
+        :param dict config:  the validator configuration, with the 
+                             configurations for the component validators 
+                             given under "bagit", "multibag", and "nist".
+        :param progress:     a function for reporting checksum verification
+                             progress (see BagItValidator)
+        """
         if not config:
             config = {}
-        bagit = BagItValidator(config=config.get("bagit", {}))
+        bagit = BagItValidator(config=config.get("bagit", {}),
+                               progress=progress)
         multibag = MultibagValidator(config=config.get("multibag", {}))
         nist = NISTBagValidator(config=config.get("nist", {}))
 
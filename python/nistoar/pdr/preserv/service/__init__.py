@@ -11,10 +11,11 @@ preservation process can take a bit of time for large submissions; consequently,
 the :class:`~nistoar.pdr.preserv.service.PreservationService` has built-in 
 support for asynchronous processing.  
 
-(Currently, the only working implementation of the 
-:class:`~service.PreservationService` interface is the 
-:class:`~service.ThreadedPreservationService`, which implements asynchronous 
-execution via python threads.)
+(Two implementations of the :class:`~service.PreservationService` interface
+are provided:  the :class:`~service.ThreadedPreservationService`, which 
+implements asynchronous execution via python threads, and the 
+:class:`~service.MultiprocPreservationService`, which executes requests in 
+a pool of processes.)
 
 Asynchronous processing is by delegating the work to an 
 :class:`~siphandler.SIPHandler`.  An implementation of this class understands
@@ -35,4 +36,4 @@ This package provides several modules:
   implemented using the Web Service Gateway Interface (WSGI) framework.
 """
 from service import (PreservationService, ThreadedPreservationService, 
-                     RerequestException)
+                     MultiprocPreservationService, RerequestException)
@@ -0,0 +1,207 @@
+"""
+This module provides a persistent queue of preservation requests.
+
+The :class:`~jobqueue.PreservationQueue` records requests waiting to be
+processed (and those currently being processed) in a JSON file so that the
+queue survives a restart of the service.  The file is locked during each
+update so that the queue can be shared by multiple processes (e.g. several
+web server processes).
+"""
+import os, json, time, errno
+from collections import OrderedDict
+
+from ...utils import LockedFile
+
+QUEUED  = "queued"
+RUNNING = "running"
+
+def pid_is_alive(pid):
+    """
+    return True if a process with the given process ID is running
+    """
+    if not pid or pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return False
+        elif e.errno == errno.EPERM:
+            return True
+        else:
+            raise
+    return True
+
+class PreservationQueue(object):
+    """
+    a persistent, file-based queue of preservation requests.  Requests are
+    ordered by priority (higher values first) and then by the order in which
+    they were added.  An SIP can appear in the queue only once.
+
+    Each entry in the queue is a dictionary with the following properties:
+    :prop sipid str:      the identifier of the SIP to preserve
+    :prop siptype str:    the type of SIP
+    :prop asupdate bool:  True if the request is for an update to an existing
+                          AIP
+    :prop priority int:   the priority of the request
+    :prop state str:      either QUEUED or RUNNING
+    :prop pid int:        for a RUNNING request, the ID of the process that is
+                          processing it.
+    """
+
+    def __init__(self, qfile):
+        """
+        open (and create, if necessary) the queue
+
+        :param qfile str:  the path to the file where the queue is persisted
+        """
+        self._qfile = qfile
+        if not os.path.exists(qfile):
+            with LockedFile(qfile, 'a') as fd:
+                pass
+
+    @property
+    def qfile(self):
+        """
+        the path to the file where the queue is persisted
+        """
+        return self._qfile
+
+    def _load(self, fd):
+        fd.seek(0)
+        data = fd.read()
+        if not data.strip():
+            return OrderedDict([("seq", 0), ("jobs", [])])
+        return json.loads(data, object_pairs_hook=OrderedDict)
+
+    def _save(self, fd, data):
+        fd.seek(0)
+        fd.truncate(0)
+        json.dump(data, fd, indent=2, separators=(',', ': '))
+
+    def _read(self):
+        with LockedFile(self._qfile) as fd:
+            return self._load(fd)
+
+    def _modify(self, func):
+        # apply func to the queue data while holding an exclusive lock
+        with LockedFile(self._qfile, 'a+') as fd:
+            data = self._load(fd)
+            out = func(data)
+            self._save(fd, data)
+        return out
+
+    @staticmethod
+    def _sortkey(job):
+        return (-job.get('priority', 0), job['seq'])
+
+    def add(self, sipid, siptype, asupdate=False, priority=0):
+        """
+        add a request to the queue.
+
+        :return bool:  False if a request for the SIP is already in the queue
+                       (in which case the queue is unchanged); True, otherwise.
+        """
+        def _add(data):
+            if any(j['sipid'] == sipid for j in data['jobs']):
+                return False
+            data['seq'] += 1
+            data['jobs'].append(OrderedDict([
+                ("sipid", sipid), ("siptype", siptype), ("asupdate", asupdate),
+                ("priority", priority), ("seq", data['seq']),
+                ("state", QUEUED), ("queued", time.time())
+            ]))
+            data['jobs'].sort(key=self._sortkey)
+            return True
+        return self._modify(_add)
+
+    def next(self):
+        """
+        claim the next queued request for processing by this process,
+        marking it as RUNNING.
+
+        :return dict:  the claimed request entry, or None if there are no
+                       queued requests.
+        """
+        def _next(data):
+            for job in data['jobs']:
+                if job['state'] == QUEUED:
+                    job['state'] = RUNNING
+                    job['pid'] = os.getpid()
+                    job['started'] = time.time()
+                    return dict(job)
+            return None
+        return self._modify(_next)
+
+    def remove(self, sipid):
+        """
+        remove the request for the given SIP from the queue (e.g. because its
+        processing is complete).
+
+        :return bool:  True if the request was found in the queue
+        """
+        def _remove(data):
+            n = len(data['jobs'])
+            data['jobs'] = [j for j in data['jobs'] if j['sipid'] != sipid]
+            return len(data['jobs']) < n
+        return self._modify(_remove)
+
+    def recover(self):
+        """
+        return RUNNING requests whose processes are no longer running to the
+        QUEUED state (at the front of their priority level) so that they will
+        be processed again.
+
+        :return list:  the IDs of the recovered SIPs
+        """
+        def _recover(data):
+            out = []
+            for job in data['jobs']:
+                if job['state'] == RUNNING and not pid_is_alive(job.get('pid')):
+                    job['state'] = QUEUED
+                    job['seq'] = -abs(job['seq'])
+                    job.pop('pid', None)
+                    out.append(job['sipid'])
+            data['jobs'].sort(key=self._sortkey)
+            return out
+        return self._modify(_recover)
+
+    def get(self, sipid):
+        """
+        return the entry for the given SIP's request, whether it is waiting 
+        or running, or None if the SIP is not in the queue.
+        """
+        for job in self._read()['jobs']:
+            if job['sipid'] == sipid:
+                return job
+        return None
+
+    def position(self, sipid):
+        """
+        return the position of the given SIP's request among the queued
+        (i.e. not yet running) requests.
+
+        :return tuple:  a 2-tuple containing the 1-based position and the
+                        total number of queued requests, or None if the SIP
+                        is not waiting in the queue.
+        """
+        queued = [j['sipid'] for j in self._read()['jobs']
+                             if j['state'] == QUEUED]
+        if sipid not in queued:
+            return None
+        return (queued.index(sipid)+1, len(queued))
+
+    @property
+    def depth(self):
+        """
+        the number of requests waiting in the queue (not including those
+        currently running)
+        """
+        return len([j for j in self._read()['jobs'] if j['state'] == QUEUED])
+
+    def jobs(self):
+        """
+        return a list of all entries in the queue, including those running,
+        in priority order.
+        """
+        return self._read()['jobs']
@@ -9,10 +9,11 @@ preservation process can take a bit of time for large submissions; consequently,
 the :class:`~nistoar.pdr.preserv.service.PreservationService` has built-in 
 support for asynchronous processing.  
 
-(Currently, the only working implementation of the 
-:class:`~service.PreservationService` interface is the 
-:class:`~service.ThreadedPreservationService`, which implements asynchronous 
-execution via python threads.)
+(Two implementations of the :class:`~service.PreservationService` interface
+are provided:  the :class:`~service.ThreadedPreservationService`, which 
+implements asynchronous execution via python threads, and the 
+:class:`~service.MultiprocPreservationService`, which executes requests in 
+a pool of processes.)
 
 Asynchronous processing is by delegating the work to an 
 :class:`~siphandler.SIPHandler`.  An implementation of this class understands
@@ -25,9 +26,7 @@ submit the metadata to the PDR metadata database.
 """
 from copy import deepcopy
 from abc import ABCMeta, abstractmethod, abstractproperty
-import os, logging, threading, time, errno, re
-
-from detach import Detach
+import os, logging, threading, time, errno, re, multiprocessing
 
 from .. import (PDRException, StateException, IDNotFound, 
                 ConfigurationException, SIPDirectoryNotFound,
@@ -35,6 +34,7 @@ from .. import (PDRException, StateException, IDNotFound,
 from ....id import PDRMinter
 from . import status
 from . import siphandler as hndlr
+from . import jobqueue
 from ...notify import NotificationService
 from ..bagger.prepupd import UpdatePrepService
 
@@ -374,6 +374,11 @@ class PreservationService(object):
         else:
             raise PDRException("SIP type not supported: "+siptype, sys=_sys)
 
+    def _siptype_of(self, handler):
+        if isinstance(handler, hndlr.MIDASSIPHandler):
+            return 'midas'
+        return handler.name
+
     def _get_handler_config(self, siptype):
         # from our service configuration, build a configuration object that
         # can be used to preserve an SIP of a particular type
@@ -398,108 +403,363 @@ class PreservationService(object):
 
         return pcfg
 
-class ThreadedPreservationService(PreservationService):
+DEF_MAX_WORKERS = 2
+
+def _run_handler(handler, serialtype, destdir=None, params=None):
+    # run the handler's bagit(), recording failures in its status
+    try:
+        time.sleep(0)
+        handler.bagit(serialtype, destdir, params)
+    except Exception, ex:
+        if isinstance(ex, PreservationStateException):
+            log.exception("Incorrect state for client's request: "+
+                          str(ex))
+            if ex.aipexists:
+                reason = "requested initial preservation of existing AIP"
+            else:
+                reason = "requested update to non-existing AIP"
+            handler.set_state(status.CONFLICT, reason)
+        else:
+            handler.set_state(status.FAILED, "Unexpected failure")
+        log.exception("Bagging failure: %s", str(ex))
+
+        # alert a human!
+        if handler.notifier:
+            fmtd = False
+            if isinstance(ex, PreservationException):
+                msg = [str(ex)] + ex.errors
+                fmtd = True
+            else:
+                msg = str(ex)
+            handler.notifier.alert("preserve.failure",
+                                   origin=handler.name,
+                          summary="Preservation failed for SIP="+handler._sipid,
+                                   desc=msg, formatted=fmtd,
+                                   id=handler._sipid)
+
+class _QueuedPreservationService(PreservationService):
     """
-    A class that asynchronously handles requests to ingest and preserve 
-    Submission Information Packages (SIPs).  This single class can handle 
-    multiple types of SIPs.  Because requests are handled asynchronously 
-    (i.e. in separate Python threads), multiple requests can be managed 
-    simultaneously. 
+    a base for PreservationService implementations that place requests in a
+    persistent queue (see :class:`~jobqueue.PreservationQueue`) to be 
+    processed by a bounded number of workers.  Requests waiting in the queue 
+    have a PENDING status that reports their position in the queue.  Requests
+    still in the queue when the service is restarted will be processed by 
+    the new instance.  The queue file may be shared by several instances of 
+    the service (e.g. in different web server processes); a request can then
+    be processed by any one of them.
+
+    Subclasses provide the workers by implementing _dispatch().
+
+    In addition to the parameters supported by the PreservationService, this
+    class supports the following configuration parameters:
+    :prop max_workers int (2):  the maximum number of requests to process
+                                simultaneously.
+    :prop queue_file str:       the path to the file used to persist the queue
+                                of requests.  Default: preserv_queue.json in 
+                                the working directory.
+    :prop sync_timeout float (5): the default time, in seconds, to wait for a 
+                                request to complete before returning an 
+                                asynchronous response.
     """
+
+    # the interval, in seconds, at which a waiting job checks the queue to see
+    # if its request was completed by another process
+    _poll_interval = 1.0
+
     def __init__(self, config):
         """
         initialize the service based on the given configuration.
         """
-        super(ThreadedPreservationService, self).__init__(config)
+        super(_QueuedPreservationService, self).__init__(config)
+
+        qfile = self.cfg.get('queue_file',
+                             os.path.join(self.workdir, "preserv_queue.json"))
+        self._queue = jobqueue.PreservationQueue(qfile)
+        self._maxworkers = max(int(self.cfg.get('max_workers',
+                                                DEF_MAX_WORKERS)), 1)
+        self._jobs = {}
+        self._lock = threading.RLock()
+
+    def _resume_queue(self):
+        # pick up requests left over from a previous run of the service; a 
+        # subclass calls this once it is ready to process requests
+        recovered = self._queue.recover()
+        if recovered:
+            log.warn("Restarting interrupted preservation requests: %s",
+                     ", ".join(recovered))
+        depth = self._queue.depth
+        if depth > 0:
+            log.info("Resuming %d queued preservation requests", depth)
+            self._dispatch(depth)
 
-    class _HandlerThread(threading.Thread):
-        def __init__(self, handler, serialtype, params=None, destdir=None):
-            if params is None:
-                params = {}
-            tname = params.get('worker_name')
-            threading.Thread.__init__(self, name=tname)
-            self._hdlr = handler
-            self._stype = serialtype
-            self._dest = destdir
-            self._params = params
-        def run(self):
-            try:
-                time.sleep(0)
-                self._hdlr.bagit(self._stype, self._dest, self._params)
-            except Exception, ex:
-                if isinstance(ex, PreservationStateException):
-                    log.exception("Incorrect state for client's request: "+
-                                  str(ex))
-                    if ex.aipexists:
-                        reason = "requested initial preservation of existing AIP"
-                    else:
-                        reason = "requested update to non-existing AIP"
-                    self._hdlr.set_state(status.CONFLICT, reason)
-                else:
-                    self._hdlr.set_state(status.FAILED, "Unexpected failure")
-                log.exception("Bagging failure: %s", str(ex))
-
-                # alert a human!
-                if self._hdlr.notifier:
-                    fmtd = False
-                    if isinstance(ex, PreservationException):
-                        msg = [str(ex)] + ex.errors
-                        fmtd = True
-                    else:
-                        msg = str(ex)
-                    self._hdlr.notifier.alert("preserve.failure",
-                                              origin=self._hdlr.name,
-                      summary="Preservation failed for SIP="+self._hdlr._sipid,
-                                              desc=msg, formatted=fmtd,
-                                              id=self._hdlr._sipid)
+    @abstractmethod
+    def _dispatch(self, count=1):
+        """
+        arrange for the given number of newly queued requests to be claimed 
+        from the queue and processed (via _process()).
+        """
+        raise NotImplementedError()
 
-    def _launch_handler(self, handler, timeout=None):
+    class _Job(object):
+        # a handle on a queued request that can be joined like a thread.  The
+        # request is complete once it has left the (possibly shared) queue, 
+        # no matter which process processed it.
+        def __init__(self, service, handler):
+            self.name = handler._sipid
+            self.handler = handler
+            self._svc = service
+            self._done = threading.Event()
+        def join(self, timeout=None):
+            end = None
+            if timeout is not None:
+                end = time.time() + timeout
+            while self.is_alive():
+                wait = self._svc._poll_interval
+                if end is not None:
+                    wait = min(wait, end - time.time())
+                    if wait <= 0:
+                        break
+                self._done.wait(wait)
+        def is_alive(self):
+            if not self._done.is_set() and not self._svc._is_queued(self.name):
+                self._svc._forget_job(self)
+            return not self._done.is_set()
+
+    def _is_queued(self, sipid):
+        # return True if the SIP's request is still in the queue (waiting or 
+        # running)
+        try:
+            return self._queue.get(sipid) is not None
+        except Exception, ex:
+            log.warn("%s: Unable to read preservation queue: %s",
+                     sipid, str(ex))
+            return True
+
+    def _forget_job(self, job):
+        # mark the job done and stop tracking it
+        with self._lock:
+            if self._jobs.get(job.name) is job:
+                del self._jobs[job.name]
+        job._done.set()
+
+    def _process(self, entry):
+        # process the request described by the given (claimed) queue entry, 
+        # removing it from the queue when done
+        sipid = entry['sipid']
+        with self._lock:
+            job = self._jobs.get(sipid)
+        try:
+            if job:
+                handler = job.handler
+            else:
+                # queued by a previous instance or another process
+                handler = self._make_handler(sipid, entry['siptype'],
+                                             entry.get('asupdate', False))
+            _run_handler(handler, 'zip')
+        except Exception, ex:
+            log.exception("%s: Failed to process queued preservation request",
+                          sipid)
+        finally:
+            with self._lock:
+                try:
+                    self._queue.remove(sipid)
+                except Exception, ex:
+                    log.exception("%s: Failed to remove request from queue",
+                                  sipid)
+                job = self._jobs.get(sipid)
+            if job:
+                self._forget_job(job)
+
+    def _refresh_status(self, handler, job):
+        # bring the handler's status data up to date after waiting on its job:
+        # the request may have been processed by another handler (possibly in
+        # another process).  A handler still being run by a local worker is 
+        # left alone.
+        if not job.is_alive() or job.handler is not handler:
+            handler._status.refresh()
+
+    def _add_queue_info(self, sipid, stat):
+        # if the SIP is waiting in the queue, add its position to the given 
+        # status data
+        try:
+            pos = self._queue.position(sipid)
+        except Exception, ex:
+            log.warn("%s: Unable to determine queue position: %s",
+                     sipid, str(ex))
+            return stat
+        if pos:
+            stat['queue_position'], stat['queue_depth'] = pos
+            stat['message'] = "{0} (position {1} of {2} in queue)" \
+                              .format(status.user_message[status.PENDING], *pos)
+        return stat
+
+    def status(self, sipid, siptype=None):
         """
-        launch the given handler in a separate thread.  After launching, 
-        this function will join with the thread for a maximum time given by 
-        the timeout value.  If not provided, the configured value of 
-        'sync_timeout' will be used.  
+        report on the current status of the preservation of a dataset with
+        the given SIP identifier.  This extends the inherited version by 
+        adding the request's position in the queue if it is PENDING.
+        """
+        out = super(_QueuedPreservationService, self).status(sipid, siptype)
+        if out.get('state') == status.PENDING:
+            self._add_queue_info(sipid, out)
+        return out
+
+    def _launch_handler(self, handler, timeout=None, priority=0):
+        """
+        queue the given handler's request for processing by a worker.  After 
+        queuing, this function will wait for the request to complete for a
+        maximum time given by the timeout value.  If not provided, the 
+        configured value of 'sync_timeout' will be used.  
 
         :param handler SIPHandler:  the handler to launch
         :param timeout        int:  the time in seconds to wait for the 
                                       handler to finish before returning an 
                                       asynchronous response.
+        :param priority       int:  the priority of the request in the queue;
+                                      higher values are processed first.
+        :return tuple:  the status data and the job, a handle that (like a 
+                        thread) can be joined to wait for its completion.  
         """
-        t = None
+        job = None
+        sipid = handler._sipid
         try: 
-            t = self._HandlerThread(handler, 'zip', {'worker-name': handler._sipid})
-            t.start()
+            with self._lock:
+                # the queue (which may be shared with other processes) decides
+                # whether the request is new; a job we are tracking for an 
+                # earlier request may have been completed elsewhere. 
+                job = self._jobs.get(sipid)
+                if job and not job.is_alive():
+                    job = None
+                if self._queue.add(sipid, self._siptype_of(handler),
+                                   bool(handler._asupdate), priority):
+                    job = self._Job(self, handler)
+                    self._jobs[sipid] = job
+                    handler.set_state(status.PENDING)
+                    self._dispatch()
+                elif not job:
+                    log.warn("%s: preservation request is already queued",
+                             sipid)
+                    return (self._add_queue_info(sipid, handler.status), None)
 
             if timeout is None:
                 timeout = float(self.cfg.get('sync_timeout', 5))
-            t.join(timeout)
+            job.join(timeout)
 
-            # the thread either finished or we timed-out waiting for it
-            if not t.is_alive():
-                log.info("%s: preservation completed synchronously",
-                         handler._sipid)
+            # the job either finished or we timed-out waiting for it
+            self._refresh_status(handler, job)
+            if not job.is_alive():
+                log.info("%s: preservation completed synchronously", sipid)
                 if handler.state == status.IN_PROGRESS:
                     handler.set_state(status.FAILED,
                                  "preservation thread died for unknown reasons")
-                elif handler.state == status.READY:
+                elif handler.state in (status.READY, status.PENDING):
                     handler.set_state(status.FAILED,
                              "preservation failed to start for unknown reasons")
             else:
-                log.info("%s: preservation running asynchronously",
-                         handler._sipid)
+                log.info("%s: preservation running asynchronously", sipid)
 
         except Exception, ex:
-            log.exception("Failed to launch handler for sipid=%s",
-                          handler._sipid)
+            log.exception("Failed to launch handler for sipid=%s", sipid)
             handler.set_state(status.FAILED,
                         "Failed to launch preservation due to internal error")
 
-        return (handler.status, t)
+        out = handler.status
+        if out.get('state') == status.PENDING:
+            self._add_queue_info(sipid, out)
+        return (out, job)
+
+class ThreadedPreservationService(_QueuedPreservationService):
+    """
+    A class that asynchronously handles requests to ingest and preserve 
+    Submission Information Packages (SIPs).  This single class can handle 
+    multiple types of SIPs.  Because requests are handled asynchronously 
+    (i.e. in separate Python threads), multiple requests can be managed 
+    simultaneously. 
+
+    Requests are placed in a persistent queue (see 
+    :class:`~jobqueue.PreservationQueue`) and processed by a bounded pool of
+    worker threads; requests waiting in the queue have a PENDING status that
+    reports their position in the queue.  Requests still in the queue when 
+    the service is restarted will be processed by the new instance.  
+
+    In addition to the parameters supported by the PreservationService, this
+    class supports the following configuration parameters:
+    :prop max_workers int (2):  the maximum number of requests to process
+                                simultaneously.
+    :prop queue_file str:       the path to the file used to persist the queue
+                                of requests.  Default: preserv_queue.json in 
+                                the working directory.
+    :prop sync_timeout float (5): the default time, in seconds, to wait for a 
+                                request to complete before returning an 
+                                asynchronous response.
+    """
+    def __init__(self, config):
+        """
+        initialize the service based on the given configuration.
+        """
+        super(ThreadedPreservationService, self).__init__(config)
+        self._workers = []
+        self._resume_queue()
+
+    class _Worker(threading.Thread):
+        def __init__(self, service):
+            threading.Thread.__init__(self)
+            self.daemon = True
+            self._svc = service
+        def run(self):
+            while self._svc._run_next(self):
+                pass
+
+    def _dispatch(self, count=1):
+        with self._lock:
+            self._ensure_workers()
+
+    def _ensure_workers(self):
+        # start workers, up to the maximum, as needed to process the
+        # queued requests.  The caller must hold self._lock.
+        need = min(self._queue.depth, self._maxworkers) - len(self._workers)
+        for i in range(need):
+            w = self._Worker(self)
+            self._workers.append(w)
+            w.start()
+
+    def _run_next(self, worker):
+        # claim the next request from the queue and process it; return False
+        # (after retiring the worker) if there are no more requests
+        try:
+            with self._lock:
+                entry = self._queue.next()
+                if not entry:
+                    self._workers.remove(worker)
+                    return False
+        except Exception, ex:
+            log.exception("Failure reading preservation queue: %s", str(ex))
+            with self._lock:
+                self._workers.remove(worker)
+            return False
+
+        self._process(entry)
+        return True
+
 
+_worker_svc = None
 
-# NOT WORKING (use ThreadedPreservationService)
+def _init_pool_process(service):
+    # initialize a pool process with its (forked) copy of the service
+    global _worker_svc
+    service._jobs = {}
+    service._lock = threading.RLock()
+    _worker_svc = service
 
-class MultiprocPreservationService(PreservationService):
+def _process_next_in_pool():
+    # claim and process the next queued request within a pool process
+    return _worker_svc._process_next()
+
+# a PENDING request that is not in the queue and whose status has not been
+# updated for this many seconds is considered lost
+LOST_REQUEST_TIMEOUT = 60
+
+class MultiprocPreservationService(_QueuedPreservationService):
     """
     A class that asynchronously handles requests to ingest and preserve 
     Submission Information Packages (SIPs).  This single class can handle 
@@ -507,8 +767,29 @@ class MultiprocPreservationService(PreservationService):
     (i.e. in separate standalone processes), multiple requests can be managed 
     simultaneously. 
 
-    This implementation launches preservation requests via a child process
-    (running a standalone bagging script).  
+    This implementation processes preservation requests in a pool of 
+    processes forked when the service is created; this allows CPU-intensive
+    bagging of multiple SIPs to make use of multiple cores.  Requests are 
+    placed in a persistent queue (see :class:`~jobqueue.PreservationQueue`),
+    from which each pool process claims the next request when it is free; 
+    requests still in the queue when the service is closed or restarted will 
+    be processed by the next instance.  The pool processes communicate the 
+    progress of a request via the SIP's status file (see 
+    :class:`~status.SIPStatusFile`).  If a pool process dies while processing
+    a request, the request is returned to the queue (as is done when the 
+    service is restarted) the next time its status is checked.  
+
+    In addition to the parameters supported by the PreservationService, this
+    class supports the following configuration parameters:
+    :prop max_workers int (2):  the number of processes in the pool (i.e. the
+                                maximum number of requests to process 
+                                simultaneously).
+    :prop queue_file str:       the path to the file used to persist the queue
+                                of requests.  Default: preserv_queue.json in 
+                                the working directory.
+    :prop sync_timeout float (5): the default time, in seconds, to wait for a 
+                                request to complete before returning an 
+                                asynchronous response.
     """
     def __init__(self, config):
         """
@@ -516,91 +797,104 @@ class MultiprocPreservationService(PreservationService):
         """
         super(MultiprocPreservationService, self).__init__(config)
 
-    def _pid_is_alive(self, pid):
-        if pid <= 0:
-            return False
-        try:
-            os.kill(pid, 0)
-        except OSError, e:
-            if e.errno == errno.ESRCH:
-                return False
-            elif e.errno == errno.EPERM:
-                return True
-            else:
-                raise
-        return True
+        self._pool = multiprocessing.Pool(self._maxworkers, _init_pool_process,
+                                          (self,))
+        self._resume_queue()
 
-    def _launch_handler(self, handler, timeout=None):
+    def close(self):
         """
-        launch the given handler in a separate thread.  After launching, 
-        this function will join with the thread for a maximum time given by 
-        the timeout value.  
+        shut down the process pool.  Any requests still being processed are
+        abandoned; they, along with the requests still waiting in the queue, 
+        will be processed when the service is next started.
         """
-        cpid = None
-        try:
-          with Detach() as d:
-            if d.pid:
-                # parent process: wait a short bit to see if the child finishes
-                # quickly
-                cpid = d.pid
-
-                if timeout is None:
-                    timeout = self.cfg.get('sync_timeout', 5)
-                starttime = time.time()
-                since = time.time() - starttime
-                while since < timeout:
-                    if not self._pid_is_alive(d.pid):
-                        break
-                    time.sleep(1)
-                    since = time.time() - starttime
-
-                if not self._pid_is_alive(d.pid):
-                    if handler.state == status.IN_PROGRESS:
-                        handler.set_state(status.FAILED,
-                                 "preservation thread died for unknown reasons")
-                    elif handler.state == status.READY:
-                        handler.set_state(status.FAILED,
-                             "preservation failed to start for unknown reasons")
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _dispatch(self, count=1):
+        # each task claims the next request from the queue, whichever it is
+        for i in range(count):
+            self._pool.apply_async(_process_next_in_pool,
+                                   callback=self._task_done)
+
+    def _task_done(self, sipid):
+        # called (in the parent) when a pool process finishes a request
+        with self._lock:
+            job = self._jobs.get(sipid)
+        if job:
+            self._forget_job(job)
+
+    def _process_next(self):
+        # (called within a pool process) claim the next request from the 
+        # queue and process it, returning its SIP ID (or None if the queue 
+        # was empty).
+        entry = self._queue.next()
+        if not entry:
+            return None
+        self._process(entry)
+        return entry['sipid']
+
+    def _refresh_status(self, handler, job):
+        # requests are processed by handlers in the pool processes
+        handler._status.refresh()
 
-                return (handler.status, d.pid)
-            else:
-                # child
-                try:
-                    handler.bagit('zip', self.storedir)
-                except Exception, e:
-                    if isinstance(ex, PreservationStateException):
-                        log.exception("Incorrect state for client's request: "+
-                                      str(ex))
-                        if ex.aipexists:
-                            reason = "requested initial preservation of " + \
-                                     "existing AIP"
-                        else:
-                            reason = "requested update to non-existing AIP"
-                        self._hdlr.set_state(status.CONFLICT, reason)
-                    else:
-                        log.exception("Preservation handler failed: %s", str(e))
-
-                    # alert a human!
-                    if self._hdlr.notifier:
-                        self._hdlr.notifier.alert("preserve.failure",
-                                                  origin=self._hdlr.name,
-                      summary="Preservation failed for SIP="+self._hdlr._sipid,
-                                                  desc=str(ex),
-                                                  id=self._hdlr._sipid)
-                finally:
-                    ex = ((handler.state != status.SUCCESSFUL) and 1) or 0
-                    sys.exit(ex)
-
-        except Exception, e:
-            if cpid is None:
-                log.exception("Failed to launch preservation process: %s",str(e))
+    def _pid_is_alive(self, pid):
+        return jobqueue.pid_is_alive(pid)
+
+    def _check_for_crash(self, handler):
+        # if the handler's request is marked as pending or in progress but it
+        # is neither being processed nor waiting in the queue, mark it as 
+        # failed.
+        handler._status.refresh()
+        if handler.state not in (status.PENDING, status.IN_PROGRESS):
+            return
+        sipid = handler._sipid
+        try:
+            entry = self._queue.get(sipid)
+        except Exception, ex:
+            log.warn("%s: Unable to read preservation queue: %s",
+                     sipid, str(ex))
+            return
+
+        if entry:
+            pid = entry.get('pid')
+            if entry['state'] == jobqueue.RUNNING and \
+               not self._pid_is_alive(pid):
+                # same policy as at start-up:  put the request back in the 
+                # queue to be tried again
+                log.error("%s: preservation process (pid=%s) died; "
+                          "re-queuing request", sipid, pid)
+                recovered = self._queue.recover()
+                if sipid in recovered:
+                    handler.set_state(status.PENDING,
+                                      "preservation process died; request "
+                                      "has been re-queued")
+                if recovered and self._pool:
+                    self._dispatch(len(recovered))
+            return
+
+        # the request may have completed since we last looked
+        handler._status.refresh()
+        if handler.state == status.IN_PROGRESS:
+            log.error("%s: preservation process died", sipid)
+            handler.set_state(status.FAILED,
+                              "preservation process died unexpectedly")
+        elif handler.state == status.PENDING:
+            since = handler._status.data['user'].get('update_time', 0)
+            if time.time() - since > LOST_REQUEST_TIMEOUT:
+                log.error("%s: pending preservation request was lost", sipid)
                 handler.set_state(status.FAILED,
-                                  "Failed to launch preservation process")
-                return (handler.status, None)
-            else:
-                log.exception("Unexpected failure while monitoring "+
-                              "preservation process: %s", str(e))
-                return (handler.status, cpid)
+                                  "preservation request was lost; please "+
+                                  "resubmit")
+
+    def _make_handler(self, sipid, siptype=None, asupdate=False):
+        # this extension makes sure the status reflects a failure of the
+        # process processing the SIP
+        out = super(MultiprocPreservationService, self)._make_handler(sipid,
+                                                              siptype, asupdate)
+        self._check_for_crash(out)
+        return out
 
 class RerequestException(PreservationException):
     """
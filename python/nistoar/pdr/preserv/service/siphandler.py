@@ -8,13 +8,13 @@ import os, sys, re, shutil, logging, errno
 from abc import ABCMeta, abstractmethod, abstractproperty
 from collections import OrderedDict
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 
 from ..bagit.serialize import DefaultSerializer
 from ..bagit.bag import NISTBag
 from ..bagit.validate import NISTAIPValidator
 from ..bagit.multibag import MultibagSplitter
 from ..bagger import utils as bagutils
-from ..bagger.base import checksum_of
 from ..bagger.midas import PreservationBagger
 from .. import (ConfigurationException, StateException, PODError)
 from .. import PreservationException, sys as _sys
@@ -44,6 +44,14 @@ class SIPHandler(object):
                                  the sub-property 'cachedir' will be set to
                                  a directory call 'preserv_status' just below
                                  the working directory ('working_dir').  
+    :prop multibag dict ({}):    configuration for splitting large bags into
+                                 multibags (see MultibagSplitter).  In addition,
+                                 the sub-property 'serialization_workers' 
+                                 (int, default 1) sets the number of member
+                                 bags to serialize concurrently.
+    :prop serializer dict ({}):  configuration for the DefaultSerializer used
+                                 when a serializer is not provided at 
+                                 construction (e.g. its 'compression' policy).
     """
     __metaclass__ = ABCMeta
 
@@ -75,7 +83,7 @@ class SIPHandler(object):
         self.cfg = deepcopy(config)
         self._minter = minter
         if not serializer:
-            serializer = DefaultSerializer()
+            serializer = DefaultSerializer(config=self.cfg.get('serializer'))
         self._ser = serializer
         self._asupdate = asupdate
 
@@ -175,7 +183,7 @@ class SIPHandler(object):
         """
         self._status.update(state, message, cache)
 
-    def _serialize(self, bagdir, destdir, format=None):
+    def _serialize(self, bagdir, destdir, format=None, overwrite=True):
         """
         serialize a given bag into a given destination directory.
 
@@ -187,6 +195,10 @@ class SIPHandler(object):
                                 must be a name recognized by the system.  
                                 If not provided a default serialization 
                                 will be applied (as given in the configuration).
+        :param overwrite bool:  if False, raise an OSError (EEXIST) rather 
+                                than overwrite a previously serialized bag
+                                in destdir, and remove any files already 
+                                written if serialization fails.  
         """
         srcbags = [ bagdir ]
 
@@ -206,18 +218,40 @@ class SIPHandler(object):
             log.warning("multibag splitting not configured")
             
 
+        if not overwrite:
+            for bagd in srcbags:
+                self._check_no_overwrite(bagd, destdir)
+
+        # serialize the (member) bags, possibly in parallel; results are
+        # returned in the order of srcbags
+        workers = min(mbcfg.get('serialization_workers', 1), len(srcbags))
+        if workers > 1:
+            log.info("Serializing %d bags using %d workers",
+                     len(srcbags), workers)
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(lambda b: self._try_serialize_bag(b, destdir,
+                                                                     format),
+                                   srcbags)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = []
+            for bagd in srcbags:
+                results.append(self._try_serialize_bag(bagd, destdir, format))
+                if results[-1][1]:
+                    break
+
         self._status.data['user']['bagfiles'] = []
         outfiles = []
-        for bagd in srcbags:
-            bagfile = self._ser.serialize(bagd, destdir, format)
-            outfiles.append(bagfile)
-
-            csumfile = bagfile + ".sha256"
-            csum = checksum_of(bagfile)
-            with open(csumfile, 'w') as fd:
-                fd.write(csum)
-                fd.write('\n')
-            outfiles.append(csumfile)
+        failure = None
+        for out, exc in results:
+            if exc:
+                failure = failure or exc
+                continue
+            bagfile, csumfile, csum = out
+            outfiles.extend([bagfile, csumfile])
 
             # write the checksum to our status object
             self._status.data['user']['bagfiles'].append({
@@ -225,6 +259,16 @@ class SIPHandler(object):
                 'sha256': csum
             })
 
+        if failure:
+            if not overwrite:
+                # roll back the files we have written
+                for f in outfiles:
+                    if os.path.exists(f):
+                        log.warn("Removing %s from %s", os.path.basename(f),
+                                 destdir)
+                        os.remove(f)
+            raise failure[0], failure[1], failure[2]
+
         self._status.cache()
 
         # remove the source bags
@@ -237,6 +281,32 @@ class SIPHandler(object):
         
         return outfiles
 
+    def _try_serialize_bag(self, bagdir, destdir, format):
+        # serialize one bag and write its checksum file, returning a tuple
+        # of the result (or None) and the exception info (or None)
+        try:
+            # the checksum is calculated during serialization if the
+            # serializer is able
+            bagfile, csum = self._ser.serialize_with_checksum(bagdir, destdir,
+                                                              format)
+            csumfile = bagfile + ".sha256"
+            with open(csumfile, 'w') as fd:
+                fd.write(csum)
+                fd.write('\n')
+            return (bagfile, csumfile, csum), None
+        except Exception:
+            log.error("Failed to serialize bag: %s", os.path.basename(bagdir))
+            return None, sys.exc_info()
+
+    def _check_no_overwrite(self, bagdir, destdir):
+        # raise an OSError if a serialization of the given bag already 
+        # exists in destdir
+        prefix = os.path.basename(bagdir) + '.'
+        for f in os.listdir(destdir):
+            if f.startswith(prefix) and not f.endswith('.part'):
+                f = os.path.join(destdir, f)
+                raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), f)
+
     def _is_ingested(self):
         """
         return True if some version of this SIP has been ingested into the PDR already.
@@ -275,6 +345,10 @@ class MIDASSIPHandler(SIPHandler):
                                  PreservationBagger instance used to create the
                                  output bag.  
     :prop review_dir str #req:  an existing directory containing MIDAS SIPs
+    :prop serialize_to_store bool (False):  if True, serialized bags will be 
+                                 written directly into the long-term storage
+                                 directory rather than into the staging 
+                                 directory and then copied.
     
     """
     name = "MIDAS-SIP"
@@ -478,37 +552,12 @@ class MIDASSIPHandler(SIPHandler):
 
         # zip it up; this may split the bag into multibags
         self._status.record_progress("Serializing")
-        savefiles = self._serialize(bagdir, self.stagedir, serialtype)
-
-        # copy the zipped files to long-term storage ("public" directory)
-        self._status.record_progress("Delivering preservation artifacts")
-        log.debug("writing files to %s", destdir)
-        errors = []
-        saved = []
-        try:
-            for f in savefiles:
-                destfile = os.path.join(destdir, os.path.basename(f))
-                if os.path.exists(destfile) and \
-                   not self.cfg.get('allow_bag_overwrite', False):
-                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
-                                  destfile)
-                shutil.copy(f, destdir)
-                saved.append(f)
-        except OSError, ex:
-            log.error("Failed to copy preservation file: %s\n" +
-                      "  to long-term storage: %s", f, destdir)
-            log.exception("Reason: %s", str(ex))
-            log.error("Rolling back successfully copied files")
-            msg = "Failed to copy preservation files to long-term storage"
-            self.set_state(status.FAILED, msg)
-
-            for f in saved:
-                fp = os.path.join(destdir, os.path.basename(f))
-                if os.path.exists(fp):
-                    log.warn("Removing %s from long-term storage", f)
-                    os.remove(fp)
-
-            raise PreservationException(msg, [str(ex)])
+        if self.cfg.get('serialize_to_store', False):
+            # write the serialized bags directly into long-term storage
+            savefiles = self._serialize_to_store(bagdir, destdir, serialtype)
+        else:
+            savefiles = self._serialize(bagdir, self.stagedir, serialtype)
+            self._deliver(savefiles, destdir)
 
         # Now write copies of the checksum files to the review SIP dir.
         # MIDAS will scoop these up and save them in its database.
@@ -606,7 +655,8 @@ class MIDASSIPHandler(SIPHandler):
                                 id=self.bagger.name)
 
         # clean up staging area
-        if self.cfg.get('clean_bag_staging', True):
+        if self.cfg.get('clean_bag_staging', True) and \
+           not self.cfg.get('serialize_to_store', False):
             headbag = None
             if not self.cfg.get('clean_headbag_staging', False):
                 bags = [b for b in [os.path.basename(f) for f in savefiles]
@@ -625,6 +675,72 @@ class MIDASSIPHandler(SIPHandler):
 
         log.info("Completed preservation of SIP %s", self.bagger.name)
 
+    def _deliver(self, savefiles, destdir):
+        # copy the zipped files to long-term storage ("public" directory)
+        self._status.record_progress("Delivering preservation artifacts")
+        log.debug("writing files to %s", destdir)
+        errors = []
+        saved = []
+        try:
+            for f in savefiles:
+                destfile = os.path.join(destdir, os.path.basename(f))
+                if os.path.exists(destfile) and \
+                   not self.cfg.get('allow_bag_overwrite', False):
+                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  destfile)
+                shutil.copy(f, destdir)
+                saved.append(f)
+        except OSError, ex:
+            log.error("Failed to copy preservation file: %s\n" +
+                      "  to long-term storage: %s", f, destdir)
+            log.exception("Reason: %s", str(ex))
+            log.error("Rolling back successfully copied files")
+            msg = "Failed to copy preservation files to long-term storage"
+            self.set_state(status.FAILED, msg)
+
+            for f in saved:
+                fp = os.path.join(destdir, os.path.basename(f))
+                if os.path.exists(fp):
+                    log.warn("Removing %s from long-term storage", f)
+                    os.remove(fp)
+
+            raise PreservationException(msg, [str(ex)])
+
+    def _serialize_to_store(self, bagdir, destdir, format):
+        # serialize the bag(s) directly into long-term storage, leaving a
+        # copy of the head bag in the staging area (as _deliver() would)
+        log.debug("serializing directly to %s", destdir)
+        try:
+            savefiles = self._serialize(bagdir, destdir, format,
+                                self.cfg.get('allow_bag_overwrite', False))
+        except OSError, ex:
+            log.error("Failed to write preservation files to long-term "+
+                      "storage: %s", destdir)
+            log.exception("Reason: %s", str(ex))
+            msg = "Failed to write preservation files to long-term storage"
+            self.set_state(status.FAILED, msg)
+            raise PreservationException(msg, [str(ex)])
+
+        if not self.cfg.get('clean_bag_staging', True) or \
+           not self.cfg.get('clean_headbag_staging', False):
+            bags = [os.path.basename(f) for f in savefiles
+                    if not f.endswith('sha256')]
+            if not self.cfg.get('clean_bag_staging', True):
+                tostage = bags
+            else:
+                tostage = [bagutils.find_latest_head_bag(bags)]
+            for f in tostage:
+                staged = os.path.join(self.stagedir, f)
+                if os.path.exists(staged):
+                    os.remove(staged)
+                try:
+                    os.link(os.path.join(destdir, f), staged)
+                except OSError:
+                    # probably on different filesystems
+                    shutil.copy(os.path.join(destdir, f), staged)
+
+        return savefiles
+
     def _is_preserved(self):
         """
         return True if some version of this SIP has been preserved (i.e. sent 
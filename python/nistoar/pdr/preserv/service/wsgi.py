@@ -1,5 +1,7 @@
 """
-A WSGI web service front-end to the ThreadedPreservationService.
+A WSGI web service front-end to the ThreadedPreservationService (or, if 
+the 'service_backend' config parameter is set to "processes", the 
+MultiprocPreservationService).
 
 This module provides the most basic implementation of a WSGI application 
 necessary for integration into a WSGI server.  It should be replaced with 
@@ -10,6 +12,7 @@ import os, sys, logging, json, cgi, re
 from wsgiref.headers import Headers
 
 from .service import (ThreadedPreservationService, RerequestException,
+                      MultiprocPreservationService,
                       ConfigurationException, PreservationStateException)
 from . import status
 from .. import PreservationSystem
@@ -30,7 +33,10 @@ class PreservationRequestApp(object):
             raise ConfigurationException("Missing required config param: "+
                                          key)
 
-        self.preserv = ThreadedPreservationService(config)
+        if config.get('service_backend', 'threads') == 'processes':
+            self.preserv = MultiprocPreservationService(config)
+        else:
+            self.preserv = ThreadedPreservationService(config)
         self.siptype = 'midas'
         authkey = config.get('auth_key')
         authmeth= config.get('auth_method')
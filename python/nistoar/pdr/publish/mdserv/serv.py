@@ -3,8 +3,8 @@ This module manages the preparation of the metadata needed by pre-publication
 landing page service.  It uses an SIPBagger to create the NERDm metadata from 
 POD metadata provided by MIDAS and assembles it into an exportable form.  
 """
-import os, logging, re, json
-from collections import Mapping
+import os, logging, re, json, hashlib, threading
+from collections import Mapping, OrderedDict
 
 from .. import PublishSystem
 from ...exceptions import (ConfigurationException, StateException,
@@ -48,6 +48,11 @@ class PrePubMetadataService(PublishSystem):
     :prop bagger dict ({}):  a dictionary for configuring the SIPBagger instance
                       used to process the SIP (see SIPBagger implementation 
                       documentation for supported sub-properties).  
+    :prop response_cache_size int (100):  the maximum number of serialized 
+                      NERDm records to keep in memory for reuse; a cached 
+                      record is only served if the SIP's input directories 
+                      have not changed since it was created.  Set to 0 to 
+                      turn off caching.
     """
 
     def __init__(self, config, workdir=None, reviewdir=None, uploaddir=None,
@@ -128,6 +133,12 @@ class PrePubMetadataService(PublishSystem):
             self.log.info("repo_access not configured; no access to published "+
                           "records.")
 
+        # serialized records, keyed by normalized SIP ID; each value is a
+        # (fingerprint, json, etag) tuple
+        self._respcache = OrderedDict()
+        self._respcache_size = self.cfg.get('response_cache_size', 100)
+        self._respcache_lock = threading.Lock()
+
     def _create_minter(self, parentdir):
         cfg = self.cfg.get('id_minter', {})
         out = PDRMinter(parentdir, cfg)
@@ -251,11 +262,111 @@ class PrePubMetadataService(PublishSystem):
             id = "ark:/{}/{}".format(naan, id)
         return id
 
+    def sip_fingerprint(self, bagger):
+        """
+        return a string that characterizes the current state of the SIP 
+        being processed by the given bagger.  The value will change if the 
+        POD file or any of the files or directories in the SIP's input 
+        directories are added, removed, or modified (as detected by their 
+        modification times and sizes), or if the metadata bag is replaced.  
+        It is cheap to calculate relative to preparing the metadata as it 
+        requires no files to be read.
+        """
+        fp = hashlib.sha256()
+        try:
+            podfile = bagger.find_pod_file()
+            st = os.stat(podfile)
+            fp.update("{0}:{1}:{2}\n".format(podfile, st.st_size, st.st_mtime))
+        except Exception as ex:
+            fp.update("nopod\n")
+
+        nfiles = 0
+        for indir in bagger._indirs:
+            for base, subdirs, files in os.walk(indir):
+                subdirs.sort()
+                st = os.stat(base)
+                fp.update("{0}/:{1}\n".format(base, st.st_mtime))
+                for f in sorted(files):
+                    path = os.path.join(base, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    fp.update("{0}:{1}:{2}\n".format(f, st.st_size, st.st_mtime))
+                    nfiles += 1
+        fp.update("nfiles:{0}\n".format(nfiles))
+
+        # the bag may have been removed or rebuilt independently of the SIP
+        for f in (bagger.bagdir, os.path.join(bagger.bagdir, "metadata")):
+            if os.path.exists(f):
+                st = os.stat(f)
+                fp.update("{0}:{1}:{2}\n".format(f, st.st_ino, st.st_mtime))
+
+        return fp.hexdigest()
+
+    def _serialize(self, mdata):
+        data = json.dumps(mdata, indent=4, separators=(',', ': '))
+        return (data, '"{0}"'.format(hashlib.sha256(data).hexdigest()[:32]))
+
+    def _cache_get(self, id, fingerprint):
+        with self._respcache_lock:
+            ent = self._respcache.get(id)
+            if not ent:
+                return None
+            if ent[0] != fingerprint:
+                del self._respcache[id]
+                return None
+            
+            # move to the end to mark it as most recently used
+            del self._respcache[id]
+            self._respcache[id] = ent
+            return ent
+
+    def _cache_put(self, id, ent):
+        if self._respcache_size <= 0:
+            return
+        with self._respcache_lock:
+            self._respcache.pop(id, None)
+            self._respcache[id] = ent
+            while len(self._respcache) > self._respcache_size:
+                self._respcache.popitem(False)
+
+    def clear_response_cache(self):
+        """
+        remove all records from the in-memory response cache
+        """
+        with self._respcache_lock:
+            self._respcache.clear()
+
     def resolve_id(self, id):
         """
         return a full NERDm resource record corresponding to the given 
         MIDAS ID.  
         """
+        mdata, data, etag = self._resolve_id(id)
+        if mdata is None:
+            mdata = json.loads(data, object_pairs_hook=OrderedDict)
+        return mdata
+
+    def resolve_id_as_json(self, id):
+        """
+        return the full NERDm resource record corresponding to the given 
+        MIDAS ID in its serialized JSON form.  The record is served from the 
+        in-memory response cache if the SIP has not changed since it was 
+        last prepared.
+
+        :return tuple:  a 2-tuple giving the JSON-encoded record and an 
+                        entity tag (a quoted string, suitable for use as an 
+                        HTTP ETag header value) that changes whenever the 
+                        record does.
+        """
+        mdata, data, etag = self._resolve_id(id)
+        return (data, etag)
+
+    def _resolve_id(self, id):
+        # returns a 3-tuple (record, json, etag); record will be None if 
+        # the json was taken from the response cache
+        
         # this handles preparation for a dataset that has been published before.
         prepper = None
 
@@ -271,19 +382,39 @@ class PrePubMetadataService(PublishSystem):
                                                    log=self.log)
                 nerdmfile = prepper.cache_nerdm_rec()
                 if nerdmfile:
-                    return read_nerd(nerdmfile)
+                    mdata = read_nerd(nerdmfile)
+                    return (mdata,) + self._serialize(mdata)
 
             # Not previously published
             raise IDNotFound(id, "No data found for identifier: "+id)
 
+        fingerprint = self.sip_fingerprint(bagger)
+        ent = self._cache_get(bagger.midasid, fingerprint)
+        if ent:
+            self.log.debug("Serving cached metadata for %s", id)
+            if bagger.bagbldr:
+                bagger.bagbldr.disconnect_logfile()
+            return (None, ent[1], ent[2])
+
         # There is a MIDAS submission in progress; create/update the 
         # metadata bag.
         bagger = self.prepare_metadata_bag(id, bagger)
+
+        # the record is not complete (and can't be cached) if there are
+        # files still awaiting examination
+        complete = not (bagger.fileExaminer and bagger.fileExaminer.files)
         if bagger.fileExaminer:
             bagger.fileExaminer.launch(stop_logging=True)
         elif bagger.bagbldr:
             bagger.bagbldr.disconnect_logfile()
-        return self.make_nerdm_record(bagger.bagdir, bagger.datafiles)
+
+        mdata = self.make_nerdm_record(bagger.bagdir, bagger.datafiles)
+        data, etag = self._serialize(mdata)
+        if complete:
+            # note that preparing the bag may have changed it
+            self._cache_put(bagger.midasid,
+                            (self.sip_fingerprint(bagger), data, etag))
+        return (mdata, data, etag)
 
     def locate_data_file(self, id, filepath):
         """
@@ -121,7 +121,7 @@ class Handler(object):
     def get_metadata(self, dsid):
         
         try:
-            mdata = self._svc.resolve_id(dsid)
+            data, etag = self._svc.resolve_id_as_json(dsid)
         except IDNotFound as ex:
             self.send_error(404,"Dataset with ID={0} not available".format(dsid))
             return []
@@ -134,11 +134,26 @@ class Handler(object):
             self.send_error(500, "Internal error")
             return []
 
+        tags = self._if_none_match()
+        if etag in tags or '*' in tags:
+            self.set_response(304, "Not Modified")
+            self.add_header('ETag', etag)
+            self.end_headers()
+            return []
+
         self.set_response(200, "Identifier found")
         self.add_header('Content-Type', 'application/json')
+        self.add_header('ETag', etag)
         self.end_headers()
 
-        return [ json.dumps(mdata, indent=4, separators=(',', ': ')) ]
+        return [ data ]
+
+    def _if_none_match(self):
+        # return the entity tags listed in the If-None-Match request header;
+        # weak tags are compared as strong ones
+        tags = self._env.get('HTTP_IF_NONE_MATCH', '').split(',')
+        tags = [t.strip() for t in tags]
+        return [(t[2:] if t.startswith('W/') else t) for t in tags if t]
 
     def get_datafile(self, id, filepath):
 
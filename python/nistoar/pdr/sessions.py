@@ -0,0 +1,146 @@
+"""
+Shared, connection-pooling HTTP sessions for the clients of PDR services.
+
+Sending each request with the module-level functions of the ``requests``
+package (``requests.get()``, etc.) opens a new TCP (and, for https, TLS)
+connection every time.  Clients that talk to a service many times--e.g. the
+distribution service while an AIP update is being prepared--should instead
+send their requests through the session returned by :func:`get_session`,
+which keeps connections alive for reuse, applies default timeouts, and
+retries requests that fail with a connection error or a 5xx response, backing
+off exponentially between attempts.
+
+Sessions are shared within a process: :func:`get_session` returns the same
+session for the same configuration.  A forked child process (e.g. a worker in
+a process pool) gets its own sessions rather than sharing the parent's
+connections.
+"""
+import os, threading
+from collections import Mapping
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+DEF_POOL_SIZE = 10
+DEF_RETRIES = 3
+DEF_BACKOFF_FACTOR = 0.5
+DEF_CONNECT_TIMEOUT = 10
+DEF_READ_TIMEOUT = 120
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_defaults = {}
+_sessions = {}
+_lock = threading.Lock()
+
+class PooledSession(requests.Session):
+    """
+    a requests Session that keeps a pool of connections alive for reuse,
+    retries failed requests, and applies a default timeout to every request.
+
+    Requests are retried when a connection cannot be made or when the server
+    responds with one of the RETRY_STATUSES; the latter (and read errors) are
+    only retried for idempotent methods (i.e. not POST).
+    """
+
+    def __init__(self, pool_size=DEF_POOL_SIZE, retries=DEF_RETRIES,
+                 backoff_factor=DEF_BACKOFF_FACTOR,
+                 timeout=(DEF_CONNECT_TIMEOUT, DEF_READ_TIMEOUT)):
+        """
+        create the session
+
+        :param int pool_size:         the maximum number of connections to keep
+                                      open to any one server
+        :param int retries:           the maximum number of times to retry a
+                                      failed request
+        :param float backoff_factor:  the factor for calculating the time to
+                                      wait before each retry; the wait after the
+                                      nth failure is backoff_factor*2^(n-1)
+                                      seconds.
+        :param timeout:  the default timeout in seconds, either a single number
+                         or a 2-tuple giving the connect and read timeouts
+                         separately.
+        """
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        self.retries = Retry(total=retries, connect=retries, read=retries,
+                             status=retries, backoff_factor=backoff_factor,
+                             status_forcelist=RETRY_STATUSES,
+                             raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=self.retries)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+def _settings(config):
+    timeout = config.get('timeout', (config.get('connect_timeout',
+                                                DEF_CONNECT_TIMEOUT),
+                                     config.get('read_timeout',
+                                                DEF_READ_TIMEOUT)))
+    if isinstance(timeout, list):
+        timeout = tuple(timeout)
+    return (config.get('pool_size', DEF_POOL_SIZE),
+            config.get('retries', DEF_RETRIES),
+            config.get('backoff_factor', DEF_BACKOFF_FACTOR),
+            timeout)
+
+def configure(config):
+    """
+    set the process-wide default session parameters used by get_session()
+    when it is called without a configuration.  The following configuration
+    properties are supported:
+    :prop pool_size int (10):  the maximum number of connections to keep open
+                               to any one server.
+    :prop retries int (3):     the maximum number of times to retry a failed
+                               request
+    :prop backoff_factor float (0.5):  the factor for calculating the time to
+                               wait before each retry (see PooledSession).
+    :prop connect_timeout float (10):  the default number of seconds to wait
+                               for a connection to a server
+    :prop read_timeout float (120):  the default number of seconds to wait
+                               for data from a server
+    :prop timeout float:       if set, override both connect_timeout and
+                               read_timeout with this value.
+
+    :param dict config:  the session configuration
+    """
+    global _defaults
+    if config is None:
+        config = {}
+    if not isinstance(config, Mapping):
+        raise ValueError("sessions.configure(): config not a dictionary: " +
+                         str(config))
+    with _lock:
+        _defaults = dict(config)
+
+def get_session(config=None):
+    """
+    return a shared PooledSession configured according to the given
+    configuration (see configure() for the supported properties).
+
+    :param dict config:  the session configuration; if None, the defaults
+                         set via configure() will be used.
+    """
+    if config is None:
+        config = _defaults
+    key = (os.getpid(),) + _settings(config)
+    with _lock:
+        out = _sessions.get(key)
+        if out is None:
+            out = PooledSession(*key[1:])
+            _sessions[key] = out
+    return out
+
+def close_all():
+    """
+    close all of the sessions created by this process, releasing their
+    connections.
+    """
+    with _lock:
+        for key in [k for k in _sessions if k[0] == os.getpid()]:
+            _sessions.pop(key).close()
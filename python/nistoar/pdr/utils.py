@@ -2,11 +2,20 @@
 Utility functions useful across the pdr package
 """
 from collections import OrderedDict, Mapping
-import hashlib, json, re, shutil, os, time, subprocess, logging, threading
+import hashlib, json, re, shutil, os, io, time, subprocess, logging, threading
+import multiprocessing, stat
+from multiprocessing.pool import ThreadPool
 try:
     import fcntl
 except ImportError:
     fcntl = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from .exceptions import (NERDError, PODError, StateException)
 
@@ -223,7 +232,8 @@ def write_json(jsdata, destfile, indent=4, nolock=False):
     :param dict jsdata:    the JSON data to write 
     :param str  destfile:  the path to the file to write the data to
     :param int  indent:    the number of characters to use for indentation
-                           (default: 4).
+                           (default: 4).  If None, the data will be written
+                           compactly, without any added whitespace.
     :param bool  nolock:   if False (default), an exclusive lock will be acquired
                            before writing to the file.  A True value writes the 
                            data without a lock
@@ -232,7 +242,10 @@ def write_json(jsdata, destfile, indent=4, nolock=False):
         with LockedFile(destfile, 'a') as fd:
             blab(log, "Acquired exclusive lock for writing: "+destfile)
             fd.truncate(0)
-            json.dump(jsdata, fd, indent=indent, separators=(',', ': '))
+            seps = (',', ': ')
+            if indent is None:
+                seps = (',', ':')
+            json.dump(jsdata, fd, indent=indent, separators=seps)
         blab(log, "released EX")
     except Exception, ex:
         raise StateException("{0}: Failed to write JSON data to file: {1}"
@@ -308,37 +321,166 @@ def build_mime_type_map(filelist):
         update_mimetypes_from_file(out, file)
     return out
 
-def checksum_of(filepath):
+CHECKSUM_BUFSIZE = 10240000   # 10 MB buffer
+
+# read buffers reused across calls to checksum_of(), one per thread
+_readbufs = threading.local()
+
+def _get_read_buffer(size):
+    buf = getattr(_readbufs, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = bytearray(size)
+        _readbufs.buf = buf
+    return buf
+
+def checksum_of(filepath, bufsize=CHECKSUM_BUFSIZE):
     """
     return the checksum for the given file
+
+    :param str filepath:  the path to the file to checksum
+    :param int bufsize:   the size of the buffer to read the file into (which 
+                          is reused across calls within the same thread)
     """
-    bfsz = 10240000   # 10 MB buffer
     sum = hashlib.sha256()
-    with open(filepath) as fd:
+    buf = _get_read_buffer(bufsize)
+    view = memoryview(buf)
+    with io.open(filepath, 'rb', buffering=0) as fd:
+        if hasattr(os, 'posix_fadvise'):
+            # not available before python 3.3
+            os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         while True:
-            buf = fd.read(bfsz)
-            if not buf: break
-            sum.update(buf)
+            n = fd.readinto(buf)
+            if not n: break
+            sum.update(view[:n])
     return sum.hexdigest()
 
-def measure_dir_size(dirpath):
+def _checksum_pair(args):
+    # a checksums_of() task; this must be defined at the module level so that
+    # it can be sent to worker processes
+    return (args[0], checksum_of(*args))
+
+def checksums_of(filepaths, workers=None, processes=False,
+                 bufsize=CHECKSUM_BUFSIZE):
+    """
+    calculate the checksums of many files concurrently, returning them as 
+    they become available.  Hashing is spread across a pool of worker threads
+    (which is effective as the hashing releases the GIL) or, optionally, 
+    processes.  If one of the files cannot be read, the exception will be 
+    raised when its result would have been returned.  
+
+    :param list filepaths:  the paths to the files to checksum
+    :param int workers:     the number of files to hash in parallel; if None,
+                            the number of CPUs will be used.  A value of 1 
+                            will cause the files to be hashed serially.  
+    :param bool processes:  if True, hash the files in a pool of separate 
+                            processes rather than threads
+    :param int bufsize:     the size of the read buffer used by each worker
+    :return generator:  an iterator of 2-tuples giving a file path and its 
+                        checksum; the order of the results will not 
+                        necessarily match the order of the input paths.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for fp in filepaths:
+            yield (fp, checksum_of(fp, bufsize))
+        return
+
+    pool = (processes and multiprocessing.Pool(workers)) or ThreadPool(workers)
+    try:
+        for out in pool.imap_unordered(_checksum_pair,
+                                       [(fp, bufsize) for fp in filepaths]):
+            yield out
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def copy_with_checksum(srcpath, destpath, algorithms=('sha256',),
+                       bufsize=CHECKSUM_BUFSIZE):
+    """
+    copy a file to a new location, calculating its checksums as it is copied
+    so that the file's contents need only be read once.  Like shutil.copy(),
+    the permission bits are copied as well.
+
+    :param str srcpath:      the path to the file to copy
+    :param str destpath:     the destination path; if this is a directory, the
+                             file will be copied into it with the same name.
+    :param list algorithms:  the names of the checksum algorithms to calculate
+                             (as recognized by hashlib); default: ['sha256']
+    :param int bufsize:      the number of bytes to read at a time
+    :return tuple:  a 2-element tuple giving the number of bytes copied and a 
+                    dictionary of the hex checksums keyed by algorithm name.
+    """
+    if os.path.isdir(destpath):
+        destpath = os.path.join(destpath, os.path.basename(srcpath))
+    if isinstance(algorithms, (str, unicode)):
+        algorithms = [ algorithms ]
+    sums = [(a, hashlib.new(a)) for a in algorithms]
+
+    size = 0
+    with open(srcpath, 'rb') as ifd:
+        with open(destpath, 'wb') as ofd:
+            while True:
+                buf = ifd.read(bufsize)
+                if not buf: break
+                for a, sum in sums:
+                    sum.update(buf)
+                ofd.write(buf)
+                size += len(buf)
+    shutil.copymode(srcpath, destpath)
+
+    return (size, dict([(a, sum.hexdigest()) for a, sum in sums]))
+
+def measure_dir_size(dirpath, exclude=None):
     """
     return a pair of numbers representing, in order, the totaled size (in bytes)
     of all files below the directory and the total number of files.  
 
     Note that the byte count does not include the capacity taken up by directory
     entries and thus is not an accurate measure of the space the directory takes
-    up on disk.
+    up on disk.  As with os.walk(), symbolic links to directories are not 
+    followed.  Each entry is examined with a single stat call (or none, for 
+    directories, when os.scandir() or the scandir package is available).
 
     :param str dirpath:  the path to the directory of interest
+    :param list exclude: the names of entries directly within dirpath that 
+                         should not be included in the measurement
     :rtype:  list containing 2 ints
     """
     size = 0
     count = 0
-    for root, subdirs, files in os.walk(dirpath):
-        count += len(files)
-        for f in files:
-            size += os.stat(os.path.join(root,f)).st_size
+    skip = set(exclude or [])
+    todo = [dirpath]
+    while todo:
+        dir = todo.pop()
+        if scandir:
+            for ent in scandir(dir):
+                if dir is dirpath and ent.name in skip:
+                    continue
+                if ent.is_dir(follow_symlinks=False):
+                    todo.append(ent.path)
+                elif not ent.is_dir():
+                    size += ent.stat().st_size
+                    count += 1
+        else:
+            for name in os.listdir(dir):
+                if dir is dirpath and name in skip:
+                    continue
+                path = os.path.join(dir, name)
+                st = os.lstat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append(path)
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        pass   # broken link; count the link itself
+                    if stat.S_ISDIR(st.st_mode):
+                        continue
+                size += st.st_size
+                count += 1
     return [size, count]
 
 def rmtree_sys(rootdir):
@@ -2,6 +2,10 @@ from __future__ import absolute_import
 import os, pdb, sys, json, requests, logging, time, re, hashlib
 import unittest as test
 
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import threading
+
 from nistoar.testing import *
 from nistoar.pdr.distrib import client as dcli
 
@@ -130,10 +134,114 @@ class TestRESTServiceClient(test.TestCase):
         self.assertEqual(resp[0], 404)
         self.assertNotEqual(resp[1], "Bag file found")
 
+    def test_are_available(self):
+        urls = [ "/_aip/pdr1010.mbag0_3-2.zip", "/_aip/goob.zip",
+                 "_aip/pdr1010.mbag0_3-1.zip" ]
+        avail = self.cli.are_available(urls)
+        self.assertEqual(avail, { urls[0]: True, urls[1]: False,
+                                  urls[2]: True })
+        self.assertEqual(self.cli.are_available(urls, 1), avail)
+        self.assertEqual(self.cli.are_available([]), {})
+
     def test_is_available(self):
         self.assertTrue(self.cli.is_available("/_aip/pdr1010.mbag0_3-2.zip"))
         self.assertFalse(self.cli.is_available("/_aip/goob.zip"))
         
+class _RangeHandler(BaseHTTPRequestHandler):
+    # serves the server's content, honoring Range requests; the first 
+    # server.drops responses are cut off halfway through.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        srv = self.server
+        body = srv.content
+        start = 0
+        rng = self.headers.getheader('Range')
+        srv.ranges.append(rng)
+        if rng and srv.honor_range:
+            start = int(re.match(r'bytes=(\d+)-', rng).group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}"
+                             .format(start, len(body)-1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)-start))
+        self.end_headers()
+
+        if srv.drops > 0:
+            srv.drops -= 1
+            self.wfile.write(body[start:start+(len(body)-start)/2])
+            self.close_connection = 1
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+class _RangeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class TestRetrieveFileResume(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.srv = _RangeServer(("localhost", 0), _RangeHandler)
+        self.srv.content = os.urandom(3*1024*1024 + 17)
+        self.srv.drops = 0
+        self.srv.honor_range = True
+        self.srv.ranges = []
+        self.thread = threading.Thread(target=self.srv.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.cli = dcli.RESTServiceClient("http://localhost:{0}"
+                                          .format(self.srv.server_address[1]),
+                                          chunk_size=64*1024)
+        self.out = self.tf.track("resumed.zip")
+        self.tf.track("resumed.zip.part")
+        self.csum = hashlib.sha256(self.srv.content).hexdigest()
+
+    def tearDown(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+        self.tf.clean()
+
+    def test_retrieve(self):
+        self.assertEqual(self.cli.retrieve_file("bag.zip", self.out), self.csum)
+        self.assertEqual(checksum_of(self.out), self.csum)
+        self.assertFalse(os.path.exists(self.out+".part"))
+        self.assertEqual(self.srv.ranges, [None])
+
+    def test_resume(self):
+        self.srv.drops = 2
+        self.assertEqual(self.cli.retrieve_file("bag.zip", self.out), self.csum)
+        self.assertEqual(checksum_of(self.out), self.csum)
+        self.assertFalse(os.path.exists(self.out+".part"))
+        self.assertEqual(len(self.srv.ranges), 3)
+        self.assertIsNone(self.srv.ranges[0])
+        self.assertTrue(self.srv.ranges[1].startswith("bytes="))
+
+    def test_resume_norange(self):
+        # server ignores Range: start over
+        self.srv.drops = 1
+        self.srv.honor_range = False
+        self.assertEqual(self.cli.retrieve_file("bag.zip", self.out), self.csum)
+        self.assertEqual(checksum_of(self.out), self.csum)
+
+    def test_resume_leftover_part(self):
+        with open(self.out+".part", 'wb') as fd:
+            fd.write(self.srv.content[:1000])
+        self.assertEqual(self.cli.retrieve_file("bag.zip", self.out), self.csum)
+        self.assertEqual(checksum_of(self.out), self.csum)
+        self.assertEqual(self.srv.ranges, ["bytes=1000-"])
+
+    def test_give_up(self):
+        self.srv.drops = 10
+        with self.assertRaises(dcli.DistribServerError):
+            self.cli.retrieve_file("bag.zip", self.out)
+        self.assertFalse(os.path.exists(self.out))
+        self.assertTrue(os.path.exists(self.out+".part"))
+        self.assertEqual(len(self.srv.ranges), dcli.DEF_RESUME_ATTEMPTS+1)
+
 
 if __name__ == '__main__':
     test.main()
@@ -177,6 +177,30 @@ class TestDataChecker(test.TestCase):
         self.assertTrue(self.ckr.bag_location("goob.txt"))
         self.assertFalse(self.ckr.available_in_cached_bag(cmp))
 
+    def test_memoized(self):
+        opened = []
+        def open_bag(loc):
+            opened.append(loc)
+            return self.mb_open_bag(loc)
+        self.mb_open_bag = dc.mb.open_bag
+        dc.mb.open_bag = open_bag
+        try:
+            with self.ckr.memoized():
+                for i in range(3):
+                    self.assertTrue(self.ckr.available_in_cached_bag(
+                                                                'trial2.json'))
+                    self.assertTrue(self.ckr.available_in_cached_bag(
+                                                        'trial3/trial3a.json'))
+                self.assertEqual(len(opened), len(set(opened)))
+                n = len(opened)
+                self.assertGreater(n, 0)
+
+            self.assertIsNone(self.ckr._memo)
+            self.assertTrue(self.ckr.available_in_cached_bag('trial2.json'))
+            self.assertGreater(len(opened), n)
+        finally:
+            dc.mb.open_bag = self.mb_open_bag
+
     def test_has_pdr_url(self):
         self.assertTrue(self.ckr.has_pdr_url("http://localhost:8888/od/ds/blah"))
         self.assertFalse(self.ckr.has_pdr_url("http://localhost:8888/goob/blah"))
@@ -284,6 +308,16 @@ class TestDataCheckerWithService(test.TestCase):
         #        re.sub(r'data\.nist\.gov', 'localhost:9091', cmp['downloadURL'])
         # self.assertTrue(self.ckr.available_via_url(cmp))
 
+    def test_available_via_urls(self):
+        urls = [ "http://localhost:9091/od/ds/_aip/pdr1010.mbag0_3-1.zip",
+                 "http://localhost:9091/_aip/goob.zip",
+                 "http://localhost:9091/_aip/pdr1010.mbag0_3-1.zip" ]
+        self.assertEqual(self.ckr.available_via_urls(urls),
+                         [True, False, True])
+        self.assertEqual(self.ckr.available_via_urls(urls, 1),
+                         [True, False, True])
+        self.assertEqual(self.ckr.available_via_urls([]), [])
+
     def test_containing_bag_available(self):
         self.assertTrue(self.ckr.containing_bag_available("trial1.json"))
         self.assertTrue(self.ckr.containing_bag_available("trial2.json"))
@@ -351,6 +385,18 @@ class TestDataCheckerWithService(test.TestCase):
     def test_unavailable_files(self):
         self.assertEqual(len(self.ckr.unavailable_files()), 0)
         self.assertTrue(self.ckr.all_files_available())
+
+    def test_unavailable_files_parallel(self):
+        self.assertEqual(self.ckr.unavailable_files(workers=4), [])
+
+        cmp = self.ckr.bag.nerd_metadata_for('trial3/trial3a.json')
+        cmp['filepath'] = "goob.json"
+        self.assertFalse(self.ckr.containing_bag_available(cmp))
+
+        self.config['check_workers'] = 3
+        self.ckr = dc.DataChecker(NISTBag(self.hbag), self.config,
+                                  logging.getLogger("datachecker"))
+        self.assertTrue(self.ckr.all_files_available())
         
         
 
@@ -340,6 +340,71 @@ class TestMIDASMetadataBaggerMixed(test.TestCase):
         self.assertEqual(data['downloadURL'], dlurl)
         self.assertNotIn('description', data)
 
+    def test_update_resmd_comp(self):
+        self.bagr.resmd = OrderedDict([("@id", "ark:/88434/goob"),
+                                       ("components", [
+            {"@id": "#ref", "title": "ref"},
+            {"@id": "cmps/a.txt", "filepath": "a.txt", "size": 1}
+        ])])
+
+        self.bagr._update_resmd_comp({"@id": "cmps/a.txt", "filepath": "a.txt",
+                                      "size": 2})
+        self.bagr._update_resmd_comp({"@id": "cmps/b.txt", "filepath": "b.txt",
+                                      "size": 3})
+        cmps = self.bagr.resmd['components']
+        self.assertEqual(len(cmps), 3)
+        self.assertEqual(cmps[1]['size'], 2)
+        self.assertEqual(cmps[2]['filepath'], "b.txt")
+
+        self.bagr._update_resmd_comp({"@id": "cmps/b.txt", "filepath": "b.txt",
+                                      "size": 5})
+        self.assertEqual(len(cmps), 3)
+        self.assertEqual(cmps[2]['size'], 5)
+
+        # components are matched by identifier only
+        self.bagr._update_resmd_comp({"@id": "cmps/bee", "filepath": "b.txt",
+                                      "size": 4})
+        self.assertEqual(len(cmps), 4)
+        self.assertEqual(cmps[3]['@id'], "cmps/bee")
+
+        # setting resmd resets the index
+        self.bagr.resmd = {}
+        self.bagr._update_resmd_comp({"@id": "cmps/a.txt", "filepath": "a.txt"})
+        self.assertEqual(self.bagr.resmd['components'],
+                         [{"@id": "cmps/a.txt", "filepath": "a.txt"}])
+
+    @test.skipIf("bench" not in os.environ.get("OAR_TEST_INCLUDE",""),
+                 "kindly skipping benchmarks")
+    def test_ensure_file_metadata_scaling(self):
+        # syncing the file metadata for a SIP (as ensure_data_files() does,
+        # first describing each file and then re-examining it) should take 
+        # linear time:  compare the time per file for 2000 and 20000 files
+        def sync(nfiles, name):
+            sipdir = self.tf.mkdir(name)
+            files = []
+            for i in range(nfiles):
+                destpath = os.path.join(name, "f%d.dat" % i)
+                srcpath = os.path.join(sipdir, "f%d.dat" % i)
+                with open(srcpath, 'w') as fd:
+                    fd.write(str(i))
+                files.append((destpath, srcpath))
+
+            start = time.time()
+            for destpath, srcpath in files:
+                self.bagr.ensure_file_metadata(srcpath, destpath)
+            for destpath, srcpath in files:
+                self.bagr.ensure_file_metadata(srcpath, destpath, True)
+            return (time.time() - start) / nfiles
+
+        self.bagr.resmd = { "components": [] }
+        small = sync(2000, "small")
+        large = sync(20000, "large")
+        print("\nfile metadata sync: {0:.2f} ms/file for 2000 files, {1:.2f} "
+              "ms/file for 20000 files".format(small*1e3, large*1e3),
+              file=sys.stderr)
+        self.assertEqual(len(self.bagr.resmd['components']), 22000)
+        self.assertLess(large, 3 * small)
+
     def test_ensure_file_metadata_checksumfile(self):
         self.assertFalse(os.path.exists(self.bagdir))
         self.assertIsNone(self.bagr.bagbldr.ediid)
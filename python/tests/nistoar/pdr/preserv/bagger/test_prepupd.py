@@ -267,6 +267,23 @@ class TestUpdatePrepper(test.TestCase):
         self.assertIn("data", contents)
         self.assertIn("bagit.txt", contents)
         self.assertIn("bag-info.txt", contents)
+        self.assertNotEqual(os.listdir(os.path.join(root, "data")), [])
+
+    def test_unpack_bag_as_metadata_only(self):
+        root = self.tf.track("goober")
+        bagzip = os.path.join(self.bagsdir, "ABCDEFG.2.mbag0_4-4.zip")
+        
+        self.prepr._unpack_bag_as(bagzip, root, metadata_only=True)
+        self.assertTrue(os.path.exists(root))
+
+        contents = [f for f in os.listdir(root)]
+        self.assertIn("metadata", contents)
+        self.assertIn("multibag", contents)
+        self.assertIn("bagit.txt", contents)
+        self.assertIn("bag-info.txt", contents)
+        self.assertNotIn("data", contents)
+        self.assertTrue(os.path.isfile(os.path.join(root, "metadata",
+                                                    "nerdm.json")))
 
     def test_create_from_headbag(self):
         headbag = os.path.join(self.bagsdir, "ABCDEFG.1.mbag0_4-2.zip")
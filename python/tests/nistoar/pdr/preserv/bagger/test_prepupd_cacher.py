@@ -72,6 +72,9 @@ class TestHeadBagCacher(test.TestCase):
         self.cacher = prepupd.HeadBagCacher(self.distribsvc, self.cachedir)
         self.infodir = os.path.join(self.cachedir, "_info")
 
+    def tearDown(self):
+        self.cacher.close()
+
     def test_recall_head_info(self):
         info = {"9.0": { "id": "pdr0000", "name": "pdr0000.9_0.mbag0_4-13.zip",
                          "size": 5432, "hashtype": "md5", "hash": "xxxxx",
@@ -83,6 +86,9 @@ class TestHeadBagCacher(test.TestCase):
         with open(os.path.join(self.infodir, "pdr0000"), 'w') as fd:
             json.dump(info, fd, indent=2)
 
+        # info saved by an earlier version is migrated into the index
+        self.assertEqual(self.cacher._recall_head_info("pdr0000"), info)
+        self.assertFalse(os.path.exists(os.path.join(self.infodir, "pdr0000")))
         self.assertEqual(self.cacher._recall_head_info("pdr0000"), info)
         self.assertEqual(self.cacher._recall_head_info("pdr0001"), {})
 
@@ -95,11 +101,16 @@ class TestHeadBagCacher(test.TestCase):
                          "version": "1.1" }
         }
         self.cacher._save_head_info("pdr0000", info)
-        
-        with open(os.path.join(self.infodir, "pdr0000")) as fd:
-            data = json.load(fd)
+        self.assertEqual(self.cacher._recall_head_info("pdr0000"), info)
 
-        self.assertEqual(info, data)
+        # the index persists
+        self.cacher.close()
+        self.cacher = prepupd.HeadBagCacher(self.distribsvc, self.cachedir)
+        self.assertEqual(self.cacher._recall_head_info("pdr0000"), info)
+
+        del info["1.1"]
+        self.cacher._save_head_info("pdr0000", info)
+        self.assertEqual(self.cacher._recall_head_info("pdr0000"), info)
 
     def test_head_info_file(self):
         self.assertEqual(self.cacher._head_info_file("pdr2222"),
@@ -114,15 +125,14 @@ class TestHeadBagCacher(test.TestCase):
                          "version": "1.1" }}
               
         self.cacher._cache_head_info("pdr0000", "9.0", info["9.0"])
-        with open(os.path.join(self.infodir, "pdr0000")) as fd:
-            data = json.load(fd)
+        data = self.cacher._recall_head_info("pdr0000")
         self.assertEqual(info, data)
 
         self.cacher._cache_head_info("pdr0000", "1.1", ninfo["1.1"])
-        with open(os.path.join(self.infodir, "pdr0000")) as fd:
-            data = json.load(fd)
+        data = self.cacher._recall_head_info("pdr0000")
         info.update(ninfo)
         self.assertEqual(info, data)
+        self.assertEqual(list(data.keys()), ["9.0", "1.1"])
 
     def test_confirm_bagfile(self):
         hbfile = os.path.join(datadir,"pdr1010.mbag0_3-2.zip")
@@ -140,6 +150,12 @@ class TestHeadBagCacher(test.TestCase):
         self.cacher.confirm_bagfile(info)
         self.assertTrue(os.path.exists(hbfile))
 
+        # a checksum calculated during download is trusted
+        self.cacher.confirm_bagfile(info, checksum=info['checksum']['hash'])
+        with self.assertRaises(prepupd.CorruptedBagError):
+            self.cacher.confirm_bagfile(info, False, "c35f")
+        self.assertTrue(os.path.exists(hbfile))
+
         info["checksum"]["hash"] = "c35f"
         with self.assertRaises(prepupd.CorruptedBagError):
             self.cacher.confirm_bagfile(info, False)
@@ -155,44 +171,35 @@ class TestHeadBagCacher(test.TestCase):
         hbfile = os.path.join(self.cachedir, "pdr1010.mbag0_3-2.zip")
         self.assertTrue(os.path.exists(hbfile))
         self.cacher._cache_head_info("pdr1010", "1", info)
-        with open(os.path.join(self.infodir, "pdr1010")) as fd:
-            data = json.load(fd)
+        data = self.cacher._recall_head_info("pdr1010")
         self.assertIn("1", data)
         
         # now check that the info gets purged, too.
         with self.assertRaises(prepupd.CorruptedBagError):
             self.cacher.confirm_bagfile(info, True)
         self.assertTrue(not os.path.exists(hbfile))
-        with open(os.path.join(self.infodir, "pdr1010")) as fd:
-            data = json.load(fd)
+        data = self.cacher._recall_head_info("pdr1010")
         self.assertNotIn("1", data)
 
     def test_cache_headbag(self):
         hbfile = os.path.join(self.cachedir, "pdr1010.mbag0_3-2.zip")
-        infofile = os.path.join(self.infodir, "pdr1010")
         self.assertTrue(not os.path.exists(hbfile))
-        self.assertTrue(not os.path.exists(infofile))
         self.assertEqual(self.cacher.cache_headbag("pdr1010", "1", True), hbfile)
         self.assertTrue(os.path.exists(hbfile))
-        self.assertTrue(os.path.exists(infofile))
 
         info = self.cacher._recall_head_info("pdr1010")
         self.assertIn("1", info)
 
         hbfile = os.path.join(self.cachedir, "pdr2210.2.mbag0_3-2.zip")
-        infofile = os.path.join(self.infodir, "pdr2210")
         self.assertTrue(not os.path.exists(hbfile))
-        self.assertTrue(not os.path.exists(infofile))
         self.assertEqual(self.cacher.cache_headbag("pdr2210", "2", True), hbfile)
         self.assertTrue(os.path.exists(hbfile))
 
-        self.assertTrue(os.path.exists(infofile))
         info = self.cacher._recall_head_info("pdr2210")
         self.assertIn("2", info)
 
         hbfile = os.path.join(self.cachedir, "pdr2210.3_1_3.mbag0_3-5.zip")
         self.assertTrue(not os.path.exists(hbfile))
-        self.assertTrue(os.path.exists(infofile))
         self.assertEqual(self.cacher.cache_headbag("pdr2210"), hbfile)
         self.assertTrue(os.path.exists(hbfile))
 
@@ -213,9 +220,91 @@ class TestHeadBagCacher(test.TestCase):
 
         self.assertIsNone(self.cacher.cache_headbag("goober"))
 
-        
-        
-                    
+    def test_stats(self):
+        hbfile = os.path.join(self.cachedir, "pdr1010.mbag0_3-2.zip")
+        self.assertEqual(self.cacher.stats['hits'], 0)
+        self.assertEqual(self.cacher.stats['misses'], 0)
+        self.assertEqual(self.cacher.usage, {"count": 0, "size": 0})
+
+        self.cacher.cache_headbag("pdr1010", "1")
+        size = os.stat(hbfile).st_size
+        stats = self.cacher.stats
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['bytes_downloaded'], size)
+        self.assertEqual(self.cacher.usage, {"count": 1, "size": size})
+
+        self.cacher.cache_headbag("pdr1010", "1")
+        stats = self.cacher.stats
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['bytes_served'], size)
+        self.assertEqual(stats['evicted'], 0)
+
+    def test_sync_index(self):
+        shutil.copy(os.path.join(datadir,"pdr1010.mbag0_3-2.zip"), self.cachedir)
+        with open(os.path.join(self.cachedir, "goob.zip.part"), 'w') as fd:
+            fd.write("incomplete")
+        self.cacher.close()
+        self.cacher = prepupd.HeadBagCacher(self.distribsvc, self.cachedir)
+        self.assertEqual(self.cacher.usage['count'], 1)
+
+        os.remove(os.path.join(self.cachedir, "pdr1010.mbag0_3-2.zip"))
+        self.cacher.close()
+        self.cacher = prepupd.HeadBagCacher(self.distribsvc, self.cachedir)
+        self.assertEqual(self.cacher.usage['count'], 0)
+
+    def test_prune_count(self):
+        self.cacher.max_count = 2
+        bag1 = self.cacher.cache_headbag("pdr1010", "1")
+        bag2 = self.cacher.cache_headbag("pdr2210", "2")
+        self.assertEqual(self.cacher.usage['count'], 2)
+
+        # use bag1 so that bag2 is the least recently used
+        time.sleep(0.01)
+        self.cacher.cache_headbag("pdr1010", "1")
+        bag3 = self.cacher.cache_headbag("pdr2210")
+        self.assertEqual(self.cacher.usage['count'], 2)
+        self.assertTrue(os.path.exists(bag1))
+        self.assertFalse(os.path.exists(bag2))
+        self.assertTrue(os.path.exists(bag3))
+        self.assertEqual(self.cacher.stats['evicted'], 1)
+
+        # the head info is retained so that the bag can be refetched
+        self.assertIn("2", self.cacher._recall_head_info("pdr2210"))
+        self.assertEqual(self.cacher.cache_headbag("pdr2210", "2"), bag2)
+        self.assertTrue(os.path.exists(bag2))
+        self.assertFalse(os.path.exists(bag1))
+
+    def test_prune_size(self):
+        bag1 = self.cacher.cache_headbag("pdr1010", "1")
+        size = os.stat(bag1).st_size
+        self.cacher.max_size = size
+
+        # the bag just fetched is kept even if it alone exceeds the limit
+        bag2 = self.cacher.cache_headbag("pdr2210", "2")
+        self.assertFalse(os.path.exists(bag1))
+        self.assertTrue(os.path.exists(bag2))
+        self.assertEqual(self.cacher.usage['count'], 1)
+        self.assertEqual(self.cacher.stats['bytes_evicted'], size)
+
+        # limits are applied when the cache is opened
+        self.cacher.close()
+        self.cacher = prepupd.HeadBagCacher(self.distribsvc, self.cachedir,
+                                            max_count=0)
+        self.assertEqual(self.cacher.usage['count'], 0)
+        self.assertFalse(os.path.exists(bag2))
+
+    def test_prewarm(self):
+        out = self.cacher.prewarm(["pdr1010", "goober", "pdr2210"])
+        self.assertEqual(list(out.keys()), ["pdr1010", "goober", "pdr2210"])
+        self.assertEqual(out["pdr1010"],
+                         os.path.join(self.cachedir, "pdr1010.mbag0_3-2.zip"))
+        self.assertIsNone(out["goober"])
+        self.assertEqual(out["pdr2210"],
+                         os.path.join(self.cachedir, "pdr2210.3_1_3.mbag0_3-5.zip"))
+        self.assertTrue(os.path.exists(out["pdr2210"]))
+        self.assertEqual(self.cacher.stats['misses'], 2)
 
 
 
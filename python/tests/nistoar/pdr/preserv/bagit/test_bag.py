@@ -1,4 +1,4 @@
-import os, sys, pdb, shutil, logging, json, subprocess
+import os, sys, pdb, shutil, logging, json, subprocess, time
 from cStringIO import StringIO
 from io import BytesIO
 import warnings as warn
@@ -331,7 +331,186 @@ class TestNISTBag(test.TestCase):
     def test_is_headbag(self):
         self.assertTrue(self.bag.is_headbag())
 
-                         
+
+class TestZippedNISTBag(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        zipbase = os.path.join(self.tf.mkdir("zips"), "samplembag")
+        self.zipfile = shutil.make_archive(zipbase, "zip", datadir,
+                                           "samplembag")
+        self.bag = bag.ZippedNISTBag(self.zipfile)
+
+    def tearDown(self):
+        self.bag.close()
+        self.tf.clean()
+
+    def test_ctor(self):
+        self.assertEqual(self.bag.zipfile, self.zipfile)
+        self.assertEqual(self.bag.name, "samplembag")
+        self.assertEqual(self.bag.dir, "samplembag")
+        self.assertEqual(self.bag.data_dir, "samplembag/data")
+        self.assertEqual(self.bag.nerd_file_for("trial1.json"),
+                         "samplembag/metadata/trial1.json/nerdm.json")
+
+    def test_notzip(self):
+        with self.assertRaises(exceptions.StateException):
+            bag.ZippedNISTBag(os.path.join(bagdir, "bag-info.txt"))
+
+    def test_nerd_metadata_for(self):
+        data = self.bag.nerd_metadata_for("")
+        self.assertIn("ediid", data)
+        self.assertIn("components", data)
+        self.assertEqual(data, bag.NISTBag(bagdir).nerd_metadata_for(""))
+
+        data = self.bag.nerd_metadata_for("trial3/trial3a.json")
+        self.assertEqual(data['filepath'], 'trial3/trial3a.json')
+        self.assertIn("nrdp:DataFile", data['@type'])
+
+        with self.assertRaises(bagex.ComponentNotFound):
+            self.bag.nerd_metadata_for('goober')
+
+    def test_nerdm_record(self):
+        data = self.bag.nerdm_record()
+        self.assertIn("ediid", data)
+        self.assertEqual(len(data['components']), 5)
+        for comp in data['components']:
+            self.assertNotIn("$schema", comp)
+
+        expect = bag.NISTBag(bagdir).nerdm_record()
+        self.assertEqual(sorted(c['@id'] for c in data['components']),
+                         sorted(c['@id'] for c in expect['components']))
+        self.assertEqual(self.bag.nerdm_record(), data)
+
+    def test_navigation(self):
+        self.assertTrue(self.bag.comp_exists("trial3/trial3a.json"))
+        self.assertFalse(self.bag.comp_exists("trial4"))
+        self.assertTrue(self.bag.is_data_file("trial1.json"))
+        self.assertFalse(self.bag.is_data_file("trial3"))
+        self.assertTrue(self.bag.is_subcoll("trial3"))
+        self.assertEqual(sorted(self.bag.subcoll_children("")),
+                         ["trial1.json", "trial2.json", "trial3"])
+
+    def test_iter_data_files(self):
+        datafiles = list(self.bag.iter_data_files())
+        self.assertEqual(sorted(datafiles), sorted(
+            bag.NISTBag(bagdir).iter_data_files()))
+        self.assertEqual(sorted(self.bag.iter_data_components()), sorted(
+            bag.NISTBag(bagdir).iter_data_components()))
+
+    def test_iter_fetch_records(self):
+        fdata = [t for t in self.bag.iter_fetch_records()]
+        self.assertEqual(len(fdata), 3)
+        self.assertEqual(fdata[0][2], "data/trial1.json")
+        self.assertEqual(fdata[2][2], "data/trial3/trial3a.json")
+
+    def test_get_baginfo(self):
+        data = self.bag.get_baginfo()
+        self.assertEqual(data, bag.NISTBag(bagdir).get_baginfo())
+        self.assertEqual(data['Bag-Count'], [ "1 of 1" ])
+        self.assertEqual(self.bag.bagit_version, "0.97")
+        self.assertTrue(self.bag.is_headbag())
+        self.assertEqual(self.bag.multibag_dir, "samplembag/multibag")
+
+        data = self.bag.get_baginfo("samplembag/goober.txt")
+        self.assertEqual(data, {})
+
+
+class TestNISTBagCache(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.bagdir = self.tf.track("samplembag")
+        shutil.copytree(bagdir, self.bagdir)
+
+        # backdate the metadata files so that they are eligible for caching
+        past = time.time() - 60
+        for root, subdirs, files in os.walk(os.path.join(self.bagdir,
+                                                         "metadata")):
+            for f in files:
+                os.utime(os.path.join(root, f), (past, past))
+        self.bag = bag.NISTBag(self.bagdir)
+
+    def tearDown(self):
+        self.bag = None
+        self.tf.clean()
+
+    def test_nerdm_record_cached(self):
+        data = self.bag.nerdm_record()
+        self.assertEqual(len(data['components']), 5)
+        self.assertTrue(len(self.bag._mdcache) > 0)
+
+        # returned data should be safe to change
+        data['title'] = "Goober"
+        data['components'][0]['title'] = "Gurn"
+        data = self.bag.nerdm_record()
+        self.assertNotEqual(data['title'], "Goober")
+        self.assertNotEqual(data['components'][0].get('title'), "Gurn")
+
+    def test_detect_change(self):
+        data = self.bag.nerdm_record()
+        trial1 = [c for c in data['components']
+                    if c.get('filepath') == "trial1.json"][0]
+        self.assertNotEqual(trial1.get('title'), "Goober")
+
+        mdfile = self.bag.nerd_file_for("trial1.json")
+        with open(mdfile) as fd:
+            md = json.load(fd, object_pairs_hook=OrderedDict)
+        md['title'] = "Goober"
+        with open(mdfile, 'w') as fd:
+            json.dump(md, fd, indent=4)
+
+        data = self.bag.nerdm_record()
+        trial1 = [c for c in data['components']
+                    if c.get('filepath') == "trial1.json"][0]
+        self.assertEqual(trial1['title'], "Goober")
+        self.assertEqual(self.bag.nerd_metadata_for("trial1.json")['title'],
+                         "Goober")
+
+    def test_nocache(self):
+        self.bag = bag.NISTBag(self.bagdir, cache_metadata=False)
+        data = self.bag.nerdm_record()
+        self.assertEqual(len(data['components']), 5)
+        self.assertIsNone(self.bag._mdcache)
+
+    def test_cache_limit(self):
+        data = self.bag.nerdm_record()
+        full = self.bag._mdcache_size
+        self.assertEqual(len(self.bag._mdcache), 5)
+        self.assertEqual(full, sum([len(e[1])
+                                    for e in self.bag._mdcache.values()]))
+
+        # the cache should only hold as much as its limit allows, dropping
+        # the least recently used entries
+        self.bag = bag.NISTBag(self.bagdir, cache_metadata=full//2)
+        self.assertEqual(self.bag.nerdm_record(), data)
+        self.assertLessEqual(self.bag._mdcache_size, full//2)
+        self.assertLess(len(self.bag._mdcache), 5)
+        self.assertGreater(len(self.bag._mdcache), 0)
+        self.assertEqual(self.bag.nerdm_record(), data)
+
+        self.bag.clear_cache()
+        self.assertEqual(len(self.bag._mdcache), 0)
+        self.assertEqual(self.bag._mdcache_size, 0)
+
+    @test.skipIf("bench" not in os.environ.get("OAR_TEST_INCLUDE",""),
+                 "kindly skipping benchmarks")
+    def test_cache_speedup(self):
+        def timeit(bg, merge):
+            bg.nerdm_record(merge)
+            start = time.time()
+            for i in range(500):
+                bg.nerdm_record(merge)
+            return time.time() - start
+
+        for merge in (True, False):
+            cached = timeit(self.bag, merge)
+            uncached = timeit(bag.NISTBag(self.bagdir, cache_metadata=False),
+                              merge)
+            sys.stderr.write("\nnerdm_record({0}): {1:.3f}s cached, {2:.3f}s "
+                             "uncached".format(merge, cached, uncached))
+            self.assertLess(cached, uncached)
+
 
 if __name__ == '__main__':
     test.main()
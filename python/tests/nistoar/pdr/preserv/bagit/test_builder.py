@@ -1,4 +1,4 @@
-import os, sys, pdb, shutil, logging, json, re
+import os, sys, pdb, shutil, logging, json, re, time
 from cStringIO import StringIO
 from shutil import copy2 as filecopy, rmtree
 from io import BytesIO
@@ -9,7 +9,8 @@ from collections import OrderedDict
 from nistoar.testing import *
 import nistoar.pdr.preserv.bagit.builder as bldr
 import nistoar.pdr.exceptions as exceptions
-from nistoar.pdr.utils import read_nerd
+from nistoar.pdr.utils import read_nerd, checksum_of
+from nistoar.pdr.checksumcache import ChecksumCache
 
 # datadir = tests/nistoar/pdr/preserv/data
 datadir = os.path.join(
@@ -742,6 +743,72 @@ class TestBuilder2(test.TestCase):
         written = comps[0]
         self.assertEqual(md, written)
 
+    def test_update_nonfile_metadata_in_batch(self):
+        self.bag.define_component("@id:#ref0", "grn:Goober")
+        with self.bag.batch():
+            for i in range(200):
+                self.bag.update_metadata_for("@id:#ref%d" % i, {"n": i},
+                                             "grn:Goober")
+            md = self.bag.update_metadata_for("@id:#ref5", {"foo": "bar"})
+            self.assertEqual(md['n'], 5)
+            self.assertEqual(md['foo'], "bar")
+
+            # the resource metadata is parsed once and then kept in memory
+            memo = self.bag._nonfile_comps_in()
+            self.assertIs(self.bag._nonfile_comps_in(), memo)
+            self.assertEqual(memo[2]["#ref199"], 199)
+
+            # changing a component's identifier updates the index
+            self.bag.replace_metadata_for("@id:#ref7", {"@id": "#seven"})
+            self.assertTrue(self.bag._has_nonfile_comp("#seven"))
+            self.assertFalse(self.bag._has_nonfile_comp("#ref7"))
+
+            self.assertTrue(self.bag.remove_component("@id:#ref3"))
+            self.assertFalse(self.bag._has_nonfile_comp("#ref3"))
+            md = self.bag.update_metadata_for("@id:#ref4", {"foo": "gurn"})
+            self.assertEqual(md['n'], 4)
+
+        written = read_nerd(self.bag.bag.nerd_file_for(""))
+        comps = written['components']
+        self.assertEqual(len(comps), 199)
+        self.assertEqual([c['@id'] for c in comps].count("#ref0"), 1)
+        self.assertEqual(comps[0]['n'], 0)
+        self.assertEqual(comps[3]['foo'], "gurn")
+        self.assertEqual(comps[4]['foo'], "bar")
+        self.assertEqual(comps[6], {"@id": "#seven"})
+        self.assertEqual(comps[-1]['n'], 199)
+
+    def test_nonfile_lookup_in_batch(self):
+        self.bag.update_metadata_for("", {"title": "Goober"})
+        with self.bag.batch():
+            self.assertFalse(self.bag._has_nonfile_comp("#ref0"))
+            self.bag.update_metadata_for("", {"description": ["gurn"]})
+            self.assertFalse(self.bag._has_nonfile_comp("#ref0"))
+
+        # a lookup does not add an empty components list
+        written = read_nerd(self.bag.bag.nerd_file_for(""))
+        self.assertEqual(written['description'], ["gurn"])
+        self.assertNotIn('components', written)
+
+    def test_nonfile_batch_scaling(self):
+        # the cost of an update within a batch should not grow with the 
+        # number of components already there
+        def time_updates(bag, n):
+            start = time.time()
+            with bag.batch():
+                for i in range(n):
+                    bag.update_metadata_for("@id:#ref%d" % i, {"n": i},
+                                            "grn:Goober")
+            return (time.time() - start) / n
+
+        small = time_updates(self.bag, 100)
+        self.tf.track("otherbag")
+        with bldr.BagBuilder(self.tf.root, "otherbag", self.cfg) as other:
+            large = time_updates(other, 800)
+            self.assertEqual(len(read_nerd(other.bag.nerd_file_for(""))
+                                 ['components']), 800)
+        self.assertLess(large, 3 * small)
+
     def test_update_metadata_for_resource(self):
         md = self.bag.define_component("", "Resource")
         self.assertNotIn("foo", md)
@@ -754,6 +821,206 @@ class TestBuilder2(test.TestCase):
         written = read_nerd(self.bag.bag.nerd_file_for(""))
         self.assertEqual(md, written)
 
+    def test_batch(self):
+        self.bag.define_component("trial/readme.txt", "DataFile")
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+        newfile = self.bag.bag.nerd_file_for("trial/sub/data.csv")
+        before = read_nerd(mdfile)
+
+        with self.bag.batch():
+            self.bag.update_metadata_for("trial/readme.txt", {"foo": "bar"})
+            md = self.bag.update_metadata_for("trial/readme.txt",
+                                              {"goob": "gurn"})
+            self.assertEqual(md['foo'], "bar")
+            self.assertEqual(md['goob'], "gurn")
+            self.bag.define_component("trial/sub/data.csv", "DataFile")
+
+            # nothing written yet, but the bag view sees the updates
+            self.assertEqual(read_nerd(mdfile), before)
+            self.assertFalse(os.path.exists(newfile))
+            self.assertEqual(self.bag.bag.nerd_metadata_for(
+                                                 "trial/readme.txt")['goob'],
+                             "gurn")
+            self.assertTrue(self.bag.bag.is_subcoll("trial/sub"))
+
+            with self.bag.batch():
+                self.bag.update_metadata_for("trial/readme.txt",
+                                             {"hand": "eye"})
+
+        written = read_nerd(mdfile)
+        self.assertEqual(written['foo'], "bar")
+        self.assertEqual(written['goob'], "gurn")
+        self.assertEqual(written['hand'], "eye")
+        self.assertTrue(os.path.exists(newfile))
+        self.assertTrue(os.path.exists(
+            self.bag.bag.nerd_file_for("trial/sub")))
+        self.assertEqual([f for f in os.listdir(os.path.dirname(mdfile))
+                            if f.startswith('.')], [])
+        self.assertIsNone(self.bag._batch)
+
+    def test_batch_abort(self):
+        self.bag.define_component("trial/readme.txt", "DataFile")
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+        before = read_nerd(mdfile)
+
+        with self.assertRaises(RuntimeError):
+            with self.bag.batch():
+                self.bag.update_metadata_for("trial/readme.txt",
+                                             {"foo": "bar"})
+                self.bag.define_component("trial/sub/data.csv", "DataFile")
+                self.bag.update_metadata_for("@id:#goob", {"foo": "bar"},
+                                             "grn:Goober")
+                raise RuntimeError("crash")
+
+        self.assertEqual(read_nerd(mdfile), before)
+        self.assertFalse(os.path.exists(os.path.join(self.bag.bagdir,
+                                                     "metadata", "trial",
+                                                     "sub")))
+        self.assertFalse(os.path.exists(self.bag.bag.nerd_file_for("")))
+        self.assertIsNone(self.bag._batch)
+        self.assertNotIn('foo',
+                         self.bag.bag.nerd_metadata_for("trial/readme.txt"))
+
+    def test_batch_remove(self):
+        self.bag.define_component("trial/readme.txt", "DataFile")
+        self.bag.define_component("trial/sub/data.csv", "DataFile")
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+        before = read_nerd(mdfile)
+
+        with self.assertRaises(RuntimeError):
+            with self.bag.batch():
+                self.bag.update_metadata_for("trial/readme.txt",
+                                             {"foo": "bar"})
+                self.assertTrue(self.bag.remove_component("trial/readme.txt"))
+                self.assertTrue(self.bag.remove_component("trial/sub"))
+                self.assertFalse(self.bag.bag.comp_exists("trial/readme.txt"))
+                self.assertFalse(self.bag.bag.comp_exists("trial/sub"))
+                self.bag.define_component("trial/sub", "Subcollection")
+                raise RuntimeError("crash")
+
+        # the removals are undone
+        self.assertEqual(read_nerd(mdfile), before)
+        self.assertTrue(self.bag.bag.comp_exists("trial/sub/data.csv"))
+        self.assertFalse(os.path.exists(os.path.join(self.bag.bagdir,
+                                                 bldr._BatchBagView.TRASH_DIR)))
+
+        with self.bag.batch():
+            self.assertTrue(self.bag.remove_component("trial/readme.txt"))
+            self.assertTrue(self.bag.remove_component("trial/sub"))
+            self.bag.define_component("trial/sub/new.csv", "DataFile")
+
+        self.assertFalse(os.path.exists(mdfile))
+        self.assertFalse(self.bag.bag.comp_exists("trial/sub/data.csv"))
+        self.assertTrue(self.bag.bag.comp_exists("trial/sub/new.csv"))
+        self.assertFalse(os.path.exists(os.path.join(self.bag.bagdir,
+                                                 bldr._BatchBagView.TRASH_DIR)))
+
+    def test_batch_leftovers(self):
+        self.bag.define_component("trial/readme.txt", "DataFile")
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+
+        # simulate a session that crashed while committing
+        tmpf = os.path.join(os.path.dirname(mdfile), ".nerdm.json.batch")
+        with open(tmpf, 'w') as fd:
+            fd.write("{")
+        trash = os.path.join(self.bag.bagdir, bldr._BatchBagView.TRASH_DIR)
+        os.mkdir(trash)
+        os.mkdir(os.path.join(trash, "0"))
+
+        with self.bag.batch():
+            self.assertFalse(os.path.exists(tmpf))
+            self.assertFalse(os.path.exists(trash))
+            self.bag.update_metadata_for("trial/readme.txt", {"foo": "bar"})
+
+    def test_abandoned_batch(self):
+        self.bag.define_component("trial/readme.txt", "DataFile")
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+        before = read_nerd(mdfile)
+
+        # open a session and abandon it (as if the process crashed)
+        session = self.bag.batch()
+        session.__enter__()
+        self.assertTrue(self.bag.remove_component("trial/readme.txt"))
+        self.bag.define_component("trial/sub/data.csv", "DataFile")
+        self.assertFalse(os.path.exists(mdfile))
+        self.bag.disconnect_logfile()
+
+        self.bag = bldr.BagBuilder(self.tf.root, "testbag", self.cfg)
+        with self.bag.batch():
+            pass
+        self.assertEqual(read_nerd(mdfile), before)
+        self.assertFalse(os.path.exists(os.path.join(self.bag.bagdir,
+                                                 "metadata", "trial", "sub")))
+        self.assertFalse(os.path.exists(os.path.join(self.bag.bagdir,
+                                                 bldr._BatchBagView.TRASH_DIR)))
+
+    def test_interrupted_commit(self):
+        self.bag.define_component("trial/readme.txt", "DataFile")
+        self.bag.define_component("trial/goob.txt", "DataFile")
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+        mdfile2 = self.bag.bag.nerd_file_for("trial/goob.txt")
+
+        def crash(renames):
+            # complete only the first rename
+            os.rename(*renames[0])
+            raise RuntimeError("crash")
+
+        session = self.bag.batch()
+        session.__enter__()
+        self.bag.update_metadata_for("trial/readme.txt", {"foo": "bar"})
+        self.bag.update_metadata_for("trial/goob.txt", {"foo": "bar"})
+        self.assertTrue(self.bag.remove_component("trial"))
+        self.bag.define_component("trial/readme.txt", "DataFile")
+        self.bag.update_metadata_for("trial/readme.txt", {"foo": "bar"})
+        self.bag.update_metadata_for("trial/goob.txt", {"foo": "gurn"},
+                                     "DataFile")
+        self.bag._batch._rename_all = crash
+        with self.assertRaises(RuntimeError):
+            self.bag._batch.commit()
+        self.bag.disconnect_logfile()
+
+        # the commit gets completed
+        self.bag = bldr.BagBuilder(self.tf.root, "testbag", self.cfg)
+        with self.bag.batch():
+            pass
+        self.assertEqual(read_nerd(mdfile)['foo'], "bar")
+        self.assertEqual(read_nerd(mdfile2)['foo'], "gurn")
+        self.assertEqual([f for f in os.listdir(os.path.dirname(mdfile))
+                            if f.startswith('.')], [])
+        self.assertFalse(os.path.exists(os.path.join(self.bag.bagdir,
+                                                 bldr._BatchBagView.TRASH_DIR)))
+
+    def test_finalize_leftovers(self):
+        self.bag.update_metadata_for("trial/readme.txt", {"foo": "bar"},
+                                     "DataFile")
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+        tmpf = os.path.join(os.path.dirname(mdfile), ".nerdm.json.batch")
+        with open(tmpf, 'w') as fd:
+            fd.write("{")
+
+        self.bag.finalize_bag()
+        self.assertFalse(os.path.exists(tmpf))
+        self.assertEqual(read_nerd(mdfile)['foo'], "bar")
+
+    def test_compact_json(self):
+        self.bag.cfg['compact_json'] = True
+        self.bag.update_metadata_for("trial/readme.txt", {"foo": "bar"},
+                                     "DataFile")
+        self.bag.update_annotations_for("trial/readme.txt", {"goob": "gurn"})
+        mdfile = self.bag.bag.nerd_file_for("trial/readme.txt")
+        afile = self.bag.bag.annotations_file_for("trial/readme.txt")
+        for f in [mdfile, afile, self.bag.bag.nerd_file_for("trial")]:
+            with open(f) as fd:
+                self.assertNotIn('\n', fd.read())
+        md = read_nerd(mdfile)
+        self.assertEqual(md['foo'], "bar")
+
+        self.bag.pretty_print_metadata()
+        for f in [mdfile, afile, self.bag.bag.nerd_file_for("trial")]:
+            with open(f) as fd:
+                self.assertIn('\n    "', fd.read())
+        self.assertEqual(read_nerd(mdfile), md)
+
     def test_replace_annotation_for_file(self):
         input = { "foo": "bar", "hank": "herb" }
         md = self.bag.replace_annotations_for("readme.txt", input)
@@ -1004,6 +1271,21 @@ class TestBuilder2(test.TestCase):
         self.assertEquals(self.bag._determine_file_comp_type("goob.txt.sha"),
                           "DataFile")
 
+    def test_describe_data_file_with_cache(self):
+        srcfile = os.path.join(datadir, "trial1.json")
+        self.bag.checksum_cache = ChecksumCache(self.tf.track("cs.sqlite"))
+        try:
+            md = self.bag.describe_data_file(srcfile, "goob/trial1.json")
+            self.assertEqual(md['checksum']['hash'], checksum_of(srcfile))
+            self.assertEqual(self.bag.checksum_cache.stats['misses'], 1)
+            self.assertEqual(self.bag.checksum_cache.stats['stored'], 1)
+
+            md = self.bag.describe_data_file(srcfile, "goob/trial1.json")
+            self.assertEqual(md['checksum']['hash'], checksum_of(srcfile))
+            self.assertEqual(self.bag.checksum_cache.stats['hits'], 1)
+        finally:
+            self.bag.checksum_cache.close()
+
     def test_describe_data_file(self):
         srcfile = os.path.join(datadir, "trial1.json")
 
@@ -1139,10 +1421,91 @@ class TestBuilder2(test.TestCase):
         self.assertEqual(md['@id'], "cmps/gurn/trial1.json")
         self.assertEqual(md['mediaType'], "application/json")
         self.assertEqual(md['size'], 69)
+        self.assertEqual(md['checksum']['hash'], checksum_of(srcfile))
 
         md = self.bag.bag.nerd_metadata_for("gurn")
         self.assertEqual(md['filepath'], "gurn")
         self.assertEqual(md['@id'], "cmps/gurn")
+
+    def test_payload_counts(self):
+        srcfile = os.path.join(datadir, "trial1.json")
+        bigfile = os.path.join(datadir, "_nerdm.json")
+        ddir = os.path.join(self.bag.bagdir, "data")
+
+        self.bag.add_data_file("goob/trial1.json", srcfile, False)
+        self.bag.add_data_file("goob/trial2.json", srcfile, False)
+        self.bag.add_data_file("gurn/trial1.json", srcfile, False, True)
+        self.assertEqual(self.bag._payload_counts, [3*69, 3])
+        self.assertEqual(self.bag._payload_counts,
+                         bldr.measure_dir_size(ddir))
+
+        # replace a file
+        self.bag.add_data_file("goob/trial2.json", bigfile, False)
+        self.assertEqual(self.bag._payload_counts,
+                         bldr.measure_dir_size(ddir))
+
+        self.bag.remove_component("goob/trial1.json")
+        self.assertEqual(self.bag._payload_counts,
+                         bldr.measure_dir_size(ddir))
+        self.bag.remove_component("goob")
+        self.assertEqual(self.bag._payload_counts, [69, 1])
+
+        # a new builder on an existing bag measures the payload when needed
+        self.bag.disconnect_logfile()
+        self.bag = bldr.BagBuilder(self.tf.root, "testbag", self.cfg)
+        self.assertIsNone(self.bag._payload_counts)
+        self.assertEqual(self.bag._measure_payload(), [69, 1])
+        self.bag.add_data_file("trial2.json", srcfile, False)
+        self.assertEqual(self.bag._measure_payload(), [2*69, 2])
+
+        # changes made behind the builder's back are caught when verifying
+        os.remove(os.path.join(ddir, "trial2.json"))
+        self.assertEqual(self.bag._measure_payload(), [2*69, 2])
+        self.bag.cfg['verify_payload_oxum'] = True
+        self.assertEqual(self.bag._measure_payload(), [69, 1])
+
+    def test_payload_counts_replaced_bag(self):
+        srcfile = os.path.join(datadir, "trial1.json")
+        self.bag.add_data_file("trial1.json", srcfile, False)
+        self.assertEqual(self.bag._measure_payload(), [69, 1])
+        saved = os.path.join(self.tf.root, "savedbag")
+        shutil.copytree(self.bag.bagdir, saved)
+        self.tf.track("savedbag")
+
+        self.bag.add_data_file("trial2.json", srcfile, False)
+        self.assertEqual(self.bag._measure_payload(), [2*69, 2])
+
+        # replace the bag underneath the builder
+        rmtree(self.bag.bagdir)
+        shutil.copytree(saved, self.bag.bagdir)
+        self.assertEqual(self.bag._measure_payload(), [69, 1])
+        self.bag.add_data_file("trial3.json", srcfile, False)
+        self.assertEqual(self.bag._payload_counts, [2*69, 2])
+
+    def test_add_data_file_checksum_on_copy(self):
+        srcfile = os.path.join(datadir, "trial1.json")
+        self.bag.add_data_file("gurn/trial1.json", srcfile)
+        self.assertIn("gurn/trial1.json", self.bag._copysums)
+        self.assertEqual(self.bag._copysums["gurn/trial1.json"][2],
+                         checksum_of(srcfile))
+        self.assertEqual(self.bag._data_checksum_of("gurn/trial1.json"),
+                         checksum_of(srcfile))
+
+        # a change to the file is detected
+        dfile = os.path.join(self.bag.bag.data_dir, "gurn/trial1.json")
+        with open(dfile, 'a') as fd:
+            fd.write("\n\n")
+        self.assertEqual(self.bag._data_checksum_of("gurn/trial1.json"),
+                         checksum_of(dfile))
+        self.assertNotIn("gurn/trial1.json", self.bag._copysums)
+
+        self.bag.cfg['checksum_on_copy'] = False
+        self.bag.add_data_file("gurn/trial2.json",
+                               os.path.join(datadir, "trial2.json"))
+        self.assertNotIn("gurn/trial2.json", self.bag._copysums)
+        md = self.bag.bag.nerd_metadata_for("gurn/trial2.json")
+        self.assertEqual(md['checksum']['hash'],
+                         checksum_of(os.path.join(datadir, "trial2.json")))
                         
     def test_update_ediid(self):
         self.assertIsNone(self.bag.ediid)
@@ -7,6 +7,7 @@ from nistoar.testing import *
 from nistoar.pdr.preserv.bagit import serialize as ser
 import nistoar.pdr.preserv.bagit.builder as bldr
 from nistoar.pdr.preserv.bagit.exceptions import BagSerializationError
+from nistoar.pdr.utils import checksum_of
 
 def setUpModule():
     global loghdlr
@@ -77,6 +78,99 @@ class TestSerialize(test.TestCase):
         self.assertIn("badsip/", contents)
         self.assertIn("badsip/trial1.json", contents)
         
+    def test_zipstream_serialize(self):
+        outzip = os.path.join(self.tmpdir, "badsip.zip")
+        self.assertTrue(not os.path.exists(outzip))
+
+        out = ser.zipstream_serialize(badsip, self.tmpdir, log)
+        self.assertEqual(out, (outzip, checksum_of(outzip)))
+        self.assertTrue(zip.is_zipfile(outzip))
+        self.assertFalse(os.path.exists(outzip+".part"))
+        z = zip.ZipFile(outzip)
+        contents = z.namelist()
+        self.assertEqual(len(contents), 2)
+        self.assertIn("badsip/", contents)
+        self.assertIn("badsip/trial1.json", contents)
+        self.assertIsNone(z.testzip())
+        with open(os.path.join(badsip, "trial1.json")) as fd:
+            self.assertEqual(z.read("badsip/trial1.json"), fd.read())
+        self.assertEqual(z.getinfo("badsip/trial1.json").compress_type,
+                         zip.ZIP_DEFLATED)
+
+    def test_zipstream_serialize_stored(self):
+        bagdir = self.tf.mkdir("goob")
+        os.mkdir(os.path.join(bagdir, "data"))
+        with open(os.path.join(bagdir, "data", "img.png"), 'w') as fd:
+            fd.write(1000 * "x")
+        with open(os.path.join(bagdir, "data", "img.txt"), 'w') as fd:
+            fd.write(1000 * "x")
+
+        outzip, csum = ser.zipstream_serialize(bagdir, self.tmpdir, log)
+        z = zip.ZipFile(outzip)
+        self.assertEqual(z.namelist(), ["goob/", "goob/data/",
+                                        "goob/data/img.png",
+                                        "goob/data/img.txt"])
+        self.assertIsNone(z.testzip())
+        self.assertEqual(z.getinfo("goob/data/img.png").compress_type,
+                         zip.ZIP_STORED)
+        self.assertEqual(z.getinfo("goob/data/img.txt").compress_type,
+                         zip.ZIP_DEFLATED)
+        self.assertEqual(z.read("goob/data/img.png"), 1000 * "x")
+
+    def test_zipstream_serialize_nonascii(self):
+        bagdir = self.tf.mkdir("goob")
+        os.mkdir(os.path.join(bagdir, "data"))
+        utf8name = u"caf\u00e9.txt".encode('utf-8')
+        latin1name = u"na\u00efve.txt".encode('latin-1')
+        for name in [utf8name, latin1name]:
+            with open(os.path.join(bagdir, "data", name), 'w') as fd:
+                fd.write(name)
+
+        outzip, csum = ser.zipstream_serialize(bagdir, self.tmpdir, log)
+        z = zip.ZipFile(outzip)
+        self.assertIsNone(z.testzip())
+        info = z.getinfo(u"goob/data/caf\u00e9.txt")
+        self.assertTrue(info.flag_bits & 0x800)
+        self.assertEqual(z.read(info), utf8name)
+        info = [i for i in z.infolist()
+                  if i.filename.startswith("goob/data/na")][0]
+        self.assertFalse(info.flag_bits & 0x800)
+        self.assertEqual(z.read(info), latin1name)
+
+    def test_zipstream_serialize_zip64(self):
+        limit = ser.ZIP64_LIMIT
+        ser.ZIP64_LIMIT = 100
+        try:
+            outzip, csum = ser.zipstream_serialize(badsip, self.tmpdir, log)
+        finally:
+            ser.ZIP64_LIMIT = limit
+
+        z = zip.ZipFile(outzip)
+        self.assertIsNone(z.testzip())
+        with open(os.path.join(badsip, "trial1.json")) as fd:
+            self.assertEqual(z.read("badsip/trial1.json"), fd.read())
+
+    def test_zipstream_serialize_fail(self):
+        baddir = os.path.join(badsip, "goob")
+        with self.assertRaises(Exception):
+            ser.zipstream_serialize(baddir, self.tmpdir, log)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_zipstream_serialize_policy(self):
+        bagdir = self.tf.mkdir("goob")
+        for f in "a.h5 a.dat a.tif".split():
+            with open(os.path.join(bagdir, f), 'w') as fd:
+                fd.write(1000 * "x")
+
+        policy = ser.CompressionPolicy({"incompressible_exts": ["dat"]})
+        outzip, csum = ser.zipstream_serialize(bagdir, self.tmpdir, log,
+                                               compress=policy)
+        z = zip.ZipFile(outzip)
+        self.assertIsNone(z.testzip())
+        self.assertEqual(z.getinfo("goob/a.dat").compress_type, zip.ZIP_STORED)
+        self.assertEqual(z.getinfo("goob/a.h5").compress_type, zip.ZIP_DEFLATED)
+        self.assertEqual(z.getinfo("goob/a.tif").compress_type, zip.ZIP_STORED)
+
     def test_7z_serialize(self):
         destfile = "badsip.7z"
         outzip = os.path.join(self.tmpdir, destfile)
@@ -105,6 +199,40 @@ class TestSerialize(test.TestCase):
             ser.zip7_serialize(baddir, destdir, log, destfile)
         self.assertTrue(not os.path.exists(outzip))
 
+class TestCompressionPolicy(test.TestCase):
+
+    def test_default(self):
+        policy = ser.CompressionPolicy()
+        self.assertEqual(policy.mimetypes['png'], "image/png")
+        self.assertTrue(policy("data/trial1.json"))
+        self.assertTrue(policy("data/README"))
+        self.assertTrue(policy("data/image.svg"))
+        self.assertFalse(policy("data/image.png"))
+        self.assertFalse(policy("data/IMAGE.JPG"))
+        self.assertFalse(policy("data/image.tif"))
+        self.assertFalse(policy("data/movie.mp4"))
+        self.assertFalse(policy("data/data.zip"))
+        self.assertFalse(policy("data/data.tar.gz"))
+        self.assertFalse(policy("data/data.h5"))
+
+    def test_config(self):
+        policy = ser.CompressionPolicy({
+            "incompressible_types": ["image/"],
+            "incompressible_exts": [".dat"]
+        })
+        self.assertFalse(policy("data/image.svg"))
+        self.assertFalse(policy("data/image.png"))
+        self.assertFalse(policy("data/data.dat"))
+        self.assertTrue(policy("data/data.h5"))
+        self.assertTrue(policy("data/data.zip"))
+
+    def test_is_incompressible_type(self):
+        policy = ser.CompressionPolicy()
+        self.assertTrue(policy.is_incompressible_type("video/mpeg"))
+        self.assertTrue(policy.is_incompressible_type("application/zip"))
+        self.assertFalse(policy.is_incompressible_type("application/json"))
+        self.assertFalse(policy.is_incompressible_type("video"))
+
 class TestDefaultSerializer(test.TestCase):
     def setUp(self):
         self.tf = Tempfiles()
@@ -130,6 +258,24 @@ class TestDefaultSerializer(test.TestCase):
         self.assertIn("badsip/", contents)
         self.assertIn("badsip/trial1.json", contents)
         
+    def test_serialize_with_checksum(self):
+        outzip = self.tf.track("badsip.zip")
+        out = self.ser.serialize_with_checksum(badsip, os.path.dirname(outzip),
+                                               "zip", log)
+        self.assertEqual(out, (outzip, checksum_of(outzip)))
+
+    def test_register(self):
+        def serfunc(bagdir, destdir, log):
+            return os.path.join(destdir, "goob.zip"), "abc"
+        self.ser.register("goob", serfunc, True)
+        self.assertIn('goob', self.ser.formats)
+        self.assertEqual(self.ser.serialize(badsip, "/tmp", "goob"),
+                         "/tmp/goob.zip")
+        self.assertEqual(self.ser.serialize_with_checksum(badsip, "/tmp", "goob"),
+                         ("/tmp/goob.zip", "abc"))
+        with self.assertRaises(TypeError):
+            self.ser.register("goob", "goob")
+
     def test_7z(self):
         outzip = self.tf.track("badsip.7z")
         self.assertTrue(not os.path.exists(outzip))
@@ -156,6 +156,59 @@ class TestBagItValidator(test.TestCase):
         self.assertTrue(has_error(errs, "2.1.3-7"))
         self.assertTrue(has_error(errs, "3-1-2"))
         self.assertTrue(has_error(errs, "2.1.3-4"))
+
+
+    def test_manifest_progress(self):
+        calls = []
+        self.valid8.progress = lambda *args: calls.append(args)
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertEqual(errs.failed(), [])
+
+        sizes = [os.stat(os.path.join(self.bagdir, "data", f)).st_size
+                 for f in "trial1.json trial2.json trial3/trial3a.json".split()]
+        self.assertEqual(len(calls), 3)
+        self.assertEqual([c[1] for c in calls], [1, 2, 3])
+        self.assertTrue(all(c[0] == "manifest-sha256.txt" and c[2] == 3 and
+                            c[4] == sum(sizes) for c in calls))
+        self.assertEqual(calls[-1][3], sum(sizes))
+
+        # the largest files are verified first
+        del calls[:]
+        self.valid8.cfg = { "test_manifest": { "checksum_workers": 1 } }
+        self.valid8.test_manifest(self.bag)
+        done = [0] + [c[3] for c in calls]
+        self.assertEqual([done[i+1]-done[i] for i in range(3)],
+                         sorted(sizes, reverse=True))
+
+    def test_manifest_stop_on_failure(self):
+        mf = os.path.join(self.bag.dir, "manifest-sha256.txt")
+        with open(mf) as fd:
+            lines = fd.readlines()
+        with open(mf, 'w') as fd:
+            for line in lines:
+                fd.write("x9sx8lsd "+line.split()[1]+"\n")
+
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertEqual(len(errs.failed()), 1)
+        self.assertEqual(len(errs.failed()[0].comments), 4)
+
+        self.valid8.cfg = {
+            "test_manifest": {
+                "stop_on_failure": True,
+                "checksum_workers": 1
+            }
+        }
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertEqual(len(errs.failed()), 1)
+        self.assertTrue(has_error(errs, "3-2-2"))
+        self.assertEqual(len(errs.failed()[0].comments), 2)
+
+        # checksums are not verified when errors are not wanted
+        calls = []
+        self.valid8.progress = lambda *args: calls.append(args)
+        errs = self.valid8.test_manifest(self.bag, val.WARN|val.REC)
+        self.assertFalse(has_error(errs, "3-2-2"))
+        self.assertEqual(calls, [])
             
     def test_test_tagmanifest(self):
         errs = self.valid8.test_tagmanifest(self.bag)
@@ -2,6 +2,11 @@ import os, sys, pdb, json
 import unittest as test
 
 import nistoar.pdr.preserv.bagit.validate.base as base
+from nistoar.pdr.preserv.bagit.bag import NISTBag
+
+datadir = os.path.join( os.path.dirname(os.path.dirname(
+                           os.path.dirname(__file__))), "data" )
+bagdir = os.path.join(datadir, "samplembag")
 
 class TestValidationIssue(test.TestCase):
 
@@ -82,6 +87,78 @@ class TestValidationIssue(test.TestCase):
         self.assertEqual(issue.description,
            "ERROR: Life 3.1 A1.1: Life must self-replicate\n  Little\n  green")
 
+class TestBagInventory(test.TestCase):
+
+    def setUp(self):
+        self.inv = base.BagInventory(bagdir)
+
+    def test_lookups(self):
+        self.assertEqual(self.inv.dir, bagdir)
+        self.assertTrue(self.inv.isdir(bagdir))
+        self.assertTrue(self.inv.isdir(os.path.join(bagdir, "data", "trial3")))
+        self.assertFalse(self.inv.isdir(os.path.join(bagdir, "bagit.txt")))
+        self.assertTrue(self.inv.isfile(os.path.join(bagdir, "bagit.txt")))
+        self.assertTrue(self.inv.isfile(os.path.join(bagdir, "data", "trial3",
+                                                     "trial3a.json")))
+        self.assertFalse(self.inv.isfile(os.path.join(bagdir, "data")))
+        self.assertTrue(self.inv.exists(os.path.join(bagdir, "data")))
+        self.assertFalse(self.inv.exists(os.path.join(bagdir, "goober")))
+        self.assertEqual(sorted(self.inv.listdir(os.path.join(bagdir, "data"))),
+                         ["trial1.json", "trial2.json", "trial3"])
+
+        # paths outside the bag are looked up on disk
+        self.assertTrue(self.inv.isdir(datadir))
+
+    def test_walk(self):
+        top = os.path.join(bagdir, "metadata")
+        expect = [(r, sorted(d), sorted(f)) for r, d, f in os.walk(top)]
+        got = [(r, sorted(d), sorted(f)) for r, d, f in self.inv.walk(top)]
+        self.assertEqual(sorted(got), sorted(expect))
+        self.assertEqual(list(self.inv.walk(os.path.join(bagdir, "goob"))), [])
+
+    def test_stat(self):
+        bagitf = os.path.join(bagdir, "bagit.txt")
+        st = self.inv.stat(bagitf)
+        self.assertEqual(st.st_size, os.stat(bagitf).st_size)
+        self.assertIs(self.inv.stat(bagitf), st)
+
+    def test_read_json(self):
+        nerdf = os.path.join(bagdir, "metadata", "nerdm.json")
+        data = self.inv.read_json(nerdf)
+        self.assertIn("ediid", data)
+        self.assertIs(self.inv.read_json(nerdf), data)
+
+        with self.assertRaises(ValueError):
+            self.inv.read_json(os.path.join(bagdir, "bagit.txt"))
+        with self.assertRaises(IOError):
+            self.inv.read_json(os.path.join(bagdir, "goober.json"))
+
+class _InvValidator(base.ValidatorBase):
+    def __init__(self):
+        super(_InvValidator, self).__init__({})
+        self.seen = []
+    def test_one(self, bag, want=base.ALL, results=None):
+        self.seen.append(self._inventory(bag))
+    def test_two(self, bag, want=base.ALL, results=None):
+        self.seen.append(self._inventory(bag))
+
+class TestSharedInventory(test.TestCase):
+
+    def test_validate(self):
+        bag = NISTBag(bagdir)
+        v1 = _InvValidator()
+        v2 = _InvValidator()
+        base.AggregatedValidator(v1, v2).validate(bag)
+
+        self.assertEqual(len(v1.seen), 2)
+        self.assertEqual(len(v2.seen), 2)
+        self.assertTrue(all(i is v1.seen[0] for i in v1.seen + v2.seen))
+
+        # outside of validate(), a fresh snapshot is taken
+        v1.test_one(bag)
+        self.assertIsNot(v1.seen[-1], v1.seen[0])
+
+
 
 
 
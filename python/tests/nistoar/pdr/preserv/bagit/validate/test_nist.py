@@ -1,5 +1,5 @@
 from __future__ import print_function
-import os, sys, pdb, json, shutil, copy, re
+import os, sys, pdb, json, shutil, copy, re, time
 
 import unittest as test
 from collections import OrderedDict
@@ -432,9 +432,69 @@ class TestMultibagValidator(test.TestCase):
         self.assertEqual(errs.failed()[0].label, "4.1-4-2c")
         self.assertEqual(errs.failed()[1].label, "4.1-4-2a")
 
-        
-        
-        
+    def test_nerdm_validity_parallel(self):
+        expect = self.valid8.test_nerdm_validity(self.bag)
+
+        for procs in (False, True):
+            valid8 = val.NISTBagValidator({ "nerdm_schema_dir": schemadir,
+                                            "validation_workers": 3,
+                                            "validation_processes": procs })
+            errs = valid8.test_nerdm_validity(self.bag)
+            self.assertEqual(errs.count_applied(), expect.count_applied())
+            self.assertEqual([str(e) for e in errs.failed()],
+                             [str(e) for e in expect.failed()])
+
+class TestSchemaValidatorCache(test.TestCase):
+
+    def setUp(self):
+        val.clear_schema_validators()
+
+    def tearDown(self):
+        val.clear_schema_validators()
+
+    def test_schema_validator(self):
+        with val.schema_validator(schemadir, '_') as v1:
+            self.assertIsNotNone(v1)
+
+            # a validator in use is not handed out again
+            with val.schema_validator(schemadir, '_') as v2:
+                self.assertIsNot(v2, v1)
+
+        # ...but is reused once returned
+        with val.schema_validator(schemadir, '_') as v3:
+            self.assertIn(v3, [v1, v2])
+        with val.schema_validator(schemadir, '$') as v4:
+            self.assertIsNot(v4, v1)
+            self.assertIsNot(v4, v2)
+
+        val.clear_schema_validators()
+        with val.schema_validator(schemadir, '_') as v5:
+            self.assertIsNot(v5, v1)
+            self.assertIsNot(v5, v2)
+
+    def test_validation_pool(self):
+        cfg = { "nerdm_schema_dir": schemadir, "validation_workers": 2,
+                "validation_processes": True }
+        comps = [({"_schema": val.DEF_NERDM_DATAFILE_SCHEMA}, None)] * 3
+
+        # the process pool is shared by validators for their lifetimes
+        val.NISTBagValidator(cfg)._validate_comps(comps)
+        self.assertEqual(len(val._pools), 1)
+        pool = list(val._pools.values())[0]
+        val.NISTBagValidator(cfg)._validate_comps(comps)
+        self.assertEqual(list(val._pools.values()), [pool])
+
+        val.clear_schema_validators()
+        self.assertEqual(len(val._pools), 0)
+
+        # the pool is shut down once it goes unused
+        cfg['validation_pool_idle'] = 0.1
+        val.NISTBagValidator(cfg)._validate_comps(comps)
+        self.assertEqual(len(val._pools), 1)
+        time.sleep(0.5)
+        self.assertEqual(len(val._pools), 0)
+
+
 
 if __name__ == '__main__':
     test.main()
@@ -0,0 +1,96 @@
+import os, pdb, sys, json, time
+import unittest as test
+
+from nistoar.testing import *
+from nistoar.pdr.preserv.service import jobqueue as jq
+
+class TestPreservationQueue(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.qfile = self.tf.track("queue.json")
+        self.q = jq.PreservationQueue(self.qfile)
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_ctor(self):
+        self.assertTrue(os.path.exists(self.qfile))
+        self.assertEqual(self.q.qfile, self.qfile)
+        self.assertEqual(self.q.depth, 0)
+        self.assertEqual(self.q.jobs(), [])
+        self.assertIsNone(self.q.next())
+
+    def test_add(self):
+        self.assertTrue(self.q.add("goob", "midas"))
+        self.assertTrue(self.q.add("gurn", "midas", True))
+        self.assertFalse(self.q.add("goob", "midas"))
+        self.assertEqual(self.q.depth, 2)
+        self.assertEqual([j['sipid'] for j in self.q.jobs()], ["goob", "gurn"])
+        self.assertTrue(self.q.jobs()[1]['asupdate'])
+
+        # persisted
+        q = jq.PreservationQueue(self.qfile)
+        self.assertEqual(q.depth, 2)
+        self.assertEqual(q.position("gurn"), (2, 2))
+
+    def test_priority(self):
+        self.q.add("goob", "midas")
+        self.q.add("gurn", "midas")
+        self.q.add("hank", "midas", priority=1)
+        self.assertEqual([j['sipid'] for j in self.q.jobs()],
+                         ["hank", "goob", "gurn"])
+        self.assertEqual(self.q.position("goob"), (2, 3))
+        self.assertIsNone(self.q.position("bob"))
+
+    def test_next(self):
+        self.q.add("goob", "midas")
+        self.q.add("gurn", "midas")
+
+        job = self.q.next()
+        self.assertEqual(job['sipid'], "goob")
+        self.assertEqual(job['state'], jq.RUNNING)
+        self.assertEqual(job['pid'], os.getpid())
+        self.assertEqual(self.q.depth, 1)
+        self.assertIsNone(self.q.position("goob"))
+        self.assertEqual(self.q.position("gurn"), (1, 1))
+        self.assertEqual(self.q.get("goob")['state'], jq.RUNNING)
+        self.assertEqual(self.q.get("gurn")['state'], jq.QUEUED)
+        self.assertIsNone(self.q.get("bob"))
+
+        # still can't add a running job
+        self.assertFalse(self.q.add("goob", "midas"))
+
+        self.assertEqual(self.q.next()['sipid'], "gurn")
+        self.assertIsNone(self.q.next())
+        self.assertEqual(len(self.q.jobs()), 2)
+
+        self.assertTrue(self.q.remove("goob"))
+        self.assertFalse(self.q.remove("goob"))
+        self.assertEqual([j['sipid'] for j in self.q.jobs()], ["gurn"])
+
+    def test_recover(self):
+        self.q.add("goob", "midas")
+        self.q.add("gurn", "midas")
+        self.q.next()
+        self.assertEqual(self.q.recover(), [])   # we're still alive
+
+        # simulate a job from a dead process
+        with open(self.qfile) as fd:
+            data = json.load(fd)
+        data['jobs'][0]['pid'] = 999999999
+        with open(self.qfile, 'w') as fd:
+            json.dump(data, fd)
+
+        self.assertEqual(self.q.recover(), ["goob"])
+        self.assertEqual(self.q.position("goob"), (1, 2))
+        self.assertEqual(self.q.next()['sipid'], "goob")
+
+    def test_pid_is_alive(self):
+        self.assertTrue(jq.pid_is_alive(os.getpid()))
+        self.assertFalse(jq.pid_is_alive(0))
+        self.assertFalse(jq.pid_is_alive(None))
+        self.assertFalse(jq.pid_is_alive(999999999))
+
+if __name__ == '__main__':
+    test.main()
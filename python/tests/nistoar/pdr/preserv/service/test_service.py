@@ -1,9 +1,10 @@
-import os, pdb, sys, logging, threading, time, yaml
+import os, pdb, sys, logging, threading, time, yaml, json
 import unittest as test
 
 from nistoar.testing import *
 from nistoar.pdr.preserv.service import service as serv
 from nistoar.pdr.preserv.service import status
+from nistoar.pdr.preserv.service import jobqueue
 from nistoar.pdr.preserv.service.siphandler import SIPHandler, MIDASSIPHandler
 from nistoar.pdr.exceptions import PDRException, StateException
 
@@ -184,6 +185,73 @@ class TestThreadedPreservationService(test.TestCase):
         self.assertTrue(os.path.exists(os.path.join(self.store,
                                     self.midasid+".1_0_0.mbag0_4-0.zip.sha256")))
 
+    def test_launch_queued(self):
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        (stat, job) = self.svc._launch_handler(hndlr, 0)
+        self.assertEqual(job.name, self.midasid)
+        job.join()
+
+        self.assertEqual(hndlr.state, status.SUCCESSFUL)
+        self.assertEqual(self.svc._queue.jobs(), [])
+        self.assertTrue(os.path.exists(os.path.join(self.workdir,
+                                                    "preserv_queue.json")))
+
+    def test_status_queued(self):
+        self.svc._queue.add("goober", "midas")
+        self.svc._queue.add(self.midasid, "midas")
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        hndlr._status.reset()
+
+        stat = self.svc.status(self.midasid)
+        self.assertEqual(stat['state'], status.PENDING)
+        self.assertEqual(stat['queue_position'], 2)
+        self.assertEqual(stat['queue_depth'], 2)
+        self.assertIn("position 2 of 2", stat['message'])
+
+    def test_recover_queue(self):
+        self.svc._queue.add(self.midasid, "midas")
+        self.svc = serv.ThreadedPreservationService(self.config)
+        for t in threading.enumerate():
+            if isinstance(t, serv.ThreadedPreservationService._Worker):
+                t.join()
+        self.assertEqual(self.svc._queue.jobs(), [])
+        stat = self.svc.status(self.midasid)
+        self.assertEqual(stat['state'], status.SUCCESSFUL)
+
+    def test_shared_queue(self):
+        # a request queued by one service instance but processed by another
+        # sharing the same queue file
+        self.svc._poll_interval = 0.1
+        self.svc._ensure_workers = lambda: None   # let other do the work
+        other = serv.ThreadedPreservationService(self.config)
+        self.assertEqual(other._queue.qfile, self.svc._queue.qfile)
+
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        (stat, job) = self.svc._launch_handler(hndlr, 0)
+        self.assertEqual(stat['state'], status.PENDING)
+        self.assertTrue(job.is_alive())
+
+        with other._lock:
+            other._ensure_workers()
+        job.join(30)
+        self.assertFalse(job.is_alive())
+        for w in list(other._workers):
+            w.join()
+        self.assertEqual(self.svc._jobs, {})
+        self.assertEqual(self.svc._queue.jobs(), [])
+        self.assertEqual(self.svc.status(self.midasid)['state'],
+                         status.SUCCESSFUL)
+
+        # a new request must be queued again rather than waiting on the
+        # completed job
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        (stat, job2) = self.svc._launch_handler(hndlr, 0)
+        self.assertIsNot(job2, job)
+        self.assertTrue(job2.is_alive())
+        self.assertIsNotNone(self.svc._queue.get(self.midasid))
+        self.svc._queue.remove(self.midasid)
+        self.assertFalse(job2.is_alive())
+
     def test_preserve(self):
         self.assertFalse(os.path.exists(os.path.join(self.narch,"archive.txt")))
 
@@ -354,6 +422,8 @@ class TestMultiprocPreservationService(test.TestCase):
             raise
 
     def tearDown(self):
+        if self.svc:
+            self.svc.close()
         self.svc = None
         self.tf.clean()
 
@@ -364,33 +434,87 @@ class TestMultiprocPreservationService(test.TestCase):
 
         self.assertEqual(self.svc.siptypes, ['midas'])
 
-# multiproc is not working
-#
-#    def test_launch_sync(self):
-#        hndlr = self.svc._make_handler(self.midasid, 'midas')
-#        self.assertEqual(hndlr.state, status.FORGOTTEN)
-#        self.assertTrue(hndlr.isready())
-#         self.assertEqual(hndlr.state, status.READY)
-# 
-#         cpid = 0
-#         try:
-#             pdb.set_trace()
-#             (stat, cpid) = self.svc._launch_handler(hndlr, 10)
-#             self.assertEqual(stat['state'], status.SUCCESSFUL)
-#         finally:
-#             if cpid > 0:
-#                 try:
-#                     os.waitpid(cpid, 0)
-#                 except OSError, e:
-#                     time.sleep(2)
-# 
-#         self.assertEqual(hndlr.state, status.SUCCESSFUL)
-#         self.assertTrue(os.path.exists(os.path.join(self.store,
-#                                            self.midasid+".1_0.mbag0_4-0.zip")))
-#         self.assertTrue(os.path.exists(os.path.join(self.store,
-#                                     self.midasid+".1_0.mbag0_4-0.zip.sha256")))
-        
+    def test_launch_sync(self):
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        self.assertEqual(hndlr.state, status.FORGOTTEN)
+        self.assertTrue(hndlr.isready())
+        self.assertEqual(hndlr.state, status.READY)
+
+        (stat, job) = self.svc._launch_handler(hndlr, 60)
+        self.assertFalse(job.is_alive())
+        self.assertEqual(stat['state'], status.SUCCESSFUL)
+        self.assertEqual(hndlr.state, status.SUCCESSFUL)
+        self.assertTrue(os.path.exists(os.path.join(self.store,
+                                           self.midasid+".1_0_0.mbag0_4-0.zip")))
+        self.assertTrue(os.path.exists(os.path.join(self.store,
+                                    self.midasid+".1_0_0.mbag0_4-0.zip.sha256")))
+
+    def test_launch_async(self):
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        (stat, job) = self.svc._launch_handler(hndlr, 0)
+        self.assertIn(stat['state'], [status.PENDING, status.IN_PROGRESS])
+        job.join()
+
+        stat = self.svc.status(self.midasid)
+        self.assertEqual(stat['state'], status.SUCCESSFUL)
+
+    def test_crash_detection(self):
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        hndlr._status.start()
+        hndlr._status.data['sys']['pid'] = 999999999
+        hndlr._status.cache()
+
+        stat = self.svc.status(self.midasid)
+        self.assertEqual(stat['state'], status.FAILED)
+        self.assertIn("died", stat['message'])
+
+        # died while claimed from the queue:  the request gets re-queued
+        self.svc.close()
+        self.svc._queue.add(self.midasid, "midas")
+        self.svc._queue.next()
+        with open(self.svc._queue.qfile) as fd:
+            data = json.load(fd)
+        data['jobs'][0]['pid'] = 999999999
+        with open(self.svc._queue.qfile, 'w') as fd:
+            json.dump(data, fd)
+        hndlr._status.start()
+
+        stat = self.svc.status(self.midasid)
+        self.assertEqual(stat['state'], status.PENDING)
+        entry = self.svc._queue.get(self.midasid)
+        self.assertEqual(entry['state'], jobqueue.QUEUED)
+        self.assertNotIn('pid', entry)
+
+    def test_lost_request(self):
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        hndlr._status.reset()
+        self.assertEqual(self.svc.status(self.midasid)['state'], status.PENDING)
+
+        # pending for too long without being queued
+        hndlr._status.data['user']['update_time'] -= 2*serv.LOST_REQUEST_TIMEOUT
+        status.SIPStatusFile.write(hndlr._status._cachefile,
+                                   hndlr._status.data)
+        stat = self.svc.status(self.midasid)
+        self.assertEqual(stat['state'], status.FAILED)
+        self.assertIn("lost", stat['message'])
+
+    def test_resume_after_close(self):
+        # requests still waiting when the service is closed are processed
+        # by the next instance
+        self.svc.close()
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        self.svc._queue.add(self.midasid, "midas")
+        hndlr._status.reset()
 
+        self.svc = serv.MultiprocPreservationService(self.config)
+        self.assertIn(self.svc.status(self.midasid)['state'],
+                      [status.PENDING, status.IN_PROGRESS, status.SUCCESSFUL])
+        job = self.svc._Job(self.svc, hndlr)
+        job.join(60)
+        self.assertFalse(job.is_alive())
+        self.assertEqual(self.svc._queue.jobs(), [])
+        self.assertEqual(self.svc.status(self.midasid)['state'],
+                         status.SUCCESSFUL)
 
 
 if __name__ == '__main__':
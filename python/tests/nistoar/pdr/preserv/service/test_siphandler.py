@@ -5,6 +5,7 @@ from nistoar.testing import *
 from nistoar.pdr.preserv import PreservationException
 from nistoar.pdr.preserv.service import siphandler as sip
 from nistoar.pdr.preserv.service import status
+from nistoar.pdr.utils import checksum_of
 
 # datadir = nistoar/preserv/data
 datadir = os.path.join( os.path.dirname(os.path.dirname(__file__)), "data" )
@@ -251,6 +252,55 @@ class TestMIDASSIPHandler(test.TestCase):
         self.assertGreater(os.stat(destfile).st_size, 1)
             
         
+    def test_bagit_parallel_multibag(self):
+        self.config['multibag']['max_headbag_size'] = 100
+        self.config['multibag']['max_bag_size'] = 10000
+        self.config['multibag']['serialization_workers'] = 3
+        self.sip = sip.MIDASSIPHandler(self.midasid, self.config)
+        self.sip.bagit()
+        self.assertEqual(self.sip.state, status.SUCCESSFUL)
+
+        bagfiles = self.sip.status['bagfiles']
+        self.assertGreater(len(bagfiles), 1)
+        for bf in bagfiles:
+            bagfile = os.path.join(self.store, bf['name'])
+            self.assertTrue(os.path.exists(bagfile))
+            self.assertEqual(bf['sha256'], checksum_of(bagfile))
+
+    def test_bagit_tostore(self):
+        self.sip.cfg['serialize_to_store'] = True
+        self.assertEqual(self.sip.state, status.FORGOTTEN)
+        self.sip.bagit()
+        bagfile = os.path.join(self.store, self.midasid+".1_0_0.mbag0_4-0.zip")
+        self.assertTrue(os.path.exists(bagfile))
+        with open(bagfile+".sha256") as fd:
+            csum = fd.read().strip()
+        self.assertEqual(self.sip.status['bagfiles'][0]['sha256'], csum)
+        self.assertEqual(self.sip.state, status.SUCCESSFUL)
+
+        cf = os.path.join(self.revdir, "1491/_preserv", self.midasid+"_0.sha256")
+        self.assertTrue(os.path.exists(cf), "Does not exist: "+cf)
+
+        # head bag is in staging area; store copy was not cleaned up
+        staged = os.listdir(self.sip.stagedir)
+        self.assertEqual(staged, [os.path.basename(bagfile)])
+        self.assertTrue(os.path.exists(bagfile))
+
+    def test_bagit_tostore_nooverwrite(self):
+        self.sip.cfg['serialize_to_store'] = True
+        destfile = os.path.join(self.store, self.midasid+".1_0_0.mbag0_4-0.zip")
+        with open(destfile, 'w') as fd:
+            fd.write("\n");
+
+        try:
+            self.sip.bagit()
+            self.fail("Failed to catch overwrite error")
+        except PreservationException as ex:
+            self.assertEqual(len(ex.errors), 1)
+            self.assertEqual(ex.errors[0],
+                             "[Errno 17] File exists: '{}'".format(destfile))
+        self.assertEqual(os.stat(destfile).st_size, 1)
+            
     def test_is_preserved(self):
         self.assertEqual(self.sip.state, status.FORGOTTEN)
         self.assertFalse(self.sip._is_preserved())
@@ -291,6 +291,52 @@ class TestPrePubMetadataService(test.TestCase):
         with self.assertRaises(serv.IDNotFound):
             self.srv.resolve_id("asldkfjsdalfk")
 
+    def test_resolve_id_cached(self):
+        self.config['async_file_examine'] = False
+        self.srv = serv.PrePubMetadataService(self.config)
+        self.assertFalse(os.path.exists(self.bagdir))
+
+        data, etag = self.srv.resolve_id_as_json(self.midasid)
+        self.assertIn(self.midasid, self.srv._respcache)
+        mdata = json.loads(data)
+        self.assertEqual(mdata['ediid'], self.midasid)
+
+        # unchanged SIP: the cached response is served
+        data2, etag2 = self.srv.resolve_id_as_json(self.midasid)
+        self.assertEqual(etag2, etag)
+        self.assertEqual(data2, data)
+        self.assertEqual(self.srv.resolve_id(self.midasid)['ediid'],
+                         self.midasid)
+
+        # a change to the SIP changes the fingerprint
+        bagger = self.srv.open_bagger(self.midasid)
+        fp = self.srv.sip_fingerprint(bagger)
+        self.assertEqual(self.srv._respcache[self.midasid][0], fp)
+        indir = self.tf.mkdir("sip")
+        shutil.rmtree(indir)
+        shutil.copytree(self.testsip, indir)
+        self.config['review_dir'] = os.path.join(indir, "review")
+        self.config['upload_dir'] = os.path.join(indir, "upload")
+        self.srv = serv.PrePubMetadataService(self.config)
+        bagger = self.srv.open_bagger(self.midasid)
+        fp = self.srv.sip_fingerprint(bagger)
+        with open(os.path.join(indir, "review", "1491", "trial1.json"), 'a') \
+             as fd:
+            fd.write("\n")
+        self.assertNotEqual(self.srv.sip_fingerprint(bagger), fp)
+
+    def test_response_cache_lru(self):
+        self.srv._respcache_size = 2
+        self.srv._cache_put("a", ("fa", "{}", '"a"'))
+        self.srv._cache_put("b", ("fb", "{}", '"b"'))
+        self.assertTrue(self.srv._cache_get("a", "fa"))
+        self.srv._cache_put("c", ("fc", "{}", '"c"'))
+        self.assertEqual(list(self.srv._respcache.keys()), ["a", "c"])
+        self.assertIsNone(self.srv._cache_get("a", "fx"))
+        self.assertNotIn("a", self.srv._respcache)
+        self.srv.clear_response_cache()
+        self.assertEqual(len(self.srv._respcache), 0)
+
     def test_resolve_arkid(self):
         indir = os.path.join(self.workdir, os.path.basename(self.testsip))
         shutil.copytree(self.testsip, indir)
@@ -113,6 +113,44 @@ class TestApp(test.TestCase):
         self.assertEqual(data['ediid'], '3A1EE2F169DD3B8CE0531A570681DB5D1491')
         self.assertEqual(len(data['components']), 7)
         
+    def test_etag(self):
+        self.svc = wsgi.app({
+            'working_dir':     self.bagparent,
+            'review_dir':      self.revdir,
+            'upload_dir':      self.upldir,
+            'id_registry_dir': self.bagparent,
+            'async_file_examine': False
+        })
+        req = {
+            'PATH_INFO': '/3A1EE2F169DD3B8CE0531A570681DB5D1491',
+            'REQUEST_METHOD': 'GET'
+        }
+        body = self.svc(req, self.start)
+        self.assertIn("200", self.resp[0])
+        etag = [l for l in self.resp if l.startswith("ETag:")]
+        self.assertEqual(len(etag), 1)
+        etag = etag[0][len("ETag:"):].strip()
+        self.assertTrue(etag.startswith('"'))
+
+        self.resp = []
+        req['HTTP_IF_NONE_MATCH'] = etag
+        body = self.svc(req, self.start)
+        self.assertIn("304", self.resp[0])
+        self.assertEqual(len(body), 0)
+        self.assertIn("ETag: "+etag, self.resp)
+
+        self.resp = []
+        req['HTTP_IF_NONE_MATCH'] = '"goober", W/'+etag
+        body = self.svc(req, self.start)
+        self.assertIn("304", self.resp[0])
+
+        self.resp = []
+        req['HTTP_IF_NONE_MATCH'] = '"goober"'
+        body = self.svc(req, self.start)
+        self.assertIn("200", self.resp[0])
+        data = json.loads(body[0])
+        self.assertEqual(data['ediid'], '3A1EE2F169DD3B8CE0531A570681DB5D1491')
+        
     def test_head_good_id(self):
         req = {
             'PATH_INFO': '/3A1EE2F169DD3B8CE0531A570681DB5D1491',
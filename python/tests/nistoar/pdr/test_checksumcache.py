@@ -0,0 +1,141 @@
+import os, sys, pdb, time
+import unittest as test
+
+from nistoar.testing import *
+import nistoar.pdr.checksumcache as csc
+from nistoar.pdr.utils import checksum_of
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+testdatadir = os.path.join(testdir, 'preserv', 'data', 'simplesip')
+
+class TestChecksumCache(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.dbfile = self.tf.track("cscache.sqlite")
+        self.cache = csc.ChecksumCache(self.dbfile, 3)
+
+        # files must be a little old to be cached
+        self.past = time.time() - 60
+        self.files = []
+        for i in range(5):
+            f = self.tf.track("file{0}.txt".format(i))
+            with open(f, 'w') as fd:
+                fd.write("file #{0}\n".format(i))
+            os.utime(f, (self.past, self.past))
+            self.files.append(f)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tf.clean()
+
+    def test_ctor(self):
+        self.assertTrue(os.path.isfile(self.dbfile))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.stats['hits'], 0)
+
+        with self.assertRaises(ValueError):
+            csc.ChecksumCache(self.dbfile, algorithm="md5")
+
+    def test_from_config(self):
+        cache = csc.ChecksumCache.from_config({'max_entries': 10}, self.tf.root)
+        try:
+            self.tf.track("checksum_cache.sqlite")
+            self.assertEqual(cache.dbfile, self.tf("checksum_cache.sqlite"))
+            self.assertEqual(cache.max_entries, 10)
+        finally:
+            cache.close()
+
+    def test_get_put(self):
+        f = self.files[0]
+        self.assertIsNone(self.cache.get(f))
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+        self.cache.put(f, "abcdef")
+        self.assertEqual(self.cache.get(f), "abcdef")
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['stored'], 1)
+
+        # persists across instances
+        cache = csc.ChecksumCache(self.dbfile)
+        try:
+            self.assertEqual(cache.get(f), "abcdef")
+        finally:
+            cache.close()
+
+    def test_invalidate(self):
+        f = self.files[0]
+        self.cache.put(f, "abcdef")
+        with open(f, 'a') as fd:
+            fd.write("more\n")
+        os.utime(f, (self.past, self.past+1))
+        self.assertIsNone(self.cache.get(f))
+        self.assertEqual(self.cache.stats['invalidated'], 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_too_recent(self):
+        f = self.files[0]
+        os.utime(f, None)
+        self.cache.put(f, "abcdef")
+        self.assertIsNone(self.cache.get(f))
+
+    def test_checksum_of(self):
+        f = self.files[1]
+        cs = self.cache.checksum_of(f)
+        self.assertEqual(cs, checksum_of(f))
+        self.assertEqual(self.cache.stats['misses'], 1)
+        self.assertEqual(self.cache.checksum_of(f), cs)
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+        # hard links share the cached value
+        lnk = self.tf.track("link.txt")
+        os.link(f, lnk)
+        self.assertEqual(self.cache.checksum_of(lnk), cs)
+        self.assertEqual(self.cache.stats['hits'], 2)
+
+    def test_checksums_of(self):
+        self.cache.put(self.files[0], "abcdef")
+        sums = dict(self.cache.checksums_of(self.files[:3], 2))
+        self.assertEqual(len(sums), 3)
+        self.assertEqual(sums[self.files[0]], "abcdef")
+        self.assertEqual(sums[self.files[2]], checksum_of(self.files[2]))
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['stored'], 3)
+
+    def test_prune(self):
+        for i in range(5):
+            self.cache.checksum_of(self.files[i])
+        self.assertLessEqual(len(self.cache), 4)   # pruned periodically
+        self.cache.prune()
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.stats['evicted'], 2)
+
+        # least recently used were evicted
+        self.assertIsNone(self.cache.get(self.files[0]))
+        self.assertIsNotNone(self.cache.get(self.files[4]))
+
+    def test_access_resolution(self):
+        f = self.files[0]
+        self.cache.put(f, "abcdef")
+        sql = "SELECT accessed FROM checksums"
+        accessed = self.cache._db.execute(sql).fetchone()[0]
+
+        # a recent access time is not rewritten on a hit
+        time.sleep(0.01)
+        self.assertEqual(self.cache.get(f), "abcdef")
+        self.assertEqual(self.cache._db.execute(sql).fetchone()[0], accessed)
+
+        # a stale one is
+        self.cache.access_resolution = 0
+        self.assertEqual(self.cache.get(f), "abcdef")
+        self.assertGreater(self.cache._db.execute(sql).fetchone()[0], accessed)
+
+    def test_clear(self):
+        self.cache.checksum_of(self.files[0])
+        self.assertEqual(len(self.cache), 1)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == '__main__':
+    test.main()
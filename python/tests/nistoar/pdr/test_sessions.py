@@ -0,0 +1,114 @@
+import os, sys, pdb, threading
+import unittest as test
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import requests
+import nistoar.pdr.sessions as sessions
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        srv = self.server
+        srv.requests += 1
+        srv.ports.add(self.client_address[1])
+        if srv.failures > 0:
+            srv.failures -= 1
+            code, body = 503, "busy"
+        else:
+            code, body = 200, "ok"
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestPooledSession(test.TestCase):
+
+    def setUp(self):
+        self.srv = HTTPServer(("localhost", 0), _Handler)
+        self.srv.requests = 0
+        self.srv.failures = 0
+        self.srv.ports = set()
+        self.thread = threading.Thread(target=self.srv.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://localhost:{0}/".format(self.srv.server_address[1])
+        self.sess = sessions.PooledSession(retries=2, backoff_factor=0)
+
+    def tearDown(self):
+        self.sess.close()
+        self.srv.shutdown()
+        self.srv.server_close()
+
+    def test_ctor(self):
+        self.assertEqual(self.sess.timeout, (sessions.DEF_CONNECT_TIMEOUT,
+                                             sessions.DEF_READ_TIMEOUT))
+        adapter = self.sess.get_adapter("https://example.com/")
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertEqual(adapter._pool_maxsize, sessions.DEF_POOL_SIZE)
+
+    def test_keepalive(self):
+        for i in range(3):
+            resp = self.sess.get(self.url)
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.srv.requests, 3)
+        self.assertEqual(len(self.srv.ports), 1)
+
+    def test_retry(self):
+        self.srv.failures = 2
+        resp = self.sess.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.srv.requests, 3)
+
+        # retries exhausted: the last response is returned
+        self.srv.requests = 0
+        self.srv.failures = 5
+        resp = self.sess.get(self.url)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(self.srv.requests, 3)
+
+    def test_connect_error(self):
+        url = self.url
+        self.tearDown()
+        with self.assertRaises(requests.ConnectionError):
+            self.sess.get(url)
+        self.setUp()
+
+class TestGetSession(test.TestCase):
+
+    def tearDown(self):
+        sessions.configure({})
+        sessions.close_all()
+
+    def test_get_session(self):
+        sess = sessions.get_session()
+        self.assertTrue(isinstance(sess, sessions.PooledSession))
+        self.assertIs(sessions.get_session(), sess)
+        self.assertIs(sessions.get_session({}), sess)
+
+        other = sessions.get_session({"retries": 0, "timeout": 5})
+        self.assertIsNot(other, sess)
+        self.assertEqual(other.timeout, 5)
+        self.assertEqual(other.retries.total, 0)
+
+    def test_configure(self):
+        sess = sessions.get_session()
+        sessions.configure({"pool_size": 2, "read_timeout": 30})
+        other = sessions.get_session()
+        self.assertIsNot(other, sess)
+        self.assertEqual(other.timeout, (sessions.DEF_CONNECT_TIMEOUT, 30))
+
+        with self.assertRaises(ValueError):
+            sessions.configure("goob")
+
+    def test_close_all(self):
+        sess = sessions.get_session()
+        sessions.close_all()
+        self.assertIsNot(sessions.get_session(), sess)
+
+
+if __name__ == '__main__':
+    test.main()
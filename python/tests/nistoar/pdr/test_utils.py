@@ -59,6 +59,52 @@ class TestChecksum(test.TestCase):
         dfile = os.path.join(testdatadir2,"trial3/trial3a.json")
         self.assertEqual(utils.checksum_of(dfile), self.syssum(dfile))
 
+    def test_checksums_of(self):
+        dfiles = [os.path.join(testdatadir2, f) for f in
+                  "trial1.json trial2.json trial3/trial3a.json".split()]
+        expect = dict([(f, self.syssum(f)) for f in dfiles])
+
+        for workers in (1, 3):
+            sums = list(utils.checksums_of(dfiles, workers))
+            self.assertEqual(len(sums), 3)
+            self.assertEqual(dict(sums), expect)
+
+        sums = dict(utils.checksums_of(dfiles, 2, processes=True, bufsize=100))
+        self.assertEqual(sums, expect)
+
+        with self.assertRaises(IOError):
+            list(utils.checksums_of(dfiles+["/goober/gurn.json"], 2))
+
+    def test_copy_with_checksum(self):
+        tf = Tempfiles()
+        try:
+            dfile = os.path.join(testdatadir2,"trial1.json")
+            out = tf("trial1.json")
+            size, sums = utils.copy_with_checksum(dfile, out)
+            self.assertTrue(os.path.isfile(out))
+            self.assertEqual(size, os.stat(dfile).st_size)
+            self.assertEqual(sums.keys(), ['sha256'])
+            self.assertEqual(sums['sha256'], self.syssum(dfile))
+            self.assertEqual(utils.checksum_of(out), sums['sha256'])
+
+            dfile = os.path.join(testdatadir2,"trial3/trial3a.json")
+            size, sums = utils.copy_with_checksum(dfile, tf.root,
+                                                  ['sha256', 'md5'])
+            out = tf("trial3a.json")
+            self.assertTrue(os.path.isfile(out))
+            self.assertEqual(size, os.stat(out).st_size)
+            self.assertEqual(sums['sha256'], self.syssum(dfile))
+            self.assertEqual(len(sums['md5']), 32)
+
+            # read in small pieces
+            size, sums = utils.copy_with_checksum(dfile, out, bufsize=100)
+            self.assertEqual(size, os.stat(dfile).st_size)
+            self.assertEqual(sums['sha256'], self.syssum(dfile))
+        finally:
+            tf.track("trial1.json")
+            tf.track("trial3a.json")
+            tf.clean()
+
     def syssum(self, filepath):
         cmd = ["sha256sum", filepath]
         proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
@@ -80,6 +126,30 @@ class TestMeausreDirSize(test.TestCase):
         self.assertEqual(vals[1], 5)
         self.assertEqual(vals[0], 9272)
 
+    def test_measure_exclude(self):
+        total = utils.measure_dir_size(testdatadir2)
+        sub = sorted([f for f in os.listdir(testdatadir2)
+                        if os.path.isdir(os.path.join(testdatadir2, f))])[0]
+        part = utils.measure_dir_size(os.path.join(testdatadir2, sub))
+        vals = utils.measure_dir_size(testdatadir2, [sub])
+        self.assertEqual(vals, [total[0]-part[0], total[1]-part[1]])
+
+    def test_measure_links(self):
+        tf = Tempfiles()
+        try:
+            root = tf.mkdir("measure")
+            os.mkdir(os.path.join(root, "sub"))
+            with open(os.path.join(root, "sub", "a.txt"), 'w') as fd:
+                fd.write("hello")
+            os.symlink(os.path.join(root, "sub"), os.path.join(root, "dlink"))
+            os.symlink(os.path.join(root, "sub", "a.txt"),
+                       os.path.join(root, "flink"))
+
+            # like os.walk(), linked directories are not descended into
+            self.assertEqual(utils.measure_dir_size(root), [10, 2])
+        finally:
+            tf.clean()
+
 class TestRmtree(test.TestCase):
 
     def setUp(self):
@@ -309,6 +379,21 @@ class TestJsonIO(test.TestCase):
         self.assertIn('@id', self.td)
         self.assertEqual(self.td['foo'], 'bar')
 
+    def test_write_compact(self):
+        data = utils.read_json(self.testdata)
+        utils.write_json(data, self.jfile, None)
+        with open(self.jfile) as fd:
+            content = fd.read()
+        self.assertNotIn('\n', content)
+        self.assertNotIn('": ', content)
+        self.assertEqual(utils.read_json(self.jfile), data)
+
+        utils.write_json(data, self.jfile)
+        with open(self.jfile) as fd:
+            pretty = fd.read()
+        self.assertIn('\n    "@id": ', pretty)
+        self.assertLess(len(content), len(pretty))
+
     
 
 